@@ -1,9 +1,11 @@
+import os
 import sys
 import math
+import time
 import datetime
-import random
+import numpy
 
-from skymap.database import SkyMapDatabase
+from skymap.database import SkyMapDatabase, shared_database, DATA_FOLDER
 from skymap.geometry import SphericalPoint, ensure_angle_range
 from skymap.coordinates import REFERENCE_EPOCH, PrecessionCalculator
 
@@ -112,49 +114,288 @@ class PointInConstellationPrecession(PrecessionCalculator):
         PrecessionCalculator.__init__(self, epoch, CONST_BOUND_EPOCH)
 
 
+class ConstellationZones(object):
+    """
+    The constellation zones of Delporte (the cst_id_data table), held in memory as lookup tables.
+
+    A point at epoch B1875 lies in the constellation of the first zone, in table order, with DE_low < dec and
+    RA_low <= ra < RA_up. The distinct DE_low values divide the declinations in levels, and the RA_low and RA_up values
+    divide the right ascensions in intervals. Within a level and an interval the same zones match, so the answer is
+    precomputed for each level and interval, and a lookup is two binary searches.
+    """
+
+    def __init__(self, ra_low, ra_up, de_low, constellations):
+        """
+        :param ra_low: Array with the lower right ascension of each zone, in hours
+        :param ra_up: Array with the upper right ascension of each zone, in hours
+        :param de_low: Array with the lower declination of each zone, in degrees
+        :param constellations: List with the constellation abbreviation of each zone
+        """
+
+        ra_low = numpy.asarray(ra_low, dtype=numpy.float64)
+        ra_up = numpy.asarray(ra_up, dtype=numpy.float64)
+        de_low = numpy.asarray(de_low, dtype=numpy.float64)
+        self.constellations = numpy.array([c.strip().lower() for c in constellations] + [""])
+
+        self.levels = numpy.unique(de_low)
+        self.breaks = numpy.unique(numpy.concatenate((ra_low, ra_up)))
+
+        # covers[z, j] is True if zone z covers the interval from breaks[j] to breaks[j + 1]
+        covers = (ra_low[:, None] <= self.breaks[None, :-1]) & (ra_up[:, None] >= self.breaks[None, 1:])
+
+        # first[k, j] is the first zone with DE_low <= levels[k] covering interval j, or len(zones) if there is none
+        nzones = len(de_low)
+        first = numpy.full((len(self.levels), max(len(self.breaks) - 1, 0)), nzones, dtype=numpy.int64)
+        current = first[0].copy() if len(self.levels) else None
+        zone_level = numpy.searchsorted(self.levels, de_low)
+        for k in range(len(self.levels)):
+            for z in numpy.flatnonzero(zone_level == k):
+                current = numpy.where(covers[z], numpy.minimum(current, z), current)
+            first[k] = current
+        self.first = first
+
+        # The levels and intervals as sine of declination and right ascension in degrees, for area calculations
+        self.level_bottoms = numpy.sin(numpy.radians(self.levels))
+        self.level_tops = numpy.append(self.level_bottoms[1:], 1.0)
+        self.break_degrees = 15.0 * self.breaks
+
+    @classmethod
+    def from_database(cls, db):
+        """Loads the zones from the cst_id_data table, in table order"""
+        rows = db.query("""SELECT RA_low, RA_up, DE_low, const FROM cst_id_data ORDER BY pk""")
+        return cls([r['RA_low'] for r in rows], [r['RA_up'] for r in rows], [r['DE_low'] for r in rows], [r['const'] for r in rows])
+
+    def find(self, ra, dec):
+        """
+        Finds the constellations of points at epoch B1875.
+
+        :param ra: Array of right ascensions, in degrees
+        :param dec: Array of declinations, in degrees
+        :return: Array of constellation abbreviations, empty strings for points outside all zones
+        """
+
+        ra = numpy.asarray(ra, dtype=numpy.float64) / 15.0
+        dec = numpy.asarray(dec, dtype=numpy.float64)
+
+        # Level k holds the zones with DE_low < dec; interval j holds breaks[j] <= ra < breaks[j + 1]
+        k = numpy.searchsorted(self.levels, dec, side="left") - 1
+        j = numpy.searchsorted(self.breaks, ra, side="right") - 1
+        valid = (k >= 0) & (j >= 0) & (j < len(self.breaks) - 1)
+
+        zones = numpy.full(len(ra), len(self.constellations) - 1, dtype=numpy.int64)
+        zones[valid] = self.first[k[valid], j[valid]]
+        return self.constellations[zones]
+
+    def sphere_areas(self):
+        """
+        Returns the area of each zone on the whole sphere.
+
+        :return: Array with the area of each zone in steradians, and as last element the area outside all zones
+        """
+
+        widths = numpy.radians(numpy.diff(self.break_degrees))
+        heights = self.level_tops - self.level_bottoms
+        areas = heights[:, None] * widths[None, :]
+        return numpy.bincount(self.first.ravel(), weights=areas.ravel(), minlength=len(self.constellations))
+
+    def loop_areas(self, ra, dec):
+        """
+        Integrates the area of each zone along a closed loop at epoch B1875, with Green's theorem.
+
+        In the plane of right ascension and sine of declination areas are proportional to solid angles and the zones
+        are rectangles. The area of a zone within a counterclockwise loop is minus the integral of
+        (clip(y, bottom, top) - bottom) dx along the loop, with bottom and top the sines of the declination limits.
+        The loop is followed with continuous right ascension, so a loop around a pole ends 360 degrees from where it
+        started; the integral then gives the area between the loop and the south pole. The loop is approximated by
+        straight segments in the plane, split at the right ascension intervals, and the integral is exact for each
+        segment.
+
+        :param ra: Array with the right ascensions of the vertices of the loop, in degrees
+        :param dec: Array with the declinations of the vertices of the loop, in degrees
+        :return: Array with the area of each zone within the loop in steradians, and as last element the area outside
+                 all zones
+        """
+
+        ra = numpy.asarray(ra, dtype=numpy.float64)
+        steps = (numpy.diff(numpy.append(ra, ra[0])) + 180.0) % 360.0 - 180.0
+        x = ra[0] + numpy.concatenate(([0.0], numpy.cumsum(steps)))
+        y = numpy.sin(numpy.radians(numpy.append(dec, dec[0])))
+
+        # Split the segments where they cross the right ascension intervals
+        turns = numpy.arange(math.floor(x.min() / 360.0), math.floor(x.max() / 360.0) + 1)
+        grid = (self.break_degrees[None, :] + 360.0 * turns[:, None]).ravel()
+        grid.sort()
+        x0, x1 = x[:-1], x[1:]
+        start = numpy.searchsorted(grid, numpy.minimum(x0, x1), side="right")
+        stop = numpy.searchsorted(grid, numpy.maximum(x0, x1), side="left")
+        counts = numpy.maximum(stop - start, 0)
+        segments = numpy.repeat(numpy.arange(len(x0)), counts)
+        crossings = grid[numpy.repeat(start, counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)]
+        t = (crossings - x0[segments]) / (x1[segments] - x0[segments])
+        keys = numpy.concatenate((numpy.arange(len(x), dtype=numpy.float64), segments + t))
+        order = numpy.argsort(keys, kind="mergesort")
+        x = numpy.concatenate((x, crossings))[order]
+        y = numpy.concatenate((y, y[:-1][segments] + t * (y[1:][segments] - y[:-1][segments])))[order]
+
+        # The interval of each segment
+        middle = (0.5 * (x[:-1] + x[1:])) % 360.0
+        j = numpy.searchsorted(self.break_degrees, middle, side="right") - 1
+        valid = (j >= 0) & (j < len(self.breaks) - 1)
+        dx = numpy.radians(numpy.diff(x))
+
+        areas = numpy.zeros(len(self.constellations))
+
+        # Below the loop, clip(y, bottom, top) - bottom is the height of the level, so only the total step in each
+        # interval matters. Above the loop it is zero.
+        below = self.level_tops <= y.min()
+        steps = numpy.bincount(j[valid], weights=dx[valid], minlength=len(self.breaks) - 1)
+        heights = self.level_tops[below] - self.level_bottoms[below]
+        areas += numpy.bincount(self.first[below].ravel(), weights=(-heights[:, None] * steps[None, :]).ravel(), minlength=len(areas))
+
+        # Mean of clip(y, bottom, top) - bottom along each segment, for the levels that the loop crosses
+        crossed = ~below & (self.level_bottoms < y.max())
+        y0, y1 = y[:-1, None], y[1:, None]
+        bottom, top = self.level_bottoms[None, crossed], self.level_tops[None, crossed]
+
+        def primitive(v):
+            # Integral of clip(v, bottom, top) - bottom from bottom to v
+            inside = numpy.clip(v, bottom, top) - bottom
+            return 0.5 * inside ** 2 + (top - bottom) * numpy.maximum(v - top, 0.0)
+
+        dy = y1 - y0
+        flat = numpy.abs(dy) < 1e-15
+        mean = numpy.where(
+            flat, numpy.clip(y0, bottom, top) - bottom, (primitive(y1) - primitive(y0)) / numpy.where(flat, 1.0, dy)
+        )
+
+        zones = numpy.full(mean.shape, len(self.constellations) - 1, dtype=numpy.int64)
+        zones[valid] = self.first[crossed][:, j[valid]].T
+        areas += numpy.bincount(zones.ravel(), weights=(-dx[:, None] * mean).ravel(), minlength=len(areas))
+        return areas
+
+
+_constellation_zones = None
+
+
+def get_constellation_zones():
+    """Returns the constellation zones, loading them on first use"""
+    global _constellation_zones
+    if _constellation_zones is None:
+        _constellation_zones = ConstellationZones.from_database(shared_database())
+    return _constellation_zones
+
+
 class ConstellationFinder(object):
     """
     Find the constellation for a given coordinate.
     """
-    def __init__(self, epoch=None):
-        self.db = SkyMapDatabase()
+    def __init__(self, epoch=None, zones=None):
+        if zones is None:
+            zones = get_constellation_zones()
+        self.zones = zones
         self.precessor = PointInConstellationPrecession(epoch)
 
     def find(self, ra, de):
-        ra, de = self.precessor.precess(ra, de)
-        ra /= 15.0  # Convert to fractional hours of right ascension
+        return self.find_many([ra], [de])[0] or None
+
+    def find_many(self, ra, dec):
+        """
+        Finds the constellations of arrays of coordinates.
+
+        :param ra: Array of right ascensions, in degrees
+        :param dec: Array of declinations, in degrees
+        :return: Array of constellation abbreviations, empty strings for coordinates outside all zones
+        """
+
+        ra, dec = self.precessor.precess_arrays(ra, dec)
+        return self.zones.find(ra, dec)
+
 
-        q = """
-                SELECT const
-                FROM skymap.cst_id_data
-                WHERE DE_low < {0} AND RA_low <= {1}  AND RA_up > {1} ORDER BY pk LIMIT 1
-            """.format(de, ra)
-        return self.db.query_one(q)['const'].lower()
+def sample_range(start, stop, step):
+    """Returns evenly spaced values from start up to but not including stop, at most step apart"""
+    n = max(int(math.ceil(abs(stop - start) / step)), 1)
+    return numpy.linspace(start, stop, n, endpoint=False)
 
 
-def constellations_in_area(min_longitude, max_longitude, min_latitude, max_latitude, nsamples=1000):
+def box_loops(min_ra, width, min_dec, max_dec, step=0.1):
     """
-    Generates a list of all constellations that overlap with the given area.
-    Uses a simple Monte Carlo strategy.
+    Returns the boundary of a coordinate box as counterclockwise loops, with vertices at most step apart. A box with
+    the full right ascension circle is bounded by its lower and upper parallel, unless they are at a pole.
+
+    :param min_ra: The lower right ascension, in degrees
+    :param width: The width in right ascension, in degrees
+    :param min_dec: The lower declination, in degrees
+    :param max_dec: The upper declination, in degrees
+    :param step: The maximum distance between vertices, in degrees
+    :return: A list of (ra, dec) tuples of arrays
     """
 
-    constellations = {}
-    cf = ConstellationFinder()
-
-    total = 0
-    for i in range(nsamples):
-        x = min_longitude + (max_longitude - min_longitude) * random.random()
-        y = min_latitude + (max_latitude - min_latitude) * random.random()
-        c = cf.find(x, y)
-        w = math.cos(math.radians(y))
-        if c not in constellations:
-            constellations[c] = w
-        else:
-            constellations[c] += w
-        total += w
+    if width >= 360:
+        loops = []
+        ra = sample_range(min_ra, min_ra + 360, step)
+        if min_dec > -90:
+            loops.append((ra, numpy.full(len(ra), min_dec)))
+        if max_dec < 90:
+            loops.append((ra[::-1], numpy.full(len(ra), max_dec)))
+        return loops
+
+    max_ra = min_ra + width
+    bottom = sample_range(min_ra, max_ra, step)
+    right = sample_range(min_dec, max_dec, step)
+    top = sample_range(max_ra, min_ra, step)
+    left = sample_range(max_dec, min_dec, step)
+    ra = numpy.concatenate((bottom, numpy.full(len(right), max_ra), top, numpy.full(len(left), min_ra)))
+    dec = numpy.concatenate((numpy.full(len(bottom), min_dec), right, numpy.full(len(top), max_dec), left))
+    return [(ra, dec)]
+
+
+def constellation_areas(min_longitude, max_longitude, min_latitude, max_latitude, epoch=REFERENCE_EPOCH, zones=None):
+    """
+    Computes the overlap of a coordinate box with the constellations. The boundary of the box is precessed to the
+    epoch of the Delporte boundaries and intersected with the constellation zones.
+
+    :param min_longitude: The lower right ascension of the box, in degrees
+    :param max_longitude: The upper right ascension of the box, in degrees; equal to the lower for the full circle
+    :param min_latitude: The lower declination of the box, in degrees
+    :param max_latitude: The upper declination of the box, in degrees
+    :param epoch: The epoch of the coordinates
+    :param zones: The ConstellationZones instance to use; defaults to the zones from the database
+    :return: A list of (fraction, constellation) tuples, from large to small overlap
+    """
+
+    if zones is None:
+        zones = get_constellation_zones()
+
+    width = max_longitude - min_longitude
+    if width <= 0 or width > 360:
+        width = width % 360 or 360.0
+    min_latitude = max(min_latitude, -90.0)
+    max_latitude = min(max_latitude, 90.0)
 
-    res = sorted([(v/total, k) for k, v in constellations.items()], reverse=True)
-    return [x[1] for x in res]
+    pc = PrecessionCalculator(epoch, CONST_BOUND_EPOCH)
+    areas = numpy.zeros(len(zones.constellations))
+    for ra, dec in box_loops(min_longitude % 360, width, min_latitude, max_latitude):
+        areas += zones.loop_areas(*pc.precess_arrays(ra, dec))
+
+    # The loops give the area between the box and the south pole, so a box around the north pole covers the sphere
+    pole_ra, pole_dec = PrecessionCalculator(CONST_BOUND_EPOCH, epoch).precess(0.0, 90.0)
+    if min_latitude <= pole_dec <= max_latitude and (width >= 360 or (pole_ra - min_longitude) % 360 <= width):
+        areas += zones.sphere_areas()
+
+    # A constellation can consist of several zones
+    names, inverse = numpy.unique(zones.constellations, return_inverse=True)
+    areas = numpy.bincount(inverse, weights=areas, minlength=len(names))
+    total = areas.sum()
+    result = [(a / total, c) for a, c in zip(areas.tolist(), names.tolist()) if c and a > 1e-12 * total]
+    return sorted(result, reverse=True)
+
+
+def constellations_in_area(min_longitude, max_longitude, min_latitude, max_latitude, epoch=REFERENCE_EPOCH):
+    """
+    Generates a list of all constellations that overlap with the given area, from large to small overlap.
+    """
+
+    return [c for fraction, c in constellation_areas(min_longitude, max_longitude, min_latitude, max_latitude, epoch)]
 
 
 # Constellation boundaries
@@ -333,111 +574,369 @@ class BoundaryEdge(object):
         self.interpolated_points = precessed_points
 
 
+BOUNDARIES_FOLDER = os.path.join(DATA_FOLDER, "boundaries")
+
+
+class ConstellationBoundaries(object):
+    """
+    The interpolated points of all constellation boundary edges at one epoch, kept in flat arrays. The points of edge
+    i are at offsets[i]:offsets[i + 1].
+
+    The segments between consecutive points are indexed by their bounding boxes: sorted by their lowest declination,
+    so an area query only tests the segments that start below the top of the area.
+    """
+
+    def __init__(self, epoch, ra, dec, offsets):
+        self.epoch = epoch
+        self.ra = ra
+        self.dec = dec
+        self.offsets = offsets
+        self.index_segments()
+
+    def index_segments(self):
+        """Builds the bounding box of each segment, sorted by lowest declination"""
+        last = numpy.zeros(len(self.ra), dtype=bool)
+        last[self.offsets[1:] - 1] = True
+        start = numpy.flatnonzero(~last)
+
+        # Each segment spans the shortest right ascension interval between its points
+        ra1 = self.ra[start]
+        ra2 = self.ra[start + 1]
+        forward = (ra2 - ra1) % 360
+        backward = forward > 180
+        ra_low = numpy.where(backward, ra2, ra1) % 360
+        ra_width = numpy.where(backward, 360 - forward, forward)
+        dec_low = numpy.minimum(self.dec[start], self.dec[start + 1])
+        dec_high = numpy.maximum(self.dec[start], self.dec[start + 1])
+
+        order = numpy.argsort(dec_low, kind="mergesort")
+        self.segment_edges = (numpy.searchsorted(self.offsets, start, side="right") - 1)[order]
+        self.segment_ra_low = ra_low[order]
+        self.segment_ra_width = ra_width[order]
+        self.segment_dec_low = dec_low[order]
+        self.segment_dec_high = dec_high[order]
+
+    @classmethod
+    def from_database(cls, db):
+        """Interpolates the edges of the skymap_constellation_boundaries table, at epoch B1875"""
+        rows = db.query("""SELECT ra1, dec1, ra2, dec2 FROM skymap_constellation_boundaries ORDER BY pk""")
+        points = []
+        offsets = [0]
+        for row in rows:
+            e = BoundaryEdge(SphericalPoint(row['ra1'], row['dec1']), SphericalPoint(row['ra2'], row['dec2']))
+            points.extend((p.ra, p.dec) for p in e.interpolate_points())
+            offsets.append(len(points))
+        points = numpy.array(points, dtype=numpy.float64).reshape(-1, 2)
+        return cls(CONST_BOUND_EPOCH, points[:, 0], points[:, 1], numpy.array(offsets, dtype=numpy.int64))
+
+    @classmethod
+    def load(cls, path):
+        data = numpy.load(path)
+        epoch = datetime.datetime.strptime(str(data['epoch']), "%Y-%m-%d").date()
+        return cls(epoch, data['ra'], data['dec'], data['offsets'])
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # Write to a temporary file first, so an interrupted write does not leave a corrupt cache
+        tmp_path = path + ".tmp.npz"
+        numpy.savez(tmp_path, epoch=numpy.array(self.epoch.isoformat()), ra=self.ra, dec=self.dec, offsets=self.offsets)
+        os.rename(tmp_path, path)
+
+    def precessed(self, epoch):
+        """Returns the boundaries precessed to the given epoch, all points at once"""
+        ra, dec = PrecessionCalculator(self.epoch, epoch).precess_arrays(self.ra, self.dec)
+        return ConstellationBoundaries(epoch, ra, dec, self.offsets)
+
+    def edges_in_area(self, min_longitude, max_longitude, min_latitude, max_latitude):
+        """
+        Returns the edges with a segment whose bounding box intersects the given area, so edges crossing the area
+        without a point inside it are included.
+
+        :param min_longitude: The lowest right ascension, in degrees
+        :param max_longitude: The highest right ascension, in degrees; equal to min_longitude for all right ascensions
+        :param min_latitude: The lowest declination, in degrees
+        :param max_latitude: The highest declination, in degrees
+        :return: A sorted array of edge indices
+        """
+
+        n = numpy.searchsorted(self.segment_dec_low, max_latitude, side="right")
+        candidates = numpy.flatnonzero(self.segment_dec_high[:n] >= min_latitude)
+
+        min_longitude = ensure_angle_range(min_longitude)
+        max_longitude = ensure_angle_range(max_longitude)
+        if max_longitude != min_longitude:
+            width = (max_longitude - min_longitude) % 360
+            ra_low = self.segment_ra_low[candidates]
+            overlap = ((ra_low - min_longitude) % 360 <= width) | \
+                      ((min_longitude - ra_low) % 360 <= self.segment_ra_width[candidates])
+            candidates = candidates[overlap]
+
+        return numpy.unique(self.segment_edges[candidates])
+
+    def edge(self, i):
+        """Returns edge i as a BoundaryEdge, with its interpolated points"""
+        points = [SphericalPoint(ra, dec) for ra, dec in zip(
+            self.ra[self.offsets[i]:self.offsets[i + 1]].tolist(), self.dec[self.offsets[i]:self.offsets[i + 1]].tolist()
+        )]
+        e = BoundaryEdge(points[0], points[-1])
+        e.epoch = self.epoch
+        e.interpolated_points = points
+        return e
+
+
+def boundaries_path(epoch, folder=BOUNDARIES_FOLDER):
+    return os.path.join(folder, "boundaries_{}.npz".format(epoch.isoformat()))
+
+
+_constellation_boundaries = {}
+
+
+def get_constellation_boundaries(epoch=REFERENCE_EPOCH, folder=BOUNDARIES_FOLDER):
+    """
+    Returns the constellation boundaries precessed to the given epoch. The boundaries of each epoch are kept in memory
+    and written to the folder, so they are precessed only once.
+
+    :param epoch: The epoch
+    :param folder: The folder with the precessed boundaries
+    :return: A ConstellationBoundaries instance
+    """
+
+    if epoch not in _constellation_boundaries:
+        path = boundaries_path(epoch, folder)
+        if os.path.exists(path):
+            boundaries = ConstellationBoundaries.load(path)
+        else:
+            reference_path = boundaries_path(CONST_BOUND_EPOCH, folder)
+            if os.path.exists(reference_path):
+                boundaries = ConstellationBoundaries.load(reference_path)
+            else:
+                boundaries = ConstellationBoundaries.from_database(shared_database())
+                boundaries.save(reference_path)
+            if epoch != CONST_BOUND_EPOCH:
+                boundaries = boundaries.precessed(epoch)
+                boundaries.save(path)
+        _constellation_boundaries[epoch] = boundaries
+    return _constellation_boundaries[epoch]
+
+
+def clear_constellation_boundaries(folder=BOUNDARIES_FOLDER):
+    """Removes the precessed boundaries from memory and from the folder"""
+    _constellation_boundaries.clear()
+    if os.path.exists(folder):
+        for filename in os.listdir(folder):
+            if filename.startswith("boundaries_") and filename.endswith(".npz"):
+                os.remove(os.path.join(folder, filename))
+
+
 def get_constellation_boundaries_for_area(min_longitude, max_longitude, min_latitude, max_latitude, epoch=REFERENCE_EPOCH):
-    # Convert longitude to 0-360 values
-    # TODO: sometimes boundaries cross the map but have no vertices within the map area + margin and are not plotted
-    min_longitude = ensure_angle_range(min_longitude)
-    max_longitude = ensure_angle_range(max_longitude)
-    if max_longitude == min_longitude:
-        max_longitude += 360
+    """Returns the constellation boundary edges crossing the given area at the given epoch, as BoundaryEdges"""
+    boundaries = get_constellation_boundaries(epoch)
+    return [boundaries.edge(i) for i in boundaries.edges_in_area(min_longitude, max_longitude, min_latitude, max_latitude)]
 
-    db = SkyMapDatabase()
-    q = "SELECT * FROM skymap_constellation_boundaries WHERE"
 
-    if min_longitude < max_longitude:
-        q += " ((ra1>={0} AND ra1<={1}".format(min_longitude, max_longitude)
-    else:
-        q += " (((ra1>={0} OR ra1<={1})".format(min_longitude, max_longitude)
+POLYGONS_TABLE = "skymap_constellation_polygons"
 
-    q += " AND dec1>={0} AND dec1<={1}) OR".format(min_latitude, max_latitude)
 
-    if min_longitude < max_longitude:
-        q += " (ra2>={0} AND ra2<={1}".format(min_longitude, max_longitude)
-    else:
-        q += " ((ra2>={0} OR ra2<={1})".format(min_longitude, max_longitude)
+def point_key(p):
+    """Returns a hashable key for a point, equal for points that compare equal"""
+    return round(p.ra % 360.0, 8) % 360.0, round(p.dec, 8)
 
-    q += " AND dec2>={0} AND dec2<={1}))".format(min_latitude, max_latitude)
 
-    res = db.query(q)
+def edge_key(e):
+    """Returns a hashable key for an edge, equal for edges that compare equal regardless of their direction"""
+    return tuple(sorted((point_key(e.p1), point_key(e.p2))))
 
+
+def unique_edges(edges):
+    """Removes duplicate edges, keeping the first of each"""
+    seen = set()
     result = []
-    pc = PrecessionCalculator(CONST_BOUND_EPOCH, epoch)
-    for row in res:
-        p1 = SphericalPoint(row['ra1'], row['dec1'])
-        p2 = SphericalPoint(row['ra2'], row['dec2'])
-        e = BoundaryEdge(p1, p2)
-        e.precess(pc)
-        result.append(e)
-
-    db.close()
+    for e in edges:
+        k = edge_key(e)
+        if k not in seen:
+            seen.add(k)
+            result.append(e)
     return result
 
 
-def build_constellation_boundary_database():
+def connect_edges(edges):
+    """
+    Connects the edges that share an endpoint, by calling BoundaryEdge.connect on each pair in the order of the list.
+    As later connections replace earlier ones, the pairs are found with a map from endpoints to edges but connected
+    in the same order as when all pairs are tried.
+
+    :param edges: A list of unique edges
+    """
+
+    endpoints = {}
+    for i, e in enumerate(edges):
+        for k in set((point_key(e.p1), point_key(e.p2))):
+            endpoints.setdefault(k, []).append(i)
+
+    pairs = set()
+    for indices in endpoints.values():
+        for n, i in enumerate(indices):
+            for j in indices[n + 1:]:
+                pairs.add((i, j))
+
+    for i, j in sorted(pairs):
+        edges[i].connect(edges[j])
+
+
+def extend_edges(edges):
+    """
+    Returns the unique extended edges of a list of connected edges. The result is the same as that of
+    BoundaryEdge.extended_edge for each edge, but each part of a chain is walked only once.
+
+    :param edges: A list of connected edges
+    :return: A list of extended edges
+    """
+
+    index = dict((id(e), i) for i, e in enumerate(edges))
+    ends = {}
+
+    def walk(start, ep, ext):
+        # Follow the extensions from the edge ext, entered at point ep, to the end of the chain
+        path = []
+        while ext is not None:
+            state = (index[id(ext)], point_key(ep))
+            if state in ends:
+                ep = ends[state]
+                break
+            path.append(state)
+            if ext.p1 == ep:
+                ep = ext.p2
+                ext = ext.extension2
+            else:
+                ep = ext.p1
+                ext = ext.extension1
+            if (ext is not None) and (ext == start):
+                raise ValueError("Closed circular edge for {}".format(start))
+        for state in path:
+            ends[state] = ep
+        return ep
+
+    extended = []
+    for e in edges:
+        extended.append(BoundaryEdge(walk(e, e.p1, e.extension1), walk(e, e.p2, e.extension2)))
+    return unique_edges(extended)
+
+
+def boundary_polygons(rows):
+    """
+    Joins the boundary points of each constellation into closed polygons. Runs of adjacent points are joined where
+    the end of one run is the start of another.
+
+    :param rows: The records of the cst_bound_constbnd table, in table order
+    :return: A list of (constellation, points) tuples, with points a list of SphericalPoints of which the last equals
+             the first
+    """
+
+    runs = []
+    for row in rows:
+        point = SphericalPoint(15.0 * row['RAhr'], row['DEdeg'])
+        constellation = row['cst'].strip().lower()
+        if not row['adj'] or not runs or runs[-1][0] != constellation:
+            runs.append((constellation, [point]))
+        else:
+            runs[-1][1].append(point)
+
+    # Map the start of each run to the run
+    starts = {}
+    for i, (constellation, points) in enumerate(runs):
+        starts.setdefault((constellation, point_key(points[0])), []).append(i)
+
+    used = set()
+    polygons = []
+    for i, (constellation, points) in enumerate(runs):
+        if i in used:
+            continue
+        used.add(i)
+        polygon = list(points)
+        while point_key(polygon[-1]) != point_key(polygon[0]):
+            candidates = [j for j in starts.get((constellation, point_key(polygon[-1])), []) if j not in used]
+            if not candidates:
+                print "Open boundary for {}, closing it".format(constellation)
+                polygon.append(polygon[0])
+                break
+            used.add(candidates[0])
+            polygon.extend(runs[candidates[0]][1][1:])
+        polygons.append((constellation, polygon))
+    return polygons
+
+
+def build_constellation_boundary_database(db=None, folder=BOUNDARIES_FOLDER):
+    """
+    Builds the skymap_constellation_boundaries table with the extended boundary edges, and the
+    skymap_constellation_polygons table with the closed boundary of each constellation, at epoch B1875.
+
+    :param db: An open SkyMapDatabase instance
+    :param folder: The folder with the precessed boundaries, which are removed
+    """
+
     print
     print "Building constellation boundary database"
-    db = SkyMapDatabase()
+    close = db is None
+    if db is None:
+        db = SkyMapDatabase()
     db.drop_table("skymap_constellation_boundaries")
     db.create_table("skymap_constellation_boundaries", ["ra1", "dec1", "ra2", "dec2"], [float, float, float, float])
 
-    edges = []
-    rows = db.query("""SELECT * FROM cst_bound_constbnd""")
+    rows = db.query("""SELECT * FROM cst_bound_constbnd ORDER BY pk""")
 
     print "Creating raw edges"
+    t1 = time.time()
+    edges = []
     prev_point = None
-    nrecords = len(rows)
-    next_id = 1
-    for i, row in enumerate(rows):
-        sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / (nrecords - 1)))
-        sys.stdout.flush()
-
+    for row in rows:
         if not row['adj']:
             prev_point = None
 
-        ra = 15.0 * row['RAhr']
-        dec = row['DEdeg']
-        point = SphericalPoint(ra, dec)
-
+        point = SphericalPoint(15.0 * row['RAhr'], row['DEdeg'])
         if prev_point is not None:
-            e = BoundaryEdge(prev_point, point)
-            if e not in edges:
-                edges.append(e)
-                next_id += 1
-
+            edges.append(BoundaryEdge(prev_point, point))
         prev_point = point
+    edges = unique_edges(edges)
+    t2 = time.time()
+    print "{} edges, {:.1f} s".format(len(edges), t2 - t1)
 
-    print
     print "Connecting edges"
-    n = 0
-    nrecords = len(edges) * (len(edges)-1) / 2
-    for i, e1 in enumerate(edges):
-        for e2 in edges[i+1:]:
-            sys.stdout.write("\r{0:.1f}%".format(n * 100.0 / (nrecords - 1)))
-            sys.stdout.flush()
-            n += 1
-            if e1 == e2:
-                continue
-
-            e1.connect(e2)
+    connect_edges(edges)
+    t3 = time.time()
+    print "{:.1f} s".format(t3 - t2)
 
-    print
     print "Building extended edges"
-    new_edges = []
-    nrecords = len(edges)
-    for i, e in enumerate(edges):
-        sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / (nrecords - 1)))
-        sys.stdout.flush()
-        new_edge = e.extended_edge
-        if new_edge not in new_edges:
-            new_edges.append(new_edge)
-    print
+    new_edges = extend_edges(edges)
+    t4 = time.time()
+    print "{:.1f} s".format(t4 - t3)
+
     nrecords = len(new_edges)
     print "Loading {} edges to database".format(nrecords)
-
-    for i, e in enumerate(new_edges):
-        sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / (nrecords - 1)))
-        sys.stdout.flush()
-        db.insert_row("skymap_constellation_boundaries", ["ra1", "dec1", "ra2", "dec2"], [e.p1.ra, e.p1.dec, e.p2.ra, e.p2.dec])
+    db.bulk_load(
+        "skymap_constellation_boundaries",
+        ["ra1", "dec1", "ra2", "dec2"],
+        [(e.p1.ra, e.p1.dec, e.p2.ra, e.p2.dec) for e in new_edges]
+    )
+
+    print "Building constellation polygons"
+    polygons = boundary_polygons(rows)
+    db.drop_table(POLYGONS_TABLE)
+    db.create_table(POLYGONS_TABLE, ["constellation", "polygon", "point", "ra", "dec"], [str, int, int, float, float])
+    db.bulk_load(
+        POLYGONS_TABLE,
+        ["constellation", "polygon", "point", "ra", "dec"],
+        [(c, i, j, p.ra, p.dec) for i, (c, points) in enumerate(polygons) for j, p in enumerate(points)]
+    )
+    db.add_index(POLYGONS_TABLE, "constellation")
+    print "{} polygons, {:.1f} s".format(len(polygons), time.time() - t4)
+
+    # The precessed boundaries were built from the old table
+    clear_constellation_boundaries(folder)
+
+    if close:
+        db.close()
 
 
 if __name__ == "__main__":
@@ -153,3 +153,25 @@ class PrecessionCalculator(object):
         dec2 = math.asin(v2[2])
 
         return math.degrees(ra2), math.degrees(dec2)
+
+    def precess_arrays(self, ra, dec):
+        """
+        Precesses arrays of coordinates from epoch1 to epoch2.
+
+        :param ra: Array of right ascensions, in degrees
+        :param dec: Array of declinations, in degrees
+        :return: A tuple (ra, dec) of arrays, in degrees
+        """
+
+        ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+        dec = numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+        cd = numpy.cos(dec)
+        v1 = numpy.vstack((numpy.cos(ra) * cd, numpy.sin(ra) * cd, numpy.sin(dec)))
+
+        v2 = numpy.dot(self._matrix, v1)
+
+        ra2 = numpy.arctan2(v2[1], v2[0])
+        ra2 = numpy.where(ra2 < 0, ra2 + 2 * math.pi, ra2)
+        dec2 = numpy.arcsin(numpy.clip(v2[2], -1.0, 1.0))
+
+        return numpy.degrees(ra2), numpy.degrees(dec2)
@@ -0,0 +1,368 @@
+"""
+In-memory merge of Tycho-2, Tycho-1 and Hipparcos into the skymap_stars table.
+
+The source tables are read into NumPy arrays once, joined on integer TYC1-TYC2-TYC3 and HIP keys, and the merged rows are
+bulk loaded. The merge gives the same rows as the INSERT ... SELECT statements of add_tycho2, add_tycho1 and
+add_hipparcos in skymap.stars, including their NULL semantics: a NOT IN over a subquery that returns a NULL key
+excludes every row, and string comparisons ignore case and trailing spaces, as in the default MySQL collations.
+"""
+
+import time
+import numpy
+
+
+# Integer columns are read with NULL replaced by this value, which is not a valid identifier or flag
+NULL_INT = -1
+
+SKYMAP_STARS_COLUMNS = [
+    "hip", "tyc1", "tyc2", "tyc3", "ccdm", "ccdm_comp", "hd1", "hd2", "bd", "cod", "cpd",
+    "right_ascension", "declination", "proper_motion_ra", "proper_motion_dec",
+    "johnsonV", "johnsonBV", "hp_magnitude", "vt_magnitude", "bt_magnitude",
+    "hp_max", "hp_min", "vt_max", "vt_min", "variable", "multiple", "source"
+]
+
+
+def read_table(db, table, columns):
+    """
+    Reads columns of a table into a structured array, in the order of the primary key.
+
+    :param db: An open SkyMapDatabase instance
+    :param table: The table
+    :param columns: List of (column, name, dtype) tuples. NULL integers are read as NULL_INT, NULL floats as NaN.
+    :return: The structured array
+    """
+
+    select = []
+    for column, name, dtype in columns:
+        if numpy.dtype(dtype).kind == "i":
+            select.append("""COALESCE(`{}`, {})""".format(column, NULL_INT))
+        else:
+            select.append("""`{}`""".format(column))
+    q = """SELECT {} FROM {} ORDER BY pk""".format(", ".join(select), table)
+    dtype = [(name, dtype) for column, name, dtype in columns]
+    return numpy.concatenate(list(db.query_iter(q, row_format="array", dtype=dtype)) or [numpy.zeros(0, dtype=dtype)])
+
+
+def tyc_keys(a):
+    """
+    Combines the TYC1, TYC2 and TYC3 fields of a structured array into a single integer key.
+
+    :param a: The structured array
+    :return: An array with the keys, NULL_INT where any of the fields is NULL
+    """
+
+    keys = (a['tyc1'].astype(numpy.int64) * 100000 + a['tyc2']) * 10 + a['tyc3']
+    null = (a['tyc1'] == NULL_INT) | (a['tyc2'] == NULL_INT) | (a['tyc3'] == NULL_INT)
+    return numpy.where(null, NULL_INT, keys)
+
+
+def not_in(keys, other):
+    """
+    Evaluates the SQL condition "keys NOT IN (other)", with NULL_INT for NULL keys.
+
+    :param keys: Array of keys
+    :param other: Array of keys of the subquery
+    :return: Boolean array, True where the condition is true
+    """
+
+    if (other == NULL_INT).any():
+        # A NULL in the subquery makes NOT IN either false or NULL
+        return numpy.zeros(len(keys), dtype=bool)
+    return (keys != NULL_INT) & ~numpy.in1d(keys, other)
+
+
+def normalize(s):
+    """Prepares strings for comparison: case insensitive and ignoring trailing spaces"""
+    return numpy.char.upper(numpy.char.rstrip(s, " "))
+
+
+def lookup(keys, values, wanted):
+    """
+    Looks up values by key.
+
+    :param keys: Sorted array of unique keys
+    :param values: Array with the value of each key
+    :param wanted: Array of keys to look up
+    :return: Array with the value of each wanted key, NULL_INT where the key is not found
+    """
+
+    result = numpy.full(len(wanted), NULL_INT, dtype=numpy.int64)
+    if not len(keys):
+        return result
+    positions = numpy.minimum(numpy.searchsorted(keys, wanted), len(keys) - 1)
+    found = keys[positions] == wanted
+    result[found] = values[positions[found]]
+    return result
+
+
+def sql_equal(a, b):
+    """Compares two strings like MySQL does, or returns None if either is NULL"""
+    if a is None or b is None:
+        return None
+    return a.rstrip(" ").upper() == b.rstrip(" ").upper()
+
+
+def value(v):
+    """Converts an array value to a database value, with NULL_INT and NaN becoming None"""
+    if isinstance(v, float):
+        return None if v != v else v
+    if isinstance(v, (int, long)):
+        return None if v == NULL_INT else v
+    return v
+
+
+def star_rows(columns, source, chunk_size=10000):
+    """
+    Generates skymap_stars rows from column arrays, converting a chunk of each column to database values at a time.
+
+    :param columns: Dictionary from skymap_stars column to an array with one value per star; the other columns are NULL
+    :param source: The value of the source column
+    :param chunk_size: The number of rows converted at a time
+    :return: A generator of tuples with values in the order of SKYMAP_STARS_COLUMNS
+    """
+
+    n = len(next(iter(columns.values())))
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        values = []
+        for c in SKYMAP_STARS_COLUMNS:
+            if c == "source":
+                values.append([source] * size)
+            elif c in columns:
+                values.append([value(v) for v in columns[c][start:start + size].tolist()])
+            else:
+                values.append([None] * size)
+        for row in zip(*values):
+            yield row
+
+
+def take(a, indices, fill):
+    """Returns the elements of a at the indices, with fill where the index is -1"""
+    if not len(a):
+        return numpy.full(len(indices), fill, dtype=object if a.dtype.kind == "S" else a.dtype)
+    result = a[numpy.maximum(indices, 0)]
+    if a.dtype.kind == "S":
+        result = result.astype(object)
+    result[indices < 0] = fill
+    return result
+
+
+def coalesce(a, b):
+    """Returns a, with b where a is NaN"""
+    return numpy.where(numpy.isnan(a), b, a)
+
+
+def merge_tycho2(db):
+    """
+    Generates the skymap_stars rows of add_tycho2: the Tycho-2 stars that are not in Hipparcos or Tycho-1, with the HD
+    numbers from Tyc2_HD.
+    """
+
+    t2 = read_table(db, "tyc2_tyc2", [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64),
+        ("HIP", "hip", numpy.int64), ("TYC", "tyc", "S8"),
+        ("RAmdeg", "ramdeg", numpy.float64), ("DEmdeg", "demdeg", numpy.float64),
+        ("RAdeg", "radeg", numpy.float64), ("DEdeg", "dedeg", numpy.float64),
+        ("pmRA", "pmra", numpy.float64), ("pmDE", "pmde", numpy.float64),
+        ("BTmag", "btmag", numpy.float64), ("VTmag", "vtmag", numpy.float64)
+    ])
+    hd = read_table(db, "tyc2hd_tyc2_hd", [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64),
+        ("HD", "hd", numpy.int64), ("Rem", "rem", "S8")
+    ])
+    t1 = read_table(db, "hiptyc_tyc_main", [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64)
+    ])
+
+    # HD1 is the lowest HD number of each Tycho-2 star, HD2 the highest if there is more than one
+    hd_keys = tyc_keys(hd)
+    valid = (normalize(hd['rem']) != "D") & (hd_keys != NULL_INT) & (hd['hd'] != NULL_INT)
+    hd_keys = hd_keys[valid]
+    hd_numbers = hd['hd'][valid]
+    order = numpy.lexsort((hd_numbers, hd_keys))
+    hd_keys = hd_keys[order]
+    hd_numbers = hd_numbers[order]
+    unique_keys, first, counts = numpy.unique(hd_keys, return_index=True, return_counts=True)
+    hd1 = hd_numbers[first]
+    hd2 = numpy.where(counts > 1, hd_numbers[first + counts - 1], NULL_INT)
+
+    keys = tyc_keys(t2)
+    selected = (t2['hip'] == NULL_INT) & (normalize(t2['tyc']) != "T") & not_in(keys, tyc_keys(t1))
+    t2 = t2[selected]
+    keys = keys[selected]
+
+    star_hd1 = lookup(unique_keys, hd1, keys)
+    star_hd2 = lookup(unique_keys, hd2, keys)
+
+    ra = numpy.where(numpy.isnan(t2['ramdeg']), t2['radeg'], t2['ramdeg'])
+    dec = numpy.where(numpy.isnan(t2['demdeg']), t2['dedeg'], t2['demdeg'])
+    johnson_v = t2['vtmag'] - 0.090 * (t2['btmag'] - t2['vtmag'])
+    johnson_bv = 0.085 * (t2['btmag'] - t2['vtmag'])
+
+    return star_rows({
+        'tyc1': t2['tyc1'], 'tyc2': t2['tyc2'], 'tyc3': t2['tyc3'], 'hd1': star_hd1, 'hd2': star_hd2,
+        'right_ascension': ra, 'declination': dec, 'proper_motion_ra': t2['pmra'], 'proper_motion_dec': t2['pmde'],
+        'bt_magnitude': t2['btmag'], 'vt_magnitude': t2['vtmag'], 'johnsonV': johnson_v, 'johnsonBV': johnson_bv
+    }, "T2")
+
+
+def merge_tycho1(db):
+    """
+    Generates the skymap_stars rows of add_tycho1: the Tycho-1 stars that are not in Hipparcos or Tycho-2 supplement
+    2, with a quality flag other than 9.
+    """
+
+    t1 = read_table(db, "hiptyc_tyc_main", [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64),
+        ("RAdeg", "radeg", numpy.float64), ("DEdeg", "dedeg", numpy.float64),
+        ("pmRA", "pmra", numpy.float64), ("pmDE", "pmde", numpy.float64),
+        ("Vmag", "vmag", numpy.float64), ("B-V", "bv", numpy.float64),
+        ("BTmag", "btmag", numpy.float64), ("VTmag", "vtmag", numpy.float64),
+        ("VTmax", "vtmax", numpy.float64), ("VTmin", "vtmin", numpy.float64),
+        ("HD", "hd", numpy.int64), ("BD", "bd", "S32"), ("CoD", "cod", "S32"), ("CPD", "cpd", "S32"),
+        ("MultFlag", "multflag", "S8"), ("VarFlag", "varflag", "S8"),
+        ("HIP", "hip", numpy.int64), ("Q", "q", numpy.int64)
+    ])
+    suppl2 = read_table(db, "tyc2_suppl_2", [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64)
+    ])
+
+    selected = not_in(tyc_keys(t1), tyc_keys(suppl2)) & (t1['hip'] == NULL_INT) & (t1['q'] != NULL_INT) & (t1['q'] != 9)
+    t1 = t1[selected]
+    multiple = normalize(t1['multflag']) == "D"
+    variable = normalize(t1['varflag']) == "V"
+
+    return star_rows({
+        'tyc1': t1['tyc1'], 'tyc2': t1['tyc2'], 'tyc3': t1['tyc3'],
+        'right_ascension': t1['radeg'], 'declination': t1['dedeg'],
+        'proper_motion_ra': t1['pmra'], 'proper_motion_dec': t1['pmde'],
+        'johnsonV': t1['vmag'], 'johnsonBV': t1['bv'], 'bt_magnitude': t1['btmag'], 'vt_magnitude': t1['vtmag'],
+        'vt_max': t1['vtmax'], 'vt_min': t1['vtmin'],
+        'hd1': t1['hd'], 'bd': t1['bd'], 'cod': t1['cod'], 'cpd': t1['cpd'],
+        'multiple': multiple.astype(numpy.int64), 'variable': variable.astype(numpy.int64)
+    }, "T1")
+
+
+def component_match(comp_id, ccdm):
+    """
+    Evaluates the join condition of a Hipparcos component with a Tycho-2 record in add_hipparcos:
+    the component equals the CCDM components of the Tycho-2 record, or is one of its three component letters.
+
+    :param comp_id: The component identifier of the Hipparcos double and multiple systems annex, or None
+    :param ccdm: The CCDM components of the Tycho-2 record
+    :return: True if the records match
+    """
+
+    if sql_equal(comp_id if comp_id is not None else "", ccdm.strip(" ")):
+        return True
+    if comp_id is None:
+        return False
+    return any(sql_equal(comp_id.strip(" "), ccdm[k:k + 1]) for k in range(3))
+
+
+def group_rows(keys):
+    """
+    Groups row indices by key, keeping the original order within each group.
+
+    :param keys: Array of keys
+    :return: Dictionary from key to list of row indices
+    """
+
+    groups = {}
+    for i, k in enumerate(keys.tolist()):
+        if k != NULL_INT:
+            groups.setdefault(k, []).append(i)
+    return groups
+
+
+def merge_hipparcos(db):
+    """
+    Generates the skymap_stars rows of add_hipparcos: all Hipparcos stars with a position, with one row per component
+    from the double and multiple systems annex, and the TYC identifier of the matching Tycho-2 record.
+    """
+
+    h = read_table(db, "hiptyc_hip_main", [
+        ("HIP", "hip", numpy.int64), ("RAdeg", "radeg", numpy.float64), ("DEdeg", "dedeg", numpy.float64),
+        ("pmRA", "pmra", numpy.float64), ("pmDE", "pmde", numpy.float64),
+        ("Vmag", "vmag", numpy.float64), ("B-V", "bv", numpy.float64),
+        ("BTmag", "btmag", numpy.float64), ("VTmag", "vtmag", numpy.float64),
+        ("Hpmag", "hpmag", numpy.float64), ("Hpmax", "hpmax", numpy.float64), ("Hpmin", "hpmin", numpy.float64),
+        ("HVarType", "hvartype", "S8"),
+        ("HD", "hd", numpy.int64), ("BD", "bd", "S32"), ("CoD", "cod", "S32"), ("CPD", "cpd", "S32")
+    ])
+    d = read_table(db, "hiptyc_h_dm_com", [
+        ("HIP", "hip", numpy.int64), ("CCDM", "ccdm", "S32"), ("comp_id", "comp_id", "S8"),
+        ("RAdeg", "radeg", numpy.float64), ("DEdeg", "dedeg", numpy.float64),
+        ("pmRA", "pmra", numpy.float64), ("pmDE", "pmde", numpy.float64),
+        ("BT", "bt", numpy.float64), ("VT", "vt", numpy.float64), ("Hp", "hp", numpy.float64)
+    ])
+    tyc_columns = [
+        ("TYC1", "tyc1", numpy.int64), ("TYC2", "tyc2", numpy.int64), ("TYC3", "tyc3", numpy.int64),
+        ("HIP", "hip", numpy.int64), ("CCDM", "ccdm", "S8")
+    ]
+    t = numpy.concatenate([read_table(db, "tyc2_tyc2", tyc_columns), read_table(db, "tyc2_suppl_1", tyc_columns)])
+
+    components = group_rows(d['hip'])
+    tycho = group_rows(t['hip'])
+    comp_ids = d['comp_id'].tolist()
+    ccdms = t['ccdm'].tolist()
+
+    # The joined rows, as indices into h, d and t, with -1 for no match
+    hi = []
+    di = []
+    ti = []
+    for i, hip in enumerate(h['hip'].tolist()):
+        for j in components.get(hip, [-1]):
+            comp_id = comp_ids[j] if j >= 0 else None
+            matches = [k for k in tycho.get(hip, []) if component_match(comp_id, ccdms[k])]
+            for k in matches or [-1]:
+                hi.append(i)
+                di.append(j)
+                ti.append(k)
+    hi = numpy.array(hi, dtype=numpy.int64)
+    di = numpy.array(di, dtype=numpy.int64)
+    ti = numpy.array(ti, dtype=numpy.int64)
+
+    # Stars without a position are left out
+    positioned = ~numpy.isnan(h['radeg'][hi]) if len(hi) else numpy.zeros(0, dtype=bool)
+    hi = hi[positioned]
+    di = di[positioned]
+    ti = ti[positioned]
+    hr = h[hi]
+
+    hvartype = normalize(hr['hvartype'])
+    variable = (hvartype == "P") | ((hvartype == "U") & (hr['hpmin'] - hr['hpmax'] > 0.2))
+
+    return star_rows({
+        'hip': hr['hip'], 'tyc1': take(t['tyc1'], ti, NULL_INT), 'tyc2': take(t['tyc2'], ti, NULL_INT),
+        'tyc3': take(t['tyc3'], ti, NULL_INT), 'ccdm': take(d['ccdm'], di, None), 'ccdm_comp': take(d['comp_id'], di, None),
+        'right_ascension': coalesce(take(d['radeg'], di, numpy.nan), hr['radeg']),
+        'declination': coalesce(take(d['dedeg'], di, numpy.nan), hr['dedeg']),
+        'proper_motion_ra': coalesce(take(d['pmra'], di, numpy.nan), hr['pmra']),
+        'proper_motion_dec': coalesce(take(d['pmde'], di, numpy.nan), hr['pmde']),
+        'johnsonV': hr['vmag'], 'johnsonBV': hr['bv'],
+        'bt_magnitude': coalesce(take(d['bt'], di, numpy.nan), hr['btmag']),
+        'vt_magnitude': coalesce(take(d['vt'], di, numpy.nan), hr['vtmag']),
+        'hp_magnitude': coalesce(take(d['hp'], di, numpy.nan), hr['hpmag']),
+        'hp_max': hr['hpmax'], 'hp_min': hr['hpmin'], 'variable': variable.astype(numpy.int64),
+        'hd1': hr['hd'], 'bd': hr['bd'], 'cod': hr['cod'], 'cpd': hr['cpd']
+    }, "H")
+
+
+def merge_catalogues_in_memory(db):
+    """
+    Fills the skymap_stars table with Tycho-2, Tycho-1 and Hipparcos, in that order. The table must exist and be empty.
+
+    :param db: An open SkyMapDatabase instance
+    :return: The number of stars
+    """
+
+    n = 0
+    for name, function in (("Tycho-2", merge_tycho2), ("Tycho-1", merge_tycho1), ("Hipparcos", merge_hipparcos)):
+        print "Merging {} data".format(name)
+        t1 = time.time()
+        nstars = db.bulk_load("skymap_stars", SKYMAP_STARS_COLUMNS, function(db))
+        n += nstars
+        t2 = time.time()
+        print "{} stars, {:.1f} s".format(nstars, t2 - t1)
+    return n
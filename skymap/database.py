@@ -1,20 +1,35 @@
 import os
+import math
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+import numpy
 import mysql.connector
 
 
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "data")
 DATABASE_FILE = os.path.join(DATA_FOLDER, "skymap.db")
+DATABASE_BACKEND = os.environ.get("SKYMAP_DATABASE", "mysql")
 DATATYPES = {int: "INT", str: "VARCHAR(512)", float: "DOUBLE"}
+SQLITE_DATATYPES = {int: "INTEGER", str: "TEXT", float: "REAL"}
+MYSQL_CONNECTION = {"user": "skymap", "host": "127.0.0.1", "database": "skymap", "allow_local_infile": True}
 
 
 class SkyMapDatabase(object):
+    """
+    Database connection to the MySQL skymap database.
+    """
+
+    placeholder = "%s"
+
     def __init__(self):
         self.conn = None
         self.cursor = None
+        self.in_transaction = False
         self.connect()
 
     def connect(self):
-        self.conn = mysql.connector.connect(user='skymap', host='127.0.0.1', database='skymap')
+        self.conn = mysql.connector.connect(**MYSQL_CONNECTION)
         self.cursor = self.conn.cursor()
 
     def close(self):
@@ -60,23 +75,46 @@ class SkyMapDatabase(object):
             q += """`{}`, """.format(c)
         q = q[:-2] + """) VALUES ("""
         for v in values:
-            q += """%s, """
+            q += """{}, """.format(self.placeholder)
         q = q[:-2] + """)"""
         self.commit_query(q, values)
 
     def insert_rows(self, table, columns, values_batch):
-        q = """INSERT INTO {} (""".format(table)
-        for c in columns:
-            q += """`{}`, """.format(c)
-        q = q[:-2] + """) VALUES """
         params = []
+        value_lists = []
         for values in values_batch:
-            q += """(""" + """%s, """ * len(values)
-            q = q[:-2] + """), """
+            value_lists.append("""(""" + """, """.join([self.placeholder] * len(values)) + """)""")
             params.extend(values)
-        q = q[:-2]
+        q = """INSERT INTO {} (`{}`) VALUES {}""".format(table, "`, `".join(columns), """, """.join(value_lists))
         self.commit_query(q, params)
 
+    def bulk_load(self, table, columns, rows):
+        """
+        Loads many rows into a table at once. The rows are streamed to a temporary tab-separated file, which is then
+        loaded with LOAD DATA LOCAL INFILE.
+
+        :param table: The table to load the rows into
+        :param columns: The columns to fill
+        :param rows: An iterable of rows, with values in the order of columns
+        :return: The number of rows loaded
+        """
+
+        fd, path = tempfile.mkstemp(suffix=".tsv")
+        try:
+            n = 0
+            with os.fdopen(fd, "wb") as fp:
+                for row in rows:
+                    fp.write("\t".join(tsv_field(v) for v in row) + "\n")
+                    n += 1
+            if n:
+                q = """LOAD DATA LOCAL INFILE '{}' INTO TABLE `{}` """.format(path.replace("\\", "\\\\"), table)
+                q += """FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' """
+                q += """(`{}`)""".format("`, `".join(columns))
+                self.commit_query(q)
+        finally:
+            os.remove(path)
+        return n
+
     def query(self, q, params=(), fetch=True):
         self.cursor.execute(q, params)
         if fetch:
@@ -91,10 +129,364 @@ class SkyMapDatabase(object):
         except IndexError:
             return None
 
+    def query_iter(self, q, params=(), batch_size=10000, row_format="dict", dtype=None):
+        """
+        Executes the query and yields the result in batches, without holding the full result in memory.
+
+        :param q: The query
+        :param params: The query parameters
+        :param batch_size: The number of rows in each batch
+        :param row_format: "dict" for lists of dictionaries, "tuple" for lists of tuples or "array" for NumPy structured
+                           arrays
+        :param dtype: The NumPy dtype of the structured arrays, one field per selected column
+        :return: A generator of batches
+        """
+
+        if row_format == "array" and dtype is None:
+            raise ValueError("A dtype is required for row format 'array'")
+
+        conn, cursor = self.streaming_cursor()
+        try:
+            cursor.execute(q, params)
+            columns = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if row_format == "dict":
+                    yield [dict(zip(columns, row)) for row in rows]
+                elif row_format == "tuple":
+                    yield [tuple(row) for row in rows]
+                elif row_format == "array":
+                    yield rows_to_array(rows, dtype)
+                else:
+                    raise ValueError("Unknown row format {}".format(row_format))
+        finally:
+            cursor.close()
+            if conn is not self.conn:
+                conn.close()
+
+    def streaming_cursor(self):
+        """
+        Returns a connection and an unbuffered cursor for streaming a query result from the server. The rows of an
+        unbuffered cursor must be read before the connection can execute another query, so a separate connection
+        is used to keep this one available while streaming.
+        """
+
+        conn = mysql.connector.connect(**MYSQL_CONNECTION)
+        return conn, conn.cursor(buffered=False)
+
     def commit_query(self, q, params=()):
         self.cursor.execute(q, params)
+        if not self.in_transaction:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager that groups all queries executed within it in a single transaction. The transaction is
+        committed at the end of the block, or rolled back if an exception occurs. Nested blocks join the outer
+        transaction.
+        """
+
+        if self.in_transaction:
+            yield self
+            return
+
+        self.begin()
+        self.in_transaction = True
+        try:
+            yield self
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        finally:
+            self.in_transaction = False
+
+    def begin(self):
+        # Autocommit is disabled for MySQL connections: a transaction is started implicitly
+        pass
+
+    def commit(self):
         self.conn.commit()
 
+    def rollback(self):
+        self.conn.rollback()
+
+    def bulk_update(self, table, key, columns, rows, batch_size=10000):
+        """
+        Updates many records at once. The new values are loaded into a temporary staging table in multi-row batches,
+        after which the target table is updated with a single joined UPDATE, all within one transaction.
+
+        :param table: The table to update
+        :param key: The column identifying the records to update, e.g. the primary key
+        :param columns: The columns to update
+        :param rows: An iterable of rows (key, value1, value2, ...), with values in the order of columns
+        :param batch_size: The number of rows inserted into the staging table per query
+        """
+
+        staging = "{}_staging".format(table)
+        staging_columns = [key] + list(columns)
+
+        with self.transaction():
+            self.drop_staging_table(staging)
+            self.create_staging_table(staging, table, key, staging_columns)
+
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    self.insert_rows(staging, staging_columns, batch)
+                    batch = []
+            if batch:
+                self.insert_rows(staging, staging_columns, batch)
+
+            self.commit_query(self.joined_update_query(table, staging, key, columns))
+            self.drop_staging_table(staging)
+
+    def create_staging_table(self, staging, table, key, columns):
+        # The key is declared in the CREATE statement: ALTER TABLE commits the transaction implicitly, even for a
+        # temporary table
+        self.commit_query("""CREATE TEMPORARY TABLE `{}` (PRIMARY KEY (`{}`)) SELECT {} FROM `{}` LIMIT 0""".format(
+            staging, key, "`" + "`, `".join(columns) + "`", table
+        ))
+
+    def drop_staging_table(self, staging):
+        self.commit_query("""DROP TEMPORARY TABLE IF EXISTS `{}`""".format(staging))
+
+    def joined_update_query(self, table, staging, key, columns):
+        q = """UPDATE `{0}` JOIN `{1}` ON `{0}`.`{2}`=`{1}`.`{2}` SET """.format(table, staging, key)
+        q += """, """.join("""`{0}`.`{2}`=`{1}`.`{2}`""".format(table, staging, c) for c in columns)
+        return q
+
+
+class SQLiteDatabase(SkyMapDatabase):
+    """
+    Database connection to an embedded SQLite catalogue file.
+
+    Writable connections switch the file to WAL mode, so that any number of read-only connections, in this and other
+    processes, can keep reading while the catalogue is being written. Read-only connections may be shared between
+    threads.
+    """
+
+    placeholder = "?"
+
+    def __init__(self, path=DATABASE_FILE, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        SkyMapDatabase.__init__(self)
+
+    def connect(self):
+        if self.read_only:
+            if not os.path.exists(self.path):
+                raise IOError("Database file {} does not exist".format(self.path))
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA query_only=ON")
+        else:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            # Transactions are managed explicitly, see begin()
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.cursor = self.conn.cursor()
+
+    def create_table(self, tablename, columns, datatypes, create_primary_key=True):
+        datatypes = [SQLITE_DATATYPES[x] for x in datatypes]
+        q = """CREATE TABLE {} (""".format(tablename)
+        if create_primary_key:
+            q += """pk INTEGER PRIMARY KEY AUTOINCREMENT, """
+
+        for c, t in zip(columns, datatypes):
+            q += """`{}` {}, """.format(c, t)
+        q = q[:-2] + """)"""
+        self.commit_query(q)
+
+    def add_index(self, table, column, name=None, unique=False):
+        if name is None:
+            name = column
+        self.add_multiple_column_index(table, (column,), name, unique)
+
+    def add_multiple_column_index(self, table, columns, name, unique=False):
+        # Index names are global in SQLite, so they are prefixed with the table name
+        q = """CREATE """
+        if unique:
+            q += """UNIQUE """
+        q += """INDEX `{0}_{1}` ON `{0}` ({2})""".format(table, name, "`" + "`, `".join(columns) + "`")
+        self.commit_query(q)
+
+    def drop_table(self, table):
+        self.commit_query("""DROP TABLE IF EXISTS {0}""".format(table))
+
+    def bulk_load(self, table, columns, rows, batch_size=10000):
+        """
+        Loads many rows into a table at once, using executemany in a single transaction.
+
+        :param table: The table to load the rows into
+        :param columns: The columns to fill
+        :param rows: An iterable of rows, with values in the order of columns
+        :param batch_size: The number of rows passed to each executemany call
+        :return: The number of rows loaded
+        """
+
+        q = """INSERT INTO `{}` (`{}`) VALUES ({})""".format(table, "`, `".join(columns), ", ".join([self.placeholder] * len(columns)))
+        n = 0
+        with self.transaction():
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    self.cursor.executemany(q, batch)
+                    n += len(batch)
+                    batch = []
+            if batch:
+                self.cursor.executemany(q, batch)
+                n += len(batch)
+        return n
+
+    def begin(self):
+        self.cursor.execute("BEGIN")
+
+    def commit(self):
+        self.cursor.execute("COMMIT")
+
+    def rollback(self):
+        self.cursor.execute("ROLLBACK")
+
+    def create_staging_table(self, staging, table, key, columns):
+        self.commit_query("""CREATE TEMPORARY TABLE `{}` AS SELECT {} FROM `{}` LIMIT 0""".format(staging, "`" + "`, `".join(columns) + "`", table))
+        self.commit_query("""CREATE UNIQUE INDEX temp.`{0}_{1}` ON `{0}` (`{1}`)""".format(staging, key))
+
+    def drop_staging_table(self, staging):
+        self.commit_query("""DROP TABLE IF EXISTS temp.`{}`""".format(staging))
+
+    def joined_update_query(self, table, staging, key, columns):
+        # Correlated subqueries instead of UPDATE ... FROM, which older SQLite versions do not support
+        q = """UPDATE `{}` SET """.format(table)
+        q += """, """.join(
+            """`{0}`=(SELECT `{0}` FROM `{1}` WHERE `{1}`.`{2}`=`{3}`.`{2}`)""".format(c, staging, key, table) for c in columns
+        )
+        q += """ WHERE `{0}` IN (SELECT `{0}` FROM `{1}`)""".format(key, staging)
+        return q
+
+    def streaming_cursor(self):
+        # SQLite steps through the result as rows are fetched, and allows other statements in between
+        return self.conn, self.conn.cursor()
+
+
+def tsv_field(v):
+    """
+    Formats a value for a tab-separated file loaded with LOAD DATA INFILE.
+
+    :param v: The value
+    :return: The formatted field
+    """
+
+    if v is None:
+        return "\\N"
+    if isinstance(v, bool):
+        return "1" if v else "0"
+    if isinstance(v, float):
+        if math.isnan(v):
+            return "\\N"
+        return repr(v)
+    if isinstance(v, unicode):
+        v = v.encode("utf-8")
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def rows_to_array(rows, dtype):
+    """
+    Converts a list of database rows to a NumPy structured array. NULL values become NaN in floating point fields,
+    empty strings in string fields and 0 in all other fields.
+
+    :param rows: A list of tuples
+    :param dtype: The dtype of the structured array
+    :return: The structured array
+    """
+
+    dtype = numpy.dtype(dtype)
+    fills = []
+    for name in dtype.names:
+        kind = dtype.fields[name][0].kind
+        if kind == "f":
+            fills.append(numpy.nan)
+        elif kind in "SU":
+            fills.append("")
+        else:
+            fills.append(0)
+    values = [tuple(f if v is None else v for v, f in zip(row, fills)) for row in rows]
+    return numpy.array(values, dtype=dtype)
+
+
+BACKENDS = {
+    "mysql": SkyMapDatabase,
+    "sqlite": SQLiteDatabase
+}
+
+
+def open_database(backend=None, **kwargs):
+    """
+    Opens a connection to the skymap database.
+
+    :param backend: The backend to use ("mysql" or "sqlite"); defaults to DATABASE_BACKEND
+    :param kwargs: Extra arguments for the backend, e.g. path and read_only for SQLite
+    :return: A SkyMapDatabase instance
+    """
+
+    if backend is None:
+        backend = DATABASE_BACKEND
+    return BACKENDS[backend](**kwargs)
+
+
+# Process-wide shared connections, keyed by backend and connection arguments
+_shared_databases = {}
+_shared_pid = None
+_inherited_databases = []
+
+
+def shared_database(backend=None, **kwargs):
+    """
+    Returns a connection to the skymap database that is shared by all callers within the current process. The
+    connection is opened on first use and should not be closed by the caller.
+
+    After a fork (e.g. in multiprocessing workers) the connections inherited from the parent process are set aside
+    and new ones are opened, as a connection can not be used by two processes at the same time.
+
+    :param backend: The backend to use ("mysql" or "sqlite"); defaults to DATABASE_BACKEND
+    :param kwargs: Extra arguments for the backend, e.g. path and read_only for SQLite
+    :return: A SkyMapDatabase instance
+    """
+
+    global _shared_pid
+
+    pid = os.getpid()
+    if _shared_pid != pid:
+        # Keep references to inherited connections instead of closing them: closing would end the session of the
+        # parent process as well
+        _inherited_databases.extend(_shared_databases.values())
+        _shared_databases.clear()
+        _shared_pid = pid
+
+    if backend is None:
+        backend = DATABASE_BACKEND
+    key = (backend, tuple(sorted(kwargs.items())))
+    db = _shared_databases.get(key)
+    if db is None:
+        db = open_database(backend, **kwargs)
+        _shared_databases[key] = db
+    return db
+
+
+def close_shared_databases():
+    """Closes all shared connections opened by the current process"""
+    if _shared_pid == os.getpid():
+        for db in _shared_databases.values():
+            db.close()
+    _shared_databases.clear()
+
 
 if __name__ == "__main__":
     pass
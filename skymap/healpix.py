@@ -0,0 +1,299 @@
+"""
+Equal-area hierarchical sky pixelisation, using the nested HEALPix scheme (Gorski et al. 2005).
+
+The sphere is divided into 12 base pixels, and each pixel of order k is divided into 4 pixels of order k+1. In the
+nested numbering the pixels of order k+1 within a pixel p of order k are 4p ... 4p+3, so every pixel of any order
+corresponds to a single contiguous range of pixel numbers at a higher order. Regions of the sky are covered with a
+list of such ranges.
+"""
+
+import math
+import numpy
+
+
+# The order of the pixel column of the skymap_stars table; pixels are about 3.4' across
+PIXEL_ORDER = 10
+
+# The largest distance from a pixel center to any point of the pixel is at most this factor times the square root
+# of the pixel area, for all orders
+MAX_RADIUS_FACTOR = 1.5
+
+JRLL = numpy.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+JPLL = numpy.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def spread_bits(v, nbits):
+    result = numpy.zeros_like(v)
+    for b in range(nbits):
+        result |= ((v >> b) & 1) << (2 * b)
+    return result
+
+
+def compress_bits(v, nbits):
+    result = numpy.zeros_like(v)
+    for b in range(nbits):
+        result |= ((v >> (2 * b)) & 1) << b
+    return result
+
+
+def npix(order):
+    """Returns the number of pixels of the given order"""
+    return 12 << (2 * order)
+
+
+def pixel_area(order):
+    """Returns the area of a pixel of the given order, in steradians"""
+    return 4 * math.pi / npix(order)
+
+
+def max_pixel_radius(order):
+    """Returns an upper bound of the distance from a pixel center to any point of the pixel, in radians"""
+    return min(math.pi, MAX_RADIUS_FACTOR * math.sqrt(pixel_area(order)))
+
+
+def order_for_size(size, max_order=PIXEL_ORDER):
+    """
+    Returns the lowest order with pixels no larger than the given size.
+
+    :param size: The size, in degrees
+    :param max_order: The highest order to return
+    :return: The order
+    """
+
+    for order in range(max_order + 1):
+        if math.degrees(math.sqrt(pixel_area(order))) <= size:
+            return order
+    return max_order
+
+
+def ang2pix(ra, dec, order=PIXEL_ORDER):
+    """
+    Returns the nested pixel numbers of the given coordinates.
+
+    :param ra: The right ascension, in degrees; a number or an array
+    :param dec: The declination, in degrees; a number or an array
+    :param order: The order of the pixelisation
+    :return: The pixel numbers, as an int64 array, or an int for scalar input
+    """
+
+    scalar = numpy.isscalar(ra) and numpy.isscalar(dec)
+    nside = 1 << order
+    z = numpy.sin(numpy.radians(numpy.asarray(dec, dtype=numpy.float64)))
+    tt = numpy.mod(numpy.asarray(ra, dtype=numpy.float64), 360.0) / 90.0
+    z, tt = numpy.broadcast_arrays(numpy.atleast_1d(z), numpy.atleast_1d(tt))
+    za = numpy.abs(z)
+
+    face = numpy.zeros(z.shape, dtype=numpy.int64)
+    ix = numpy.zeros(z.shape, dtype=numpy.int64)
+    iy = numpy.zeros(z.shape, dtype=numpy.int64)
+
+    # Equatorial region
+    eq = za <= 2.0 / 3.0
+    t1 = nside * (0.5 + tt[eq])
+    t2 = nside * 0.75 * z[eq]
+    jp = (t1 - t2).astype(numpy.int64)
+    jm = (t1 + t2).astype(numpy.int64)
+    ifp = jp >> order
+    ifm = jm >> order
+    face[eq] = numpy.where(ifp == ifm, ifp | 4, numpy.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    pol = ~eq
+    ntt = numpy.minimum(tt[pol].astype(numpy.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside * numpy.sqrt(3 * (1 - za[pol]))
+    jp = numpy.minimum((tp * tmp).astype(numpy.int64), nside - 1)
+    jm = numpy.minimum(((1.0 - tp) * tmp).astype(numpy.int64), nside - 1)
+    north = z[pol] >= 0
+    face[pol] = numpy.where(north, ntt, ntt + 8)
+    ix[pol] = numpy.where(north, nside - jm - 1, jp)
+    iy[pol] = numpy.where(north, nside - jp - 1, jm)
+
+    pixels = (face << (2 * order)) + spread_bits(ix, order) + (spread_bits(iy, order) << 1)
+    if scalar:
+        return int(pixels[0])
+    return pixels
+
+
+def pix2ang(pixels, order=PIXEL_ORDER):
+    """
+    Returns the coordinates of the centers of the given nested pixels.
+
+    :param pixels: The pixel numbers; a number or an array
+    :param order: The order of the pixelisation
+    :return: A tuple (ra, dec) of arrays, in degrees
+    """
+
+    nside = 1 << order
+    pixels = numpy.atleast_1d(numpy.asarray(pixels, dtype=numpy.int64))
+    face = pixels >> (2 * order)
+    ipf = pixels & ((1 << (2 * order)) - 1)
+    ix = compress_bits(ipf, order)
+    iy = compress_bits(ipf >> 1, order)
+
+    jr = (JRLL[face] << order) - ix - iy - 1
+    nr = numpy.where(jr < nside, jr, numpy.where(jr > 3 * nside, 4 * nside - jr, nside))
+    z = numpy.where(
+        jr < nside,
+        1.0 - nr * nr / (3.0 * nside * nside),
+        numpy.where(jr > 3 * nside, nr * nr / (3.0 * nside * nside) - 1.0, (2 * nside - jr) * 2.0 / (3 * nside))
+    )
+    tmp = JPLL[face] * nr + ix - iy
+    tmp = numpy.where(tmp < 0, tmp + 8 * nr, tmp)
+    ra = 45.0 * tmp / nr
+    dec = numpy.degrees(numpy.arcsin(numpy.clip(z, -1.0, 1.0)))
+    return ra, dec
+
+
+def to_vectors(ra, dec):
+    """
+    Returns the unit vectors of the given coordinates.
+
+    :param ra: The right ascension, in degrees
+    :param dec: The declination, in degrees
+    :return: An array of shape (n, 3)
+    """
+
+    ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+    cos_dec = numpy.cos(dec)
+    return numpy.column_stack((cos_dec * numpy.cos(ra), cos_dec * numpy.sin(ra), numpy.sin(dec)))
+
+
+def merge_ranges(ranges):
+    """
+    Sorts and merges overlapping and adjacent ranges.
+
+    :param ranges: A list of (start, stop) tuples, with stop exclusive
+    :return: The merged list
+    """
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def cover(classify, order=PIXEL_ORDER, depth=None):
+    """
+    Covers a region with pixel ranges, descending the pixel hierarchy from the 12 base pixels.
+
+    At each order the region is compared with the discs that enclose the pixels. The pixels whose disc lies within
+    the region are added as a whole, the pixels whose disc lies outside the region are dropped, and the other pixels are
+    divided into their 4 children. At the last order the remaining pixels are added, so the cover contains every
+    point of the region.
+
+    :param classify: A function (vectors, radius) returning two boolean arrays (inside, outside) for the discs with
+                     the given center unit vectors and radius in radians
+    :param order: The order of the returned pixel ranges
+    :param depth: The order at which to stop descending; defaults to order. A lower depth gives fewer, coarser ranges.
+    :return: A list of (start, stop) pixel ranges at the given order, with stop exclusive
+    """
+
+    if depth is None or depth > order:
+        depth = order
+    ranges = []
+    pixels = numpy.arange(12, dtype=numpy.int64)
+    for k in range(depth + 1):
+        if not len(pixels):
+            break
+        ra, dec = pix2ang(pixels, k)
+        inside, outside = classify(to_vectors(ra, dec), max_pixel_radius(k))
+        if k == depth:
+            inside = ~outside
+        shift = 2 * (order - k)
+        ranges.extend(zip((pixels[inside] << shift).tolist(), ((pixels[inside] + 1) << shift).tolist()))
+        pixels = pixels[~inside & ~outside]
+        pixels = ((pixels[:, None] << 2) + numpy.arange(4)).ravel()
+    return merge_ranges(ranges)
+
+
+def cover_cap(ra, dec, radius, order=PIXEL_ORDER, depth=None):
+    """
+    Covers a spherical cap with pixel ranges.
+
+    :param ra: The right ascension of the center, in degrees
+    :param dec: The declination of the center, in degrees
+    :param radius: The radius, in degrees
+    :param order: The order of the returned pixel ranges
+    :param depth: The order at which to stop descending; see cover
+    :return: A list of (start, stop) pixel ranges
+    """
+
+    center = to_vectors(ra, dec)[0]
+    r = math.radians(radius)
+
+    def classify(vectors, pixel_radius):
+        d = numpy.arccos(numpy.clip(vectors.dot(center), -1.0, 1.0))
+        return d + pixel_radius <= r, d - pixel_radius > r
+
+    return cover(classify, order, depth)
+
+
+def cover_box(ra_range, dec_range, order=PIXEL_ORDER, depth=None):
+    """
+    Covers a coordinate box with pixel ranges.
+
+    :param ra_range: The range (min_ra, max_ra) of right ascension, in degrees. The range wraps if min_ra > max_ra and
+                     is the full circle if min_ra == max_ra or ra_range is None.
+    :param dec_range: The range (min_dec, max_dec) of declination, in degrees, or None for all declinations
+    :param order: The order of the returned pixel ranges
+    :param depth: The order at which to stop descending; see cover
+    :return: A list of (start, stop) pixel ranges
+    """
+
+    min_dec, max_dec = numpy.radians(dec_range or (-90.0, 90.0))
+    full_circle = ra_range is None or ra_range[0] % 360.0 == ra_range[1] % 360.0
+    if not full_circle:
+        start = math.radians(ra_range[0] % 360.0)
+        width = math.radians((ra_range[1] - ra_range[0]) % 360.0)
+
+    def classify(vectors, pixel_radius):
+        dec = numpy.arcsin(numpy.clip(vectors[:, 2], -1.0, 1.0))
+        inside = (dec - pixel_radius >= min_dec) & (dec + pixel_radius <= max_dec)
+        outside = (dec + pixel_radius < min_dec) | (dec - pixel_radius > max_dec)
+        if full_circle:
+            return inside, outside
+
+        # Half of the right ascension extent of the disc; discs that contain a pole span all right ascensions
+        cos_dec = numpy.cos(dec)
+        sin_radius = math.sin(pixel_radius)
+        half = numpy.full(len(vectors), numpy.inf)
+        ok = (cos_dec > sin_radius) & (pixel_radius < math.pi / 2)
+        half[ok] = numpy.arcsin(sin_radius / cos_dec[ok])
+
+        offset = numpy.mod(numpy.arctan2(vectors[:, 1], vectors[:, 0]) - start, 2 * math.pi)
+        inside &= (offset - half >= 0) & (offset + half <= width)
+        outside |= (offset - half > width) & (offset + half < 2 * math.pi)
+        return inside, outside
+
+    return cover(classify, order, depth)
+
+
+def cover_polygon(vertices, order=PIXEL_ORDER, depth=None):
+    """
+    Covers a convex spherical polygon with pixel ranges.
+
+    :param vertices: The vertices (ra, dec) of the polygon, in degrees, in clockwise or counterclockwise order
+    :param order: The order of the returned pixel ranges
+    :param depth: The order at which to stop descending; see cover
+    :return: A list of (start, stop) pixel ranges
+    """
+
+    points = to_vectors([v[0] for v in vertices], [v[1] for v in vertices])
+    normals = numpy.cross(points, numpy.roll(points, -1, axis=0))
+    normals /= numpy.sqrt((normals ** 2).sum(axis=1))[:, None]
+    if normals[0].dot(points.sum(axis=0)) < 0:
+        normals = -normals
+
+    def classify(vectors, pixel_radius):
+        # The angular distance of the disc centers to the great circle of each edge, positive on the inner side
+        distances = numpy.arcsin(numpy.clip(vectors.dot(normals.T), -1.0, 1.0))
+        return (distances >= pixel_radius).all(axis=1), (distances < -pixel_radius).any(axis=1)
+
+    return cover(classify, order, depth)
@@ -0,0 +1,206 @@
+import os
+import re
+import time
+import numpy
+
+from skymap.database import DATA_FOLDER
+
+
+IDENTIFIERS_FOLDER = os.path.join(DATA_FOLDER, "identifiers")
+
+# The catalogues in the index, with the skymap_stars columns holding their numbers
+CATALOGUES = {
+    "HIP": ["hip"],
+    "HD": ["hd1", "hd2"],
+    "HR": ["hr"],
+    "TYC": ["tyc1", "tyc2", "tyc3"]
+}
+
+DESIGNATION_PATTERN = re.compile(r"^\s*(HIP|HD|HR|TYC)\s*(\d+)(?:-(\d+)-(\d+))?\s*$", re.IGNORECASE)
+
+
+def tyc_key(tyc1, tyc2, tyc3):
+    """Combines the three parts of a Tycho identifier into a single integer key"""
+    return (numpy.asarray(tyc1, dtype=numpy.int64) * 100000 + tyc2) * 10 + tyc3
+
+
+def parse_designation(designation):
+    """
+    Parses a catalogue designation like "HIP 32349", "HD 48915", "HR 2491" or "TYC 5949-2777-1".
+
+    :param designation: The designation
+    :return: A tuple (catalogue, key), with key the integer key of the star in the identifier index
+    """
+
+    m = DESIGNATION_PATTERN.match(designation)
+    if m is None:
+        raise ValueError("Unknown designation {}".format(designation))
+    catalogue = m.group(1).upper()
+    if catalogue == "TYC":
+        if m.group(3) is None:
+            raise ValueError("Incomplete Tycho designation {}".format(designation))
+        return catalogue, int(tyc_key(int(m.group(2)), int(m.group(3)), int(m.group(4))))
+    if m.group(3) is not None:
+        raise ValueError("Unknown designation {}".format(designation))
+    return catalogue, int(m.group(2))
+
+
+def index_arrays(keys, ids, magnitudes):
+    """
+    Sorts the keys of a catalogue, with the stars of each key from bright to faint.
+
+    :param keys: Array of keys, 0 where the star is not in the catalogue
+    :param ids: Array of star ids
+    :param magnitudes: Array of magnitudes, NaN if unknown
+    :return: A tuple (keys, ids) of sorted arrays
+    """
+
+    valid = keys > 0
+    keys = keys[valid]
+    ids = ids[valid]
+    magnitudes = numpy.where(numpy.isnan(magnitudes[valid]), numpy.inf, magnitudes[valid])
+    order = numpy.lexsort((ids, magnitudes, keys))
+    return keys[order], ids[order]
+
+
+def export_identifier_index(db, folder=IDENTIFIERS_FOLDER):
+    """
+    Writes the identifier index of the skymap_stars table: for each catalogue a sorted array of catalogue numbers and
+    an array with the corresponding star ids.
+
+    :param db: An open SkyMapDatabase instance
+    :param folder: The folder to write the index to
+    """
+
+    print "Exporting identifier index"
+    t1 = time.time()
+
+    q = """
+            SELECT
+                id, COALESCE(hip, 0), COALESCE(tyc1, 0), COALESCE(tyc2, 0), COALESCE(tyc3, 0),
+                COALESCE(hd1, 0), COALESCE(hd2, 0), COALESCE(hr, 0),
+                COALESCE(hp_magnitude, vt_magnitude, johnsonV) AS magnitude
+            FROM skymap_stars
+        """
+    dtype = [(c, numpy.int64) for c in ("id", "hip", "tyc1", "tyc2", "tyc3", "hd1", "hd2", "hr")] + [("magnitude", numpy.float64)]
+    stars = numpy.concatenate(list(db.query_iter(q, row_format="array", dtype=dtype)) or [numpy.zeros(0, dtype=dtype)])
+
+    tyc = numpy.where(stars['tyc1'] > 0, tyc_key(stars['tyc1'], stars['tyc2'], stars['tyc3']), 0)
+    catalogues = {
+        "HIP": index_arrays(stars['hip'], stars['id'], stars['magnitude']),
+        "HD": index_arrays(
+            numpy.concatenate((stars['hd1'], stars['hd2'])),
+            numpy.concatenate((stars['id'], stars['id'])),
+            numpy.concatenate((stars['magnitude'], stars['magnitude']))
+        ),
+        "HR": index_arrays(stars['hr'], stars['id'], stars['magnitude']),
+        "TYC": index_arrays(tyc, stars['id'], stars['magnitude'])
+    }
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for catalogue, (keys, ids) in catalogues.items():
+        numpy.save(os.path.join(folder, "{}_keys.npy".format(catalogue)), keys)
+        numpy.save(os.path.join(folder, "{}_ids.npy".format(catalogue)), ids)
+
+    t2 = time.time()
+    print "{} stars, {:.1f} s".format(len(stars), t2 - t1)
+
+
+class IdentifierIndex(object):
+    """
+    Maps catalogue designations to star ids, using the sorted arrays written by export_identifier_index. The arrays
+    are memory-mapped when first used.
+    """
+
+    def __init__(self, folder=IDENTIFIERS_FOLDER):
+        self.folder = folder
+        self.arrays = {}
+
+    def catalogue(self, catalogue):
+        if catalogue not in CATALOGUES:
+            raise ValueError("Unknown catalogue {}".format(catalogue))
+        if catalogue not in self.arrays:
+            self.arrays[catalogue] = (
+                numpy.load(os.path.join(self.folder, "{}_keys.npy".format(catalogue)), mmap_mode="r"),
+                numpy.load(os.path.join(self.folder, "{}_ids.npy".format(catalogue)), mmap_mode="r")
+            )
+        return self.arrays[catalogue]
+
+    def find_all(self, catalogue, key):
+        """
+        Returns the ids of all stars with the given catalogue number, from bright to faint.
+
+        :param catalogue: One of the catalogues in CATALOGUES
+        :param key: The catalogue number, or the key returned by tyc_key for Tycho
+        :return: A list of star ids
+        """
+
+        keys, ids = self.catalogue(catalogue)
+        start = numpy.searchsorted(keys, key, side="left")
+        stop = numpy.searchsorted(keys, key, side="right")
+        return [int(x) for x in ids[start:stop]]
+
+    def find_many(self, catalogue, keys):
+        """
+        Returns the id of the brightest star for each of the given catalogue numbers.
+
+        :param catalogue: One of the catalogues in CATALOGUES
+        :param keys: Array of catalogue numbers
+        :return: Array of star ids, 0 where the number is not found
+        """
+
+        index_keys, index_ids = self.catalogue(catalogue)
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        result = numpy.zeros(len(keys), dtype=numpy.int64)
+        if not len(index_keys):
+            return result
+        positions = numpy.minimum(numpy.searchsorted(index_keys, keys), len(index_keys) - 1)
+        found = index_keys[positions] == keys
+        result[found] = index_ids[positions[found]]
+        return result
+
+    def find(self, catalogue, key):
+        """
+        Returns the id of the brightest star with the given catalogue number.
+
+        :param catalogue: One of the catalogues in CATALOGUES
+        :param key: The catalogue number, or the key returned by tyc_key for Tycho
+        :return: The star id, or None if the number is not found
+        """
+
+        ids = self.find_all(catalogue, key)
+        return ids[0] if ids else None
+
+    def find_star(self, designation):
+        """
+        Returns the id of the brightest star with the given designation, like "HIP 32349" or "TYC 5949-2777-1".
+
+        :param designation: The designation
+        :return: The star id, or None if the designation is not found
+        """
+
+        return self.find(*parse_designation(designation))
+
+
+_identifier_index = None
+
+
+def get_identifier_index():
+    """Returns the identifier index, opening it on first use"""
+    global _identifier_index
+    if _identifier_index is None:
+        _identifier_index = IdentifierIndex()
+    return _identifier_index
+
+
+def find_star(designation):
+    """
+    Returns the id of the brightest star with the given designation, like "HIP 32349", "HD 48915", "HR 2491" or
+    "TYC 5949-2777-1".
+
+    :param designation: The designation
+    :return: The star id, or None if the designation is not found
+    """
+
+    return get_identifier_index().find_star(designation)
@@ -3,7 +3,7 @@ import sys
 
 from skymap.metapost import MetaPostFigure
 from skymap.geometry import Rectangle, Point
-from skymap.database import SkyMapDatabase
+from skymap.database import SkyMapDatabase, shared_database
 from skymap.stars import Star
 
 DEFAULT_DISTANCE1 = 1.0583403888888888  # 3 postscript points
@@ -51,9 +51,8 @@ def build_label_database():
 
 
 def get_label_size(text, fontsize):
-    db = SkyMapDatabase()
+    db = shared_database()
     res = db.query_one("""SELECT * FROM skymap_labels WHERE label_text="{}" AND fontsize="{}" """.format(text, fontsize))
-    db.close()
     if res is None:
         return None
     return res['width'], res['height']
@@ -0,0 +1,115 @@
+import os
+import hashlib
+
+
+MANIFEST_TABLE = "skymap_manifest"
+
+
+def file_checksum(path, blocksize=1 << 20):
+    """
+    Computes the MD5 checksum of a file.
+
+    :param path: The path of the file
+    :param blocksize: The number of bytes read at a time
+    :return: The hexadecimal checksum
+    """
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def fingerprint(*parts):
+    """
+    Combines the given values into a single checksum.
+
+    :param parts: The values, converted with str
+    :return: The hexadecimal checksum
+    """
+
+    return hashlib.md5("|".join(str(p) for p in parts)).hexdigest()
+
+
+class BuildManifest(object):
+    """
+    Records the state of the database build in the skymap_manifest table: the checksums of the input files, the
+    fingerprints of the loaded tables and catalogues, and the build steps that completed. Each entry is a key and a
+    value; an entry is only recorded once the work it describes is complete, so an interrupted build can resume.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.db.commit_query("""
+            CREATE TABLE IF NOT EXISTS {} (
+                entry VARCHAR(255) PRIMARY KEY,
+                value VARCHAR(255)
+            )
+        """.format(MANIFEST_TABLE))
+
+    def get(self, entry):
+        row = self.db.query_one("""SELECT value FROM {} WHERE entry={}""".format(MANIFEST_TABLE, self.db.placeholder), (entry,))
+        if row is None:
+            return None
+        return row['value']
+
+    def set(self, entry, value):
+        with self.db.transaction():
+            self.forget(entry)
+            self.db.insert_row(MANIFEST_TABLE, ["entry", "value"], [entry, value])
+
+    def forget(self, entry):
+        self.db.commit_query("""DELETE FROM {} WHERE entry={}""".format(MANIFEST_TABLE, self.db.placeholder), (entry,))
+
+    def file_checksum(self, path):
+        """
+        Returns the checksum of a file. The checksum is cached in the manifest together with the size and
+        modification time of the file, so unchanged files are not read again.
+
+        :param path: The path of the file
+        :return: The hexadecimal checksum
+        """
+
+        entry = "file:{}".format(os.path.abspath(path))
+        stat = os.stat(path)
+        key = "{} {}".format(stat.st_size, int(stat.st_mtime))
+        cached = self.get(entry)
+        if cached is not None and cached.rsplit(" ", 1)[0] == key:
+            return cached.rsplit(" ", 1)[1]
+
+        checksum = file_checksum(path)
+        self.set(entry, "{} {}".format(key, checksum))
+        return checksum
+
+    def run_steps(self, name, steps, db, force=False):
+        """
+        Runs a sequence of build steps, skipping the steps that completed before with the same inputs.
+
+        Each step is a tuple (step_name, version, inputs, function), with inputs the names of the catalogues it reads
+        and function called with db. The fingerprint of a step combines its version, the fingerprints of its input
+        catalogues and the fingerprint of the step before it, so a step that runs causes all later steps to run as
+        well.
+
+        :param name: The name of the build, used to prefix the manifest entries
+        :param steps: The list of steps
+        :param db: The database passed to the step functions
+        :param force: If True, all steps are run
+        """
+
+        entries = ["step:{}:{}".format(name, step[0]) for step in steps]
+        previous = ""
+        for i, (step_name, version, inputs, function) in enumerate(steps):
+            current = fingerprint(step_name, version, previous, *[self.get("catalogue:{}".format(c)) for c in inputs])
+            if not force and self.get(entries[i]) == current:
+                print "Skipping {}: up to date".format(step_name)
+            else:
+                # The results of later steps are invalidated by running this one
+                for entry in entries[i:]:
+                    self.forget(entry)
+                function(db)
+                self.set(entries[i], current)
+            previous = current
@@ -84,6 +84,42 @@ class MapArea(DrawingArea):
     def inside_coordinate_range(self, p):
         return (self.min_longitude <= p.longitude <= self.max_longitude) and (self.min_latitude <= p.latitude <= self.max_latitude)
 
+    def visible_extent(self, samples=20):
+        """
+        Returns the coordinate box (min_longitude, max_longitude, min_latitude, max_latitude) containing all of the map
+        area. Near the corners of the map box, projections like the conic ones show coordinates beyond the nominal
+        ranges, so the ranges are widened to the coordinates along the borders of the map box. Equal longitudes mean
+        all longitudes.
+
+        :param samples: The number of intervals in which each border is sampled
+        :return: The coordinate box
+        """
+
+        if self.max_longitude - self.min_longitude >= 360:
+            return self.min_longitude, self.min_longitude, self.min_latitude, self.max_latitude
+
+        center_longitude = 0.5 * (self.min_longitude + self.max_longitude)
+        longitudes = [self.min_longitude, self.max_longitude]
+        latitudes = [self.min_latitude, self.max_latitude]
+        for border in (self.map_left_border, self.map_top_border, self.map_right_border, self.map_bottom_border):
+            for k in range(samples + 1):
+                p = self.projection(border.p1 + (k / float(samples)) * border.vector, True)
+                longitudes.append(ensure_angle_range(p.longitude, center_longitude))
+                latitudes.append(p.latitude)
+        min_latitude = max(min(latitudes), -90)
+        max_latitude = min(max(latitudes), 90)
+
+        # A pole within the map box is surrounded by all longitudes
+        full_circle = max(longitudes) - min(longitudes) >= 360
+        for pole in (90, -90):
+            if self.inside_maparea(self.map_point(SphericalPoint(0, pole))):
+                full_circle = True
+                min_latitude = min(min_latitude, pole)
+                max_latitude = max(max_latitude, pole)
+        if full_circle:
+            return 0, 0, min_latitude, max_latitude
+        return min(longitudes), max(longitudes), min_latitude, max_latitude
+
     def map_point(self, spherical_point):
         return self.projection(spherical_point)
 
@@ -223,19 +259,7 @@ class MapArea(DrawingArea):
 
     def draw_constellations(self, linewidth=0.3, dashed='dash pattern=on 1.6pt off 0.8pt'):
         self.comment("Constellation boundaries")
-        min_longitude = self.min_longitude
-        max_longitude = self.max_longitude
-        if max_longitude - min_longitude < 90:
-            min_longitude -= 45
-            max_longitude += 45
-
-        min_latitude = 45 * math.floor(self.min_latitude / 45.0)
-        max_latitude = 45 * math.ceil(self.max_latitude / 45.0)
-        if min_latitude < -90:
-            min_latitude = -90
-        if max_latitude > 90:
-            max_latitude = 90
-        boundaries = get_constellation_boundaries_for_area(min_longitude, max_longitude, min_latitude, max_latitude)
+        boundaries = get_constellation_boundaries_for_area(*self.visible_extent())
         for b in boundaries:
             points = [self.map_point(p) for p in b.interpolated_points]
             self.draw_polygon(points, linewidth=linewidth, dashed=dashed)
@@ -21,7 +21,8 @@ import itertools
 
 from skymap.milkyway import get_milky_way_south_boundary, get_milky_way_north_boundary, get_milky_way_holes, get_magellanic_clouds
 from skymap.constellations import get_constellation_boundaries_for_area
-from skymap.stars import select_stars
+from skymap.stars import select_stars, none_if_nan
+from skymap.star_counts import get_star_counts
 from skymap.map import *
 from skymap.labels import LabelManager
 from skymap.geometry import Rectangle
@@ -37,7 +38,13 @@ FAINTEST_MAGNITUDE = 12
 
 
 class SkyMapMaker(object):
-    def __init__(self, filename=None, paper_size="A3", landscape=False, margin_lr=(20, 20), margin_bt=(20, 20)):
+    def __init__(self, filename=None, paper_size="A3", landscape=False, margin_lr=(20, 20), margin_bt=(20, 20), star_budget=None, star_density=None):
+        """
+        :param star_budget: If given, the faintest magnitude of the stars is chosen so that about this many stars are
+                            drawn, up to FAINTEST_MAGNITUDE
+        :param star_density: If given, the faintest magnitude of the stars is chosen so that about this many stars per
+                             square centimeter are drawn, up to FAINTEST_MAGNITUDE
+        """
         self.filename = filename
         self.paper_size = paper_size
         self.landscape = landscape
@@ -49,6 +56,8 @@ class SkyMapMaker(object):
         self.map = None
         self.figure = None
         self.labelmanager = LabelManager()
+        self.star_budget = star_budget
+        self.star_density = star_density
 
     def set_filename(self, filename):
         self.filename = filename
@@ -147,57 +156,93 @@ class SkyMapMaker(object):
         print "Drawing stars"
         self.figure.comment("Stars")
 
-        stars = select_stars(magnitude=FAINTEST_MAGNITUDE, constellation=None, ra_range=(self.map.min_longitude, self.map.max_longitude), dec_range=(self.map.min_latitude, self.map.max_latitude))
-        for star in stars:
-            # print
-            # print "HIP:", star.hip
-            # print "Bayer/Flamsteed:", star.bayer, star.flamsteed
-            # print "Proper:", star.proper_name
-            # print "Constellation:", star.constellation
-            # print "Magnitude:", star.magnitude
-            # print "Variable:", star.is_variable
-            # print "Multiple:", star.is_multiple
-            # print "Max/min magnitude:", star.max_magnitude, star.min_magnitude
+        ra_range = (self.map.min_longitude, self.map.max_longitude)
+        dec_range = (self.map.min_latitude, self.map.max_latitude)
+        magnitude = self.limiting_magnitude(ra_range, dec_range)
+        stars = select_stars(magnitude=magnitude, constellation=None, ra_range=ra_range, dec_range=dec_range, table=True)
+
+        # Only the stars with a name get a StarView, to place their label; the others are drawn from the table columns
+        columns = [stars.data[c].tolist() for c in ('right_ascension', 'declination', 'magnitude', 'min_magnitude', 'max_magnitude')]
+        variable = stars.is_variable.tolist()
+        multiple = stars.is_multiple.tolist()
+        for i, (ra, dec, magnitude, min_magnitude, max_magnitude) in enumerate(itertools.izip(*columns)):
+            if i in stars.names:
+                self.draw_star(stars[i])
+                continue
+            p = self.map.map_point(SphericalPoint(ra, dec))
+            if not self.map.inside_maparea(p):
+                continue
+            self.draw_star_symbol(p, none_if_nan(magnitude), none_if_nan(min_magnitude), none_if_nan(max_magnitude), variable[i], multiple[i])
+
+    def chart_area(self):
+        """Returns the area of the map, in square centimeters"""
+        return (self.size[0] - self.margin_lr[0] - self.margin_lr[1]) * (self.size[1] - self.margin_bt[0] - self.margin_bt[1]) / 100.0
+
+    def limiting_magnitude(self, ra_range, dec_range):
+        """
+        Returns the faintest magnitude of the stars to draw. With a star budget or density, the magnitude is chosen
+        from the precomputed star counts, before any stars are selected.
+
+        :param ra_range: The range (min_ra, max_ra) of right ascension of the map, in degrees
+        :param dec_range: The range (min_dec, max_dec) of declination of the map, in degrees
+        :return: The magnitude
+        """
 
-            self.draw_star(star)
+        budget = self.star_budget
+        if self.star_density is not None:
+            budget = self.star_density * self.chart_area()
+            if self.star_budget is not None:
+                budget = min(budget, self.star_budget)
+        if budget is None:
+            return FAINTEST_MAGNITUDE
+        return get_star_counts().limiting_magnitude(budget, ra_range, dec_range, FAINTEST_MAGNITUDE)
 
     def draw_star(self, star):
         p = self.map.map_point(star.position)
         if not self.map.inside_maparea(p):
             return
 
+        size, o = self.draw_star_symbol(p, star.magnitude, star.min_magnitude, star.max_magnitude, star.is_variable, star.is_multiple)
+
+        # Print text
+        if star.proper_name:
+            print p
+            self.labelmanager.add_label(p, star.proper_name, "tiny", extra_distance=0.5 * size - 0.7, object_for=o)
+        elif star.identifier_string.strip():
+            self.labelmanager.add_label(p, star.identifier_string, "tiny", extra_distance=0.5 * size - 0.7, object_for=o)
+
+    def draw_star_symbol(self, p, magnitude, min_magnitude, max_magnitude, is_variable, is_multiple):
+        """
+        Draws the symbol of a star and registers it with the label manager.
+
+        :return: A tuple (size, object) with the size of the symbol and the circle registered with the label manager
+        """
+
         # Print the star itself
-        if star.is_variable:
-            min_size = self.magnitude_to_size(star.min_magnitude)
-            max_size = self.magnitude_to_size(star.max_magnitude)
+        if is_variable:
+            min_size = self.magnitude_to_size(min_magnitude)
+            max_size = self.magnitude_to_size(max_magnitude)
             self.drawing_area.draw_point(p, max_size + 0.3*LINEWIDTH, color="white")
             c = Circle(p, 0.5 * max_size)
             self.drawing_area.draw_circle(c, linewidth=0.3*LINEWIDTH)
-            if star.min_magnitude < FAINTEST_MAGNITUDE:
+            if min_magnitude < FAINTEST_MAGNITUDE:
                 self.drawing_area.draw_point(p, min_size)
             size = max_size
         else:
-            size = self.magnitude_to_size(star.magnitude)
+            size = self.magnitude_to_size(magnitude)
             self.drawing_area.draw_point(p, size + 0.3*LINEWIDTH, color="white")
             self.drawing_area.draw_point(p, size)
 
         # Print the multiple bar
-        if star.is_multiple:
+        if is_multiple:
             p1 = Point(p[0] - 0.5 * size - 0.2, p[1])
             p2 = Point(p[0] + 0.5 * size + 0.2, p[1])
             l = Line(p1, p2)
             self.drawing_area.draw_line(l, linewidth=0.25)
-            print "MULTIPLE:", star, star.magnitude, star.position
 
         o = Circle(p, 0.5 * size)
         self.labelmanager.add_object(o)
-
-        # Print text
-        if star.proper_name:
-            print p
-            self.labelmanager.add_label(p, star.proper_name, "tiny", extra_distance=0.5 * size - 0.7, object_for=o)
-        elif star.identifier_string.strip():
-            self.labelmanager.add_label(p, star.identifier_string, "tiny", extra_distance=0.5 * size - 0.7, object_for=o)
+        return size, o
 
     def magnitude_to_size(self, magnitude):
         if magnitude is None:
@@ -1,14 +1,24 @@
 import os
 import re
 
-from skymap.database import SkyMapDatabase
+from skymap.database import SkyMapDatabase, shared_database
 from skymap.geometry import HourAngle, DMSAngle, SphericalPoint
 
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "milkyway")
 URL = "http://www.skymap.com/files/overlays/milky.zip"
 
 
-def parse_file(file_path, db, curve_id, point_id):
+def parse_file(file_path, rows, curve_id, point_id):
+    """
+    Parses a milky way overlay file and appends its points to rows.
+
+    :param file_path: The path of the overlay file
+    :param rows: The list to append the (id, curve_id, ra, dec) rows to
+    :param curve_id: The id of the last curve read so far
+    :param point_id: The id of the next point
+    :return: The updated (curve_id, point_id)
+    """
+
     with open(file_path, "r") as fp:
         lines = fp.readlines()
 
@@ -19,14 +29,10 @@ def parse_file(file_path, db, curve_id, point_id):
 
         if l.startswith("MOVE"):
             curve_id += 1
-            p = extract_point(l)
-            q = """INSERT INTO milkyway VALUES ({0}, "{1}", "{2}", {3})""".format(point_id, curve_id, p.longitude, p.latitude)
-        elif l.startswith("DRAW"):
-            p = extract_point(l)
-            q = """INSERT INTO milkyway VALUES ({0}, "{1}", "{2}", {3})""".format(point_id, curve_id, p.longitude, p.latitude)
-        else:
+        elif not l.startswith("DRAW"):
             continue
-        db.commit_query(q)
+        p = extract_point(l)
+        rows.append((point_id, curve_id, p.longitude, p.latitude))
         point_id += 1
 
     return curve_id, point_id
@@ -57,7 +63,7 @@ def extract_point(line):
 
 
 def get_milky_way_curve(id):
-    db = SkyMapDatabase()
+    db = shared_database()
     q = "SELECT * FROM milkyway WHERE curve_id={0} ORDER BY id ASC".format(id)
     result = db.query(q)
     curve = []
@@ -65,7 +71,6 @@ def get_milky_way_curve(id):
         curve.append(SphericalPoint(row['ra'], row['dec']))
     if curve[0] == curve[-1]:
         curve = curve[:-1]
-    db.close()
     return curve
 
 
@@ -109,9 +114,11 @@ def build_milkyway_database():
         )""")
 
     # Fill table
+    rows = []
     point_id = 0
     curve_id = 0
-    curve_id, point_id = parse_file(os.path.join(DATA_FOLDER, "milkyway.txt"), db, curve_id, point_id)
-    curve_id, point_id = parse_file(os.path.join(DATA_FOLDER, "magellanic_clouds.txt"), db, curve_id, point_id)
+    curve_id, point_id = parse_file(os.path.join(DATA_FOLDER, "milkyway.txt"), rows, curve_id, point_id)
+    curve_id, point_id = parse_file(os.path.join(DATA_FOLDER, "magellanic_clouds.txt"), rows, curve_id, point_id)
+    db.bulk_load("milkyway", ["id", "curve_id", "ra", "dec"], rows)
 
     db.close()
@@ -0,0 +1,226 @@
+import time
+import math
+import numpy
+
+from skymap.database import SkyMapDatabase
+from skymap.healpix import to_vectors
+
+
+PAIRS_TABLE = "skymap_star_pairs"
+GROUPS_TABLE = "skymap_star_groups"
+DEFAULT_CRITERION = 100.0
+
+
+def find_pairs(right_ascension, declination, criterion):
+    """
+    Finds all pairs of stars closer to each other than the criterion, using a KD-tree over the unit vectors of the
+    stars. An angular separation corresponds to a fixed chord length between unit vectors, so a single range search
+    in the tree finds all pairs.
+
+    :param right_ascension: Array of right ascensions, in degrees
+    :param declination: Array of declinations, in degrees
+    :param criterion: The angular separation below which stars form a pair, in seconds of arc
+    :return: A tuple (i, j, separation) of arrays, with i < j the indices of the stars of each pair and separation in
+             seconds of arc
+    """
+
+    from scipy.spatial import cKDTree
+
+    vectors = to_vectors(right_ascension, declination)
+    chord = 2 * math.sin(math.radians(criterion / 3600.0) / 2)
+
+    tree = cKDTree(vectors)
+    pairs = tree.query_pairs(chord, output_type="ndarray")
+    if not len(pairs):
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+
+    i = pairs[:, 0]
+    j = pairs[:, 1]
+    distances = numpy.sqrt(((vectors[i] - vectors[j]) ** 2).sum(axis=1))
+    separation = 3600.0 * numpy.degrees(2 * numpy.arcsin(numpy.minimum(distances / 2, 1.0)))
+
+    # query_pairs includes pairs at the chord length itself
+    close = separation < criterion
+    order = numpy.lexsort((j[close], i[close]))
+    return i[close][order], j[close][order], separation[close][order]
+
+
+def build_pairs_table(db=None, criterion=DEFAULT_CRITERION):
+    """
+    Finds all pairs of stars in skymap_stars closer than the criterion, and writes them to the skymap_star_pairs table.
+
+    :param db: An open SkyMapDatabase instance
+    :param criterion: The angular separation below which stars form a pair, in seconds of arc
+    :return: The number of pairs
+    """
+
+    if db is None:
+        db = SkyMapDatabase()
+
+    print "Finding star pairs closer than {} seconds of arc".format(criterion)
+    t1 = time.time()
+
+    q = """SELECT id, right_ascension, declination FROM skymap_stars WHERE right_ascension IS NOT NULL AND declination IS NOT NULL"""
+    dtype = [('id', numpy.int64), ('right_ascension', numpy.float64), ('declination', numpy.float64)]
+    stars = numpy.concatenate(list(db.query_iter(q, row_format="array", dtype=dtype)) or [numpy.zeros(0, dtype=dtype)])
+    t2 = time.time()
+    print "Read {} stars: {:.1f} s".format(len(stars), t2 - t1)
+
+    i, j, separation = find_pairs(stars['right_ascension'], stars['declination'], criterion)
+    t3 = time.time()
+    print "Found {} pairs: {:.1f} s".format(len(i), t3 - t2)
+
+    db.drop_table(PAIRS_TABLE)
+    db.create_table(PAIRS_TABLE, ["star1", "star2", "separation"], [int, int, float])
+    db.bulk_load(PAIRS_TABLE, ["star1", "star2", "separation"], zip(stars['id'][i].tolist(), stars['id'][j].tolist(), separation.tolist()))
+    db.add_index(PAIRS_TABLE, "star1")
+    db.add_index(PAIRS_TABLE, "star2")
+    t4 = time.time()
+    print "Written: {:.1f} s".format(t4 - t3)
+
+    return len(i)
+
+
+def union_find(n, i, j):
+    """
+    Divides n elements in groups, joining the elements of each pair (i, j).
+
+    :param n: The number of elements
+    :param i: Array with the first element of each pair
+    :param j: Array with the second element of each pair
+    :return: Array with for each element the smallest element of its group
+    """
+
+    parent = range(n)
+
+    def find(a):
+        root = a
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[a] != root:
+            parent[a], a = root, parent[a]
+        return root
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra = find(a)
+        rb = find(b)
+        if ra < rb:
+            parent[rb] = ra
+        elif rb < ra:
+            parent[ra] = rb
+
+    # Only the elements of a pair can have another root than themselves
+    roots = numpy.arange(n, dtype=numpy.int64)
+    involved = numpy.unique(numpy.concatenate((i, j)))
+    roots[involved] = [find(a) for a in involved.tolist()]
+    return roots
+
+
+def group_magnitudes(magnitudes, groups):
+    """
+    Computes the combined magnitude of each group of stars, by summing the fluxes of its members. Members with an
+    unknown (NaN) magnitude do not contribute.
+
+    :param magnitudes: Array of magnitudes
+    :param groups: Array with the group number of each star, from 0 to the number of groups - 1
+    :return: Array with the combined magnitude of each group
+    """
+
+    flux = numpy.nan_to_num(numpy.power(10.0, -numpy.asarray(magnitudes, dtype=numpy.float64) / 2.5))
+    total = numpy.bincount(groups, weights=flux)
+    with numpy.errstate(divide="ignore"):
+        combined = -2.5 * numpy.log10(total)
+    combined[total == 0] = numpy.nan
+    return combined
+
+
+def find_groups(right_ascension, declination, magnitudes, criterion):
+    """
+    Clusters stars into multiple systems: stars closer to each other than the criterion are in the same group,
+    directly or through other members.
+
+    :param right_ascension: Array of right ascensions, in degrees
+    :param declination: Array of declinations, in degrees
+    :param magnitudes: Array of magnitudes
+    :param criterion: The angular separation below which stars are joined, in seconds of arc
+    :return: A tuple (members, group, primary, separation, magnitude) of arrays with one entry per star in a group of
+             two or more: the index of the star, the group number (from 0), the index of the brightest star of the group,
+             the separation from that star in seconds of arc and the combined magnitude of the group
+    """
+
+    magnitudes = numpy.asarray(magnitudes, dtype=numpy.float64)
+    i, j, separation = find_pairs(right_ascension, declination, criterion)
+    roots = union_find(len(magnitudes), i, j)
+
+    members = numpy.flatnonzero(numpy.bincount(roots, minlength=len(roots))[roots] > 1)
+    if not len(members):
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty, numpy.zeros(0), numpy.zeros(0)
+    unique_roots, group = numpy.unique(roots[members], return_inverse=True)
+
+    # The primary is the brightest member; stars without magnitude come last
+    m = numpy.where(numpy.isnan(magnitudes[members]), numpy.inf, magnitudes[members])
+    order = numpy.lexsort((members, m, group))
+    first = numpy.searchsorted(group[order], numpy.arange(len(unique_roots)))
+    primary = members[order][first][group]
+
+    vectors = to_vectors(right_ascension, declination)
+    distances = numpy.sqrt(((vectors[members] - vectors[primary]) ** 2).sum(axis=1))
+    separation = 3600.0 * numpy.degrees(2 * numpy.arcsin(numpy.minimum(distances / 2, 1.0)))
+
+    combined = group_magnitudes(magnitudes[members], group)[group]
+    return members, group, primary, separation, combined
+
+
+def build_groups_table(db=None, criterion=DEFAULT_CRITERION):
+    """
+    Clusters the stars of skymap_stars into multiple systems, and writes the members of each system to the
+    skymap_star_groups table, with the primary star, the separation from the primary and the combined magnitude.
+
+    :param db: An open SkyMapDatabase instance
+    :param criterion: The angular separation below which stars are joined, in seconds of arc
+    :return: The number of groups
+    """
+
+    if db is None:
+        db = SkyMapDatabase()
+
+    print "Grouping multiple stars closer than {} seconds of arc".format(criterion)
+    t1 = time.time()
+
+    q = """
+            SELECT id, right_ascension, declination, COALESCE(hp_magnitude, vt_magnitude, johnsonV) AS magnitude
+            FROM skymap_stars
+            WHERE right_ascension IS NOT NULL AND declination IS NOT NULL
+        """
+    dtype = [('id', numpy.int64), ('right_ascension', numpy.float64), ('declination', numpy.float64), ('magnitude', numpy.float64)]
+    stars = numpy.concatenate(list(db.query_iter(q, row_format="array", dtype=dtype)) or [numpy.zeros(0, dtype=dtype)])
+
+    members, group, primary, separation, magnitude = find_groups(
+        stars['right_ascension'], stars['declination'], stars['magnitude'], criterion
+    )
+    ngroups = len(numpy.unique(group))
+    t2 = time.time()
+    print "Found {} groups with {} stars: {:.1f} s".format(ngroups, len(members), t2 - t1)
+
+    columns = ["star_id", "group_id", "primary_id", "separation", "magnitude"]
+    db.drop_table(GROUPS_TABLE)
+    db.create_table(GROUPS_TABLE, columns, [int, int, int, float, float])
+    db.bulk_load(GROUPS_TABLE, columns, zip(
+        stars['id'][members].tolist(), (group + 1).tolist(), stars['id'][primary].tolist(), separation.tolist(),
+        [None if numpy.isnan(m) else m for m in magnitude.tolist()]
+    ))
+    db.add_index(GROUPS_TABLE, "star_id", unique=True)
+    db.add_index(GROUPS_TABLE, "group_id")
+    t3 = time.time()
+    print "Written: {:.1f} s".format(t3 - t2)
+
+    return ngroups
+
+
+if __name__ == "__main__":
+    t1 = time.time()
+    build_pairs_table()
+    build_groups_table()
+    print "Time: {:.1f} s".format(time.time() - t1)
@@ -0,0 +1,259 @@
+import os
+import time
+import shutil
+import numpy
+
+from skymap.database import DATA_FOLDER
+
+
+STAR_COLUMNS_FOLDER = os.path.join(DATA_FOLDER, "star_columns")
+
+# Subfolder of a column folder with the positions propagated to other epochs
+EPOCHS_FOLDER = "epochs"
+
+# Bit flags stored in the flags column
+FLAG_VARIABLE = 1
+FLAG_MULTIPLE = 2
+
+# Columns written to disk, one .npy file per column. NULL integers are stored as 0, NULL floats as NaN.
+ID_COLUMNS = ["id", "hip", "tyc1", "tyc2", "tyc3", "hd1", "hd2", "hr", "flamsteed"]
+STAR_COLUMNS = [(c, numpy.int32) for c in ID_COLUMNS] + [
+    ("right_ascension", numpy.float64),
+    ("declination", numpy.float64),
+    ("proper_motion_ra", numpy.float64),
+    ("proper_motion_dec", numpy.float64),
+    ("magnitude", numpy.float32),
+    ("flags", numpy.uint8),
+    ("source", "S2"),
+    ("constellation", "S3")
+]
+
+# Name columns, stored only for the rows that have a name: NAME_ROWS_FILE holds the sorted row indices of these rows,
+# and each name column one string per row index. Missing names are stored as empty strings.
+NAME_COLUMNS = ["proper_name", "bayer"]
+NAME_ROWS_FILE = "name_rows.npy"
+
+
+def export_star_columns(db, folder=STAR_COLUMNS_FOLDER):
+    """
+    Writes the skymap_stars table to a set of NumPy column files, sorted by declination.
+
+    :param db: An open SkyMapDatabase instance
+    :param folder: The folder to write the column files to
+    """
+
+    print "Exporting star columns"
+    t1 = time.time()
+
+    q = """
+            SELECT
+                id, hip, tyc1, tyc2, tyc3, hd1, hd2, hr, flamsteed,
+                right_ascension, declination, proper_motion_ra, proper_motion_dec,
+                COALESCE(hp_magnitude, vt_magnitude, johnsonV) AS magnitude,
+                variable, multiple, source, constellation, proper_name, bayer
+            FROM skymap_stars
+            WHERE right_ascension IS NOT NULL AND declination IS NOT NULL
+        """
+    batches = [rows_to_columns(rows) for rows in db.query_iter(q)]
+    columns = {}
+    for name, dtype in STAR_COLUMNS:
+        columns[name] = numpy.concatenate([b[name] for b in batches] or [numpy.zeros(0, dtype=dtype)])
+    for name in NAME_COLUMNS:
+        columns[name] = numpy.concatenate([b[name] for b in batches] or [numpy.zeros(0, dtype=numpy.unicode_)])
+
+    order = numpy.argsort(columns['declination'], kind="mergesort")
+
+    save_columns(folder, columns, order)
+
+    t2 = time.time()
+    print "{} stars, {:.1f} s".format(len(order), t2 - t1)
+
+
+def save_columns(folder, columns, rows):
+    """
+    Writes the given rows of a set of columns to a folder, one .npy file per column. Positions propagated to other
+    epochs from earlier columns are removed.
+
+    :param folder: The folder to write to
+    :param columns: A dictionary or StarColumns instance with the columns in STAR_COLUMNS and NAME_COLUMNS
+    :param rows: The row indices to write
+    """
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if os.path.exists(os.path.join(folder, EPOCHS_FOLDER)):
+        shutil.rmtree(os.path.join(folder, EPOCHS_FOLDER))
+    for name, dtype in STAR_COLUMNS:
+        numpy.save(os.path.join(folder, "{}.npy".format(name)), numpy.asarray(columns[name])[rows])
+
+    if isinstance(columns, StarColumns):
+        names = dict((name, columns.name_values(name, rows)) for name in NAME_COLUMNS)
+    else:
+        names = dict((name, numpy.asarray(columns[name])[rows]) for name in NAME_COLUMNS)
+    named = numpy.zeros(len(names[NAME_COLUMNS[0]]), dtype=bool)
+    for name in NAME_COLUMNS:
+        named |= names[name] != ""
+    named = numpy.flatnonzero(named)
+    numpy.save(os.path.join(folder, NAME_ROWS_FILE), named)
+    for name in NAME_COLUMNS:
+        numpy.save(os.path.join(folder, "{}.npy".format(name)), names[name][named])
+
+
+def rows_to_columns(rows):
+    """
+    Converts skymap_stars records to a dictionary of NumPy column arrays.
+
+    :param rows: A list of database records
+    :return: A dictionary mapping the column names in STAR_COLUMNS and NAME_COLUMNS to arrays
+    """
+
+    columns = {}
+    for name, dtype in STAR_COLUMNS:
+        if name == "flags":
+            values = [
+                (FLAG_VARIABLE if r['variable'] else 0) | (FLAG_MULTIPLE if r['multiple'] else 0) for r in rows
+            ]
+        elif name in ID_COLUMNS:
+            values = [r[name] or 0 for r in rows]
+        elif name in ("source", "constellation"):
+            values = [r[name] or "" for r in rows]
+        else:
+            values = [numpy.nan if r[name] is None else r[name] for r in rows]
+        columns[name] = numpy.array(values, dtype=dtype)
+    for name in NAME_COLUMNS:
+        columns[name] = numpy.array([r.get(name) or u"" for r in rows], dtype=numpy.unicode_)
+    return columns
+
+
+class StarColumns(object):
+    """
+    Memory-mapped columnar star catalogue, as written by export_star_columns.
+    """
+
+    def __init__(self, folder=STAR_COLUMNS_FOLDER):
+        self.folder = folder
+        self.columns = {}
+        for name, dtype in STAR_COLUMNS:
+            self.columns[name] = numpy.load(os.path.join(folder, "{}.npy".format(name)), mmap_mode="r")
+
+        # Column folders written before the names were exported have no name files
+        if os.path.exists(os.path.join(folder, NAME_ROWS_FILE)):
+            self.name_rows = numpy.load(os.path.join(folder, NAME_ROWS_FILE))
+            self.names = dict((name, numpy.load(os.path.join(folder, "{}.npy".format(name)))) for name in NAME_COLUMNS)
+        else:
+            self.name_rows = numpy.zeros(0, dtype=numpy.int64)
+            self.names = dict((name, numpy.zeros(0, dtype=numpy.unicode_)) for name in NAME_COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def select(self, magnitude, constellation=None, ra_range=None, dec_range=None):
+        """
+        Select the stars brighter than the given magnitude within the given coordinate ranges.
+
+        The declination range is resolved with a binary search on the sorted declination column, the other criteria
+        with boolean masks on the resulting slice.
+
+        :param magnitude: The maximum magnitude to include
+        :param constellation: The constellation abbreviation; if given, only stars from that constellation are included
+        :param ra_range: The range (min_ra, max_ra) of right ascension to include, in degrees (0-360)
+        :param dec_range: The range (min_dec, max_dec) of declination to include, in degrees
+        :return: An array of row indices, ordered from brightest to weakest
+        """
+
+        start = 0
+        stop = len(self)
+        if dec_range:
+            declination = self.columns['declination']
+            start = numpy.searchsorted(declination, dec_range[0], side="left")
+            stop = numpy.searchsorted(declination, dec_range[1], side="right")
+
+        magnitudes = self.columns['magnitude'][start:stop]
+        mask = magnitudes <= magnitude
+
+        if constellation:
+            mask &= self.columns['constellation'][start:stop] == constellation
+
+        if ra_range:
+            min_ra, max_ra = ra_range
+            ra = self.columns['right_ascension'][start:stop]
+            if min_ra < max_ra:
+                mask &= (ra >= min_ra) & (ra <= max_ra)
+            elif max_ra < min_ra:
+                mask &= (ra >= min_ra) | (ra <= max_ra)
+
+        indices = numpy.flatnonzero(mask)
+        order = numpy.argsort(magnitudes[indices], kind="mergesort")
+        return start + indices[order]
+
+    def row(self, index):
+        """
+        Returns the star at the given row index as a dictionary with the same keys as a skymap_stars record.
+
+        :param index: The row index
+        :return: A dictionary
+        """
+
+        row = {}
+        for name, dtype in STAR_COLUMNS:
+            v = self.columns[name][index]
+            if name == "flags":
+                row['variable'] = bool(v & FLAG_VARIABLE)
+                row['multiple'] = bool(v & FLAG_MULTIPLE)
+            elif name in ID_COLUMNS:
+                row[name] = int(v) or None
+            elif name in ("source", "constellation"):
+                row[name] = str(v) or None
+            else:
+                row[name] = None if numpy.isnan(v) else float(v)
+        for name in NAME_COLUMNS:
+            row[name] = unicode(self.name_values(name, [index])[0]) or None
+        return row
+
+    def name_values(self, name, indices):
+        """
+        Returns the values of a name column for the given rows.
+
+        :param name: The name column, one of NAME_COLUMNS
+        :param indices: The row indices
+        :return: An array of strings, empty for the rows without a name
+        """
+
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        values = numpy.zeros(len(indices), dtype=self.names[name].dtype)
+        if len(self.name_rows):
+            positions = numpy.searchsorted(self.name_rows, indices).clip(0, len(self.name_rows) - 1)
+            found = self.name_rows[positions] == indices
+            values[found] = self.names[name][positions[found]]
+        return values
+
+    def star_names(self, indices):
+        """
+        Returns the names of the given rows, in the form used by StarTable.
+
+        :param indices: The row indices
+        :return: Dictionary with a tuple (proper_name, bayer, flamsteed) for the positions in indices of the rows that
+            have any of these
+        """
+
+        proper_name = self.name_values("proper_name", indices)
+        bayer = self.name_values("bayer", indices)
+        flamsteed = numpy.asarray(self.columns['flamsteed'][numpy.asarray(indices, dtype=numpy.int64)])
+        names = {}
+        for i in numpy.flatnonzero((proper_name != "") | (bayer != "") | (flamsteed != 0)):
+            names[int(i)] = (unicode(proper_name[i]) or None, unicode(bayer[i]) or None, int(flamsteed[i]) or None)
+        return names
+
+
+_star_columns = None
+
+
+def get_star_columns():
+    """Returns the memory-mapped star catalogue, opening it on first use"""
+    global _star_columns
+    if _star_columns is None:
+        _star_columns = StarColumns()
+    return _star_columns
@@ -0,0 +1,155 @@
+import os
+import math
+import time
+import numpy
+
+from skymap.database import DATA_FOLDER
+from skymap.healpix import ang2pix, pix2ang, npix, pixel_area
+
+
+STAR_COUNTS_FILE = os.path.join(DATA_FOLDER, "star_counts.npy")
+
+# The star counts are kept per pixel of this order (about 1.8 degrees wide), for each of the magnitude limits
+COUNTS_ORDER = 5
+MAGNITUDE_LIMITS = numpy.arange(-1.0, 16.01, 0.25)
+
+
+def count_stars(right_ascension, declination, magnitude, order=COUNTS_ORDER, limits=MAGNITUDE_LIMITS):
+    """
+    Counts the stars in each pixel that are at least as bright as each of the magnitude limits.
+
+    :param right_ascension: Array of right ascensions, in degrees
+    :param declination: Array of declinations, in degrees
+    :param magnitude: Array of magnitudes; stars without magnitude (NaN) are not counted
+    :param order: The order of the pixels
+    :param limits: Sorted array of magnitude limits
+    :return: An array of shape (number of pixels, number of limits), with the number of stars with a magnitude lower
+             than or equal to each limit
+    """
+
+    magnitude = numpy.asarray(magnitude, dtype=numpy.float64)
+    k = numpy.searchsorted(limits, magnitude, side="left")
+    counted = k < len(limits)
+    pixels = ang2pix(numpy.asarray(right_ascension)[counted], numpy.asarray(declination)[counted], order)
+    counts = numpy.bincount(pixels * len(limits) + k[counted], minlength=npix(order) * len(limits))
+    return numpy.cumsum(counts.reshape(npix(order), len(limits)), axis=1).astype(numpy.int32)
+
+
+def export_star_counts(columns, path=STAR_COUNTS_FILE):
+    """
+    Writes the star counts per pixel and magnitude limit of the column files.
+
+    :param columns: A StarColumns instance
+    :param path: The file to write the counts to
+    """
+
+    print "Counting stars"
+    t1 = time.time()
+    counts = count_stars(columns['right_ascension'], columns['declination'], columns['magnitude'])
+    numpy.save(path, counts)
+    t2 = time.time()
+    print "{:.1f} s".format(t2 - t1)
+
+
+def full_circle(ra_range):
+    """Returns whether a range (min_ra, max_ra) of right ascension covers the full circle: None, equal values, or a
+    width of 360 degrees or more"""
+    if not ra_range:
+        return True
+    width = ra_range[1] - ra_range[0]
+    return width == 0 or width >= 360 or width % 360 == 0
+
+
+def box_solid_angle(ra_range, dec_range):
+    """
+    Returns the solid angle of a coordinate box, in steradians.
+
+    :param ra_range: The range (min_ra, max_ra) of right ascension, in degrees; None, equal values or a width of 360
+                     degrees for the full circle
+    :param dec_range: The range (min_dec, max_dec) of declination, in degrees; None for all declinations
+    :return: The solid angle
+    """
+
+    ra_size = 360.0
+    if not full_circle(ra_range):
+        ra_size = (ra_range[1] - ra_range[0]) % 360
+    min_dec, max_dec = dec_range if dec_range else (-90.0, 90.0)
+    return math.radians(ra_size) * (math.sin(math.radians(max_dec)) - math.sin(math.radians(min_dec)))
+
+
+class StarCounts(object):
+    """
+    Estimates the number of stars in an area of the sky, from the star counts written by export_star_counts.
+    """
+
+    def __init__(self, path=STAR_COUNTS_FILE, counts=None, order=COUNTS_ORDER, limits=MAGNITUDE_LIMITS):
+        if counts is None:
+            counts = numpy.load(path)
+        self.counts = counts
+        self.order = order
+        self.limits = limits
+        self.ra, self.dec = pix2ang(numpy.arange(npix(order), dtype=numpy.int64), order)
+
+    def pixels_in_box(self, ra_range, dec_range):
+        """Returns the pixels whose center lies within the coordinate box"""
+        mask = numpy.ones(len(self.ra), dtype=bool)
+        if not full_circle(ra_range):
+            min_ra, max_ra = ra_range[0] % 360, ra_range[1] % 360
+            if min_ra < max_ra:
+                mask &= (self.ra >= min_ra) & (self.ra <= max_ra)
+            elif max_ra < min_ra:
+                mask &= (self.ra >= min_ra) | (self.ra <= max_ra)
+        if dec_range:
+            mask &= (self.dec >= dec_range[0]) & (self.dec <= dec_range[1])
+        return numpy.flatnonzero(mask)
+
+    def estimate(self, ra_range=None, dec_range=None):
+        """
+        Estimates the number of stars in a coordinate box for each of the magnitude limits, from the mean star density
+        of the pixels whose center lies within the box. For a box smaller than a pixel, the pixel of its center is used.
+
+        :param ra_range: The range (min_ra, max_ra) of right ascension, in degrees; None, equal values or a width of 360
+                         degrees for the full circle
+        :param dec_range: The range (min_dec, max_dec) of declination, in degrees
+        :return: An array with the estimated number of stars for each magnitude limit
+        """
+
+        pixels = self.pixels_in_box(ra_range, dec_range)
+        if not len(pixels):
+            ra = 0.0
+            if not full_circle(ra_range):
+                ra = ra_range[0] + 0.5 * ((ra_range[1] - ra_range[0]) % 360)
+            dec = 0.5 * (dec_range[0] + dec_range[1]) if dec_range else 0.0
+            pixels = ang2pix([ra], [dec], self.order)
+
+        density = self.counts[pixels].sum(axis=0) / (len(pixels) * pixel_area(self.order))
+        return density * box_solid_angle(ra_range, dec_range)
+
+    def limiting_magnitude(self, budget, ra_range=None, dec_range=None, faintest_magnitude=None):
+        """
+        Returns the faintest magnitude limit for which the estimated number of stars in the box stays within budget.
+
+        :param budget: The maximum number of stars
+        :param ra_range: The range (min_ra, max_ra) of right ascension, in degrees
+        :param dec_range: The range (min_dec, max_dec) of declination, in degrees
+        :param faintest_magnitude: If given, the limit is not fainter than this magnitude
+        :return: The magnitude limit
+        """
+
+        # The estimates grow with the limit, so the limits within budget are the ones before the first one over it
+        over = numpy.flatnonzero(self.estimate(ra_range, dec_range) > budget)
+        first_over = over[0] if len(over) else len(self.limits)
+        if faintest_magnitude is not None and (first_over == len(self.limits) or self.limits[first_over] > faintest_magnitude):
+            return faintest_magnitude
+        return float(self.limits[max(first_over - 1, 0)])
+
+
+_star_counts = None
+
+
+def get_star_counts():
+    """Returns the star counts, loading them on first use"""
+    global _star_counts
+    if _star_counts is None:
+        _star_counts = StarCounts()
+    return _star_counts
@@ -0,0 +1,163 @@
+import os
+import time
+import numpy
+
+from skymap.database import DATA_FOLDER
+from skymap.star_columns import StarColumns, save_columns
+from skymap.healpix import ang2pix, cover_box, npix
+
+
+STAR_TILES_FOLDER = os.path.join(DATA_FOLDER, "star_tiles")
+
+# The magnitude bands of the tile pyramid as (min_magnitude, max_magnitude, order). Fainter bands hold more stars, so
+# they are divided into more, smaller tiles (HEALPix pixels of a higher order).
+MAGNITUDE_BANDS = [
+    (-numpy.inf, 6.0, 3),
+    (6.0, 8.0, 4),
+    (8.0, 10.0, 5),
+    (10.0, 12.0, 6),
+    (12.0, numpy.inf, 6)
+]
+
+
+def band_folder(folder, i):
+    return os.path.join(folder, "band{}".format(i))
+
+
+def export_star_tiles(columns, folder=STAR_TILES_FOLDER):
+    """
+    Writes the tile pyramid. For each magnitude band, the stars of the band are written as a set of column files,
+    sorted by tile and by magnitude within each tile, together with the offsets of the tiles.
+
+    :param columns: A StarColumns instance
+    :param folder: The folder to write the tile pyramid to
+    """
+
+    print "Exporting star tiles"
+    t1 = time.time()
+
+    magnitude = numpy.asarray(columns['magnitude'])
+    for i, (min_magnitude, max_magnitude, order) in enumerate(MAGNITUDE_BANDS):
+        selected = numpy.flatnonzero((magnitude >= min_magnitude) & (magnitude < max_magnitude))
+        tiles = ang2pix(numpy.asarray(columns['right_ascension'])[selected], numpy.asarray(columns['declination'])[selected], order)
+        order_in_band = numpy.lexsort((magnitude[selected], tiles))
+        rows = selected[order_in_band]
+
+        # offsets[t]:offsets[t + 1] are the rows of tile t
+        offsets = numpy.searchsorted(tiles[order_in_band], numpy.arange(npix(order) + 1)).astype(numpy.int64)
+
+        save_columns(band_folder(folder, i), columns, rows)
+        numpy.save(os.path.join(band_folder(folder, i), "offsets.npy"), offsets)
+        print "Band {}: {} stars in {} tiles".format(i, len(rows), npix(order))
+
+    t2 = time.time()
+    print "{:.1f} s".format(t2 - t1)
+
+
+def merge_runs(runs, values):
+    """
+    Merges runs of row indices that are each sorted by value into a single sorted array, keeping equal values in
+    the order of the runs.
+
+    :param runs: A list of arrays of row indices
+    :param values: The array of values the runs are sorted by
+    :return: The merged array of row indices
+    """
+
+    runs = [r for r in runs if len(r)]
+    if not runs:
+        return numpy.zeros(0, dtype=numpy.int64)
+    while len(runs) > 1:
+        merged = []
+        for a, b in zip(runs[::2], runs[1::2]):
+            # Position of each element of b in the merged run
+            positions = numpy.searchsorted(values[a], values[b], side="right") + numpy.arange(len(b))
+            result = numpy.empty(len(a) + len(b), dtype=a.dtype)
+            mask = numpy.ones(len(result), dtype=bool)
+            mask[positions] = False
+            result[positions] = b
+            result[mask] = a
+            merged.append(result)
+        if len(runs) % 2:
+            merged.append(runs[-1])
+        runs = merged
+    return runs[0]
+
+
+class StarTiles(object):
+    """
+    Tile pyramid of the star catalogue, as written by export_star_tiles. Each band is a memory-mapped StarColumns
+    instance, with the offsets of its tiles.
+    """
+
+    def __init__(self, folder=STAR_TILES_FOLDER):
+        self.folder = folder
+        self.bands = []
+        self.offsets = []
+        for i in range(len(MAGNITUDE_BANDS)):
+            self.bands.append(StarColumns(band_folder(folder, i)))
+            self.offsets.append(numpy.load(os.path.join(band_folder(folder, i), "offsets.npy"), mmap_mode="r"))
+
+    def select(self, magnitude, constellation=None, ra_range=None, dec_range=None):
+        """
+        Select the stars brighter than the given magnitude within the given coordinate ranges. Only the bands up to
+        the given magnitude and the tiles covering the coordinate ranges are read.
+
+        :param magnitude: The maximum magnitude to include
+        :param constellation: The constellation abbreviation; if given, only stars from that constellation are included
+        :param ra_range: The range (min_ra, max_ra) of right ascension to include, in degrees (0-360)
+        :param dec_range: The range (min_dec, max_dec) of declination to include, in degrees
+        :return: A list of (StarColumns, row indices) tuples, together ordered from brightest to weakest
+        """
+
+        result = []
+        for band, offsets, (min_magnitude, max_magnitude, order) in zip(self.bands, self.offsets, MAGNITUDE_BANDS):
+            if min_magnitude > magnitude:
+                break
+
+            magnitudes = band['magnitude']
+            if max_magnitude <= magnitude:
+                # The whole band is included, so each cover range is a single slice of the band. The slices are sorted
+                # by tile, so they are sorted by magnitude afterwards, keeping equal magnitudes in tile order.
+                slices = [numpy.arange(offsets[start], offsets[stop]) for start, stop in cover_box(ra_range, dec_range, order)]
+                rows = numpy.concatenate(slices or [numpy.zeros(0, dtype=numpy.int64)])
+                rows = rows[numpy.argsort(magnitudes[rows], kind="mergesort")]
+            else:
+                # Only the band cut by the magnitude is read tile by tile
+                runs = []
+                for start, stop in cover_box(ra_range, dec_range, order):
+                    for tile in range(start, stop):
+                        first, last = offsets[tile], offsets[tile + 1]
+                        if first == last:
+                            continue
+                        last = first + numpy.searchsorted(magnitudes[first:last], magnitude, side="right")
+                        runs.append(numpy.arange(first, last))
+                rows = merge_runs(runs, magnitudes)
+
+            # The tiles cover the coordinate ranges, but can extend beyond them
+            mask = numpy.ones(len(rows), dtype=bool)
+            if constellation:
+                mask &= band['constellation'][rows] == constellation
+            if ra_range:
+                min_ra, max_ra = ra_range
+                ra = band['right_ascension'][rows]
+                if min_ra < max_ra:
+                    mask &= (ra >= min_ra) & (ra <= max_ra)
+                elif max_ra < min_ra:
+                    mask &= (ra >= min_ra) | (ra <= max_ra)
+            if dec_range:
+                dec = band['declination'][rows]
+                mask &= (dec >= dec_range[0]) & (dec <= dec_range[1])
+            result.append((band, rows[mask]))
+        return result
+
+
+_star_tiles = None
+
+
+def get_star_tiles():
+    """Returns the memory-mapped tile pyramid, opening it on first use"""
+    global _star_tiles
+    if _star_tiles is None:
+        _star_tiles = StarTiles()
+    return _star_tiles
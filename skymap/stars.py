@@ -1,13 +1,24 @@
+import os
 import sys
 import time
 import math
+import itertools
 import urllib
+import numpy
 from bs4 import BeautifulSoup
 from datetime import datetime
-from multiprocessing import Process, current_process
-from skymap.database import SkyMapDatabase
+from skymap.database import SkyMapDatabase, shared_database
+from skymap.star_columns import StarColumns, get_star_columns, export_star_columns, EPOCHS_FOLDER
+from skymap.star_columns import FLAG_VARIABLE, FLAG_MULTIPLE
+from skymap.star_tiles import get_star_tiles, export_star_tiles
+from skymap.star_counts import export_star_counts
+from skymap.manifest import BuildManifest
+from skymap.healpix import PIXEL_ORDER, ang2pix, cover_box, cover_cap, merge_ranges, order_for_size
+from skymap.multiples import find_pairs, build_pairs_table, build_groups_table
+from skymap.crossmatch import merge_catalogues_in_memory
+from skymap.identifiers import IdentifierIndex, export_identifier_index
 from skymap.geometry import ensure_angle_range, SphericalPoint
-from skymap.constellations import ConstellationFinder
+from skymap.constellations import ConstellationFinder, get_constellation_zones
 from skymap.coordinates import julian_year_difference, REFERENCE_EPOCH
 
 
@@ -18,6 +29,9 @@ MAS_FOR_FULL_CIRCLE = 360*60*60*1000.0
 HIPPARCOS_EPOCH = datetime(1991, 4, 1).date()
 TYCHO2_EPOCH = REFERENCE_EPOCH
 
+# The epoch of the positions in skymap_stars for each source; Tycho-1 and Hipparcos positions are at J1991.25
+SOURCE_EPOCHS = {"T2": TYCHO2_EPOCH, "T1": HIPPARCOS_EPOCH, "H": HIPPARCOS_EPOCH}
+
 
 GREEK_LETTERS = {
     "alp": "alpha",
@@ -60,7 +74,7 @@ def propagate_position(from_epoch, to_epoch, right_ascension, declination, prope
     :return: new position
     """
 
-    if not proper_motion_dec or not proper_motion_ra:
+    if proper_motion_dec is None or proper_motion_ra is None:
         return right_ascension, declination
 
     dt = julian_year_difference(to_epoch, from_epoch)
@@ -71,7 +85,84 @@ def propagate_position(from_epoch, to_epoch, right_ascension, declination, prope
     pm_dec = proper_motion_dec / 3.6e6
 
     # Calculate the new positions
-    ra = right_ascension + dt * pm_ra/math.cos(declination)
+    ra = right_ascension + dt * pm_ra/math.cos(math.radians(declination))
+    dec = declination + dt * pm_dec
+
+    return ra, dec
+
+
+def epoch_differences(to_epoch, from_epochs):
+    """
+    Computes the time from one or more epochs to the target epoch.
+
+    :param to_epoch: datetime
+    :param from_epochs: datetime, or a sequence of datetimes
+    :return: The differences in Julian years, as a number or an array
+    """
+
+    if not isinstance(from_epochs, (list, tuple, numpy.ndarray)):
+        return julian_year_difference(to_epoch, from_epochs)
+
+    # Only a few distinct epochs are expected, so each is converted once
+    differences = {}
+    for e in set(from_epochs):
+        differences[e] = julian_year_difference(to_epoch, e)
+    return numpy.array([differences[e] for e in from_epochs])
+
+
+def source_epoch_differences(to_epoch, sources):
+    """
+    Computes the time from the epoch of the source catalogue of each star to the target epoch. Each of the few source
+    epochs is converted once, and assigned to the stars of its source with a mask.
+
+    :param to_epoch: datetime
+    :param sources: array with the source of each star, as in SOURCE_EPOCHS
+    :return: array with the differences in Julian years
+    """
+
+    sources = numpy.asarray(sources)
+    dt = numpy.full(len(sources), julian_year_difference(to_epoch, HIPPARCOS_EPOCH))
+    for source, epoch in SOURCE_EPOCHS.items():
+        dt[sources == source] = julian_year_difference(to_epoch, epoch)
+    return dt
+
+
+def propagate_positions(from_epoch, to_epoch, right_ascension, declination, proper_motion_ra, proper_motion_dec):
+    """
+    Simple propagation in angular coordinates, for arrays of stars. Stars with an unknown (NaN) proper motion keep
+    their position.
+
+    :param from_epoch: datetime, or a sequence with the epoch of each star
+    :param to_epoch: datetime
+    :param right_ascension: array, in degrees
+    :param declination: array, in degrees
+    :param proper_motion_ra: array, in mas/year, corrected for declination
+    :param proper_motion_dec: array, in mas/year
+    :return: new positions, as a tuple of arrays (ra, dec)
+    """
+
+    dt = epoch_differences(to_epoch, from_epoch)
+    return shift_positions(dt, right_ascension, declination, proper_motion_ra, proper_motion_dec)
+
+
+def shift_positions(dt, right_ascension, declination, proper_motion_ra, proper_motion_dec):
+    """
+    Moves arrays of stars along their proper motions. Stars with an unknown (NaN) proper motion keep their position.
+
+    :param dt: The time, in Julian years, as a number or an array
+    :param right_ascension: array, in degrees
+    :param declination: array, in degrees
+    :param proper_motion_ra: array, in mas/year, corrected for declination
+    :param proper_motion_dec: array, in mas/year
+    :return: new positions, as a tuple of arrays (ra, dec)
+    """
+
+    right_ascension = numpy.asarray(right_ascension, dtype=numpy.float64)
+    declination = numpy.asarray(declination, dtype=numpy.float64)
+    pm_ra = numpy.nan_to_num(numpy.asarray(proper_motion_ra, dtype=numpy.float64)) / 3.6e6
+    pm_dec = numpy.nan_to_num(numpy.asarray(proper_motion_dec, dtype=numpy.float64)) / 3.6e6
+
+    ra = right_ascension + dt * pm_ra / numpy.cos(numpy.radians(declination))
     dec = declination + dt * pm_dec
 
     return ra, dec
@@ -137,6 +228,86 @@ def propagate_position2(from_epoch, to_epoch, right_ascension, declination, prop
     return right_ascension, declination
 
 
+def propagate_positions2(from_epoch, to_epoch, right_ascension, declination, proper_motion_ra, proper_motion_dec, distance=1.0, radial_velocity=0.0):
+    """
+    Rigorous propagation in Cartesian coordinates, for arrays of stars. Stars with an unknown (NaN) proper motion or
+    radial velocity are propagated as if it were zero.
+
+    :param from_epoch: datetime, or a sequence with the epoch of each star
+    :param to_epoch: datetime
+    :param right_ascension: array, in degrees
+    :param declination: array, in degrees
+    :param proper_motion_ra: array, in mas/year
+    :param proper_motion_dec: array, in mas/year
+    :param distance: number or array, in parsec
+    :param radial_velocity: number or array, in km/s
+    :return: new positions, as a tuple of arrays (ra, dec)
+    """
+
+    dt = epoch_differences(to_epoch, from_epoch)
+
+    right_ascension = numpy.radians(numpy.asarray(right_ascension, dtype=numpy.float64))
+    declination = numpy.radians(numpy.asarray(declination, dtype=numpy.float64))
+    proper_motion_ra = numpy.nan_to_num(numpy.asarray(proper_motion_ra, dtype=numpy.float64))
+    proper_motion_dec = numpy.nan_to_num(numpy.asarray(proper_motion_dec, dtype=numpy.float64))
+    distance = numpy.asarray(distance, dtype=numpy.float64)
+    radial_velocity = numpy.nan_to_num(numpy.asarray(radial_velocity, dtype=numpy.float64))
+
+    # Proper motions as linear velocities, and the radial velocity, in parsec/yr
+    velocity_ra = proper_motion_ra * 2 * math.pi * distance / MAS_FOR_FULL_CIRCLE
+    velocity_dec = proper_motion_dec * 2 * math.pi * distance / MAS_FOR_FULL_CIRCLE
+    velocity_r = radial_velocity * KM_PER_S_TO_PARSEC_PER_YEAR
+
+    sin_ra = numpy.sin(right_ascension)
+    cos_ra = numpy.cos(right_ascension)
+    sin_dec = numpy.sin(declination)
+    cos_dec = numpy.cos(declination)
+
+    # Propagate the Cartesian position in parsecs
+    x = distance * cos_dec * cos_ra + dt * (velocity_r * cos_dec * cos_ra - velocity_ra * sin_ra - velocity_dec * sin_dec * cos_ra)
+    y = distance * cos_dec * sin_ra + dt * (velocity_r * cos_dec * sin_ra + velocity_ra * cos_ra - velocity_dec * sin_dec * sin_ra)
+    z = distance * sin_dec + dt * (velocity_r * sin_dec + velocity_dec * cos_dec)
+
+    ra = numpy.mod(numpy.degrees(numpy.arctan2(y, x)), 360.0)
+    dec = numpy.degrees(numpy.arctan2(z, numpy.hypot(x, y)))
+    return ra, dec
+
+
+_epoch_snapshots = {}
+
+
+def positions_at_epoch(columns, epoch):
+    """
+    Returns the positions of all stars of a column store propagated to the given epoch, using the epoch of the source
+    of each star. The positions are computed once per epoch, and kept in memory and in the column folder.
+
+    :param columns: A StarColumns instance
+    :param epoch: datetime
+    :return: A tuple of arrays (ra, dec), in degrees, in the row order of the columns
+    """
+
+    key = (os.path.abspath(columns.folder), epoch)
+    if key in _epoch_snapshots:
+        return _epoch_snapshots[key]
+
+    folder = os.path.join(columns.folder, EPOCHS_FOLDER)
+    paths = [os.path.join(folder, "{}_{}.npy".format(epoch.isoformat(), c)) for c in ("ra", "dec")]
+    if all(os.path.exists(p) for p in paths):
+        positions = tuple(numpy.load(p, mmap_mode="r") for p in paths)
+    else:
+        positions = shift_positions(
+            source_epoch_differences(epoch, columns['source']), columns['right_ascension'], columns['declination'],
+            columns['proper_motion_ra'], columns['proper_motion_dec']
+        )
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for p, values in zip(paths, positions):
+            numpy.save(p, values)
+
+    _epoch_snapshots[key] = positions
+    return positions
+
+
 def angular_separation_seconds_of_arc(ra1, de1, ra2, de2):
     """
     Calculates the angular separation of two points.
@@ -153,6 +324,22 @@ def angular_separation_seconds_of_arc(ra1, de1, ra2, de2):
     return 3600 * math.sqrt((dra * math.cos(math.radians(de2))) ** 2 + dde ** 2)
 
 
+def angular_distances(ra1, de1, ra2, de2):
+    """
+    Calculates the great-circle distances between points, with the haversine formula.
+
+    :param ra1: Right ascension of the first points in degrees; a number or an array
+    :param de1: Declination of the first points in degrees; a number or an array
+    :param ra2: Right ascension of the second points in degrees; a number or an array
+    :param de2: Declination of the second points in degrees; a number or an array
+    :return: Array of distances in degrees
+    """
+
+    ra1, de1, ra2, de2 = [numpy.radians(numpy.asarray(x, dtype=numpy.float64)) for x in (ra1, de1, ra2, de2)]
+    h = numpy.sin((de2 - de1) / 2) ** 2 + numpy.cos(de1) * numpy.cos(de2) * numpy.sin((ra2 - ra1) / 2) ** 2
+    return numpy.degrees(2 * numpy.arcsin(numpy.sqrt(numpy.clip(h, 0.0, 1.0))))
+
+
 def angular_sep_to_local_degrees(ra, de, sep):
     """
     Comverts the given angular separation from seconds of arc to local degrees.
@@ -163,7 +350,7 @@ def angular_sep_to_local_degrees(ra, de, sep):
     :return: A tuple containing the separation in degrees in RA and DE direction, both equal to the input separation
     """
 
-    return sep/(3600.0*math.cos(de)), sep/3600.0
+    return sep/(3600.0*math.cos(math.radians(de))), sep/3600.0
 
 
 class Star(object):
@@ -182,22 +369,22 @@ class Star(object):
 
     @property
     def hip(self):
-        return self.data['hip']
+        return self.data.get('hip')
 
     @property
     def bayer(self):
         """Returns the Bayer designation for the star, if present"""
-        return self.data['bayer']
+        return self.data.get('bayer')
 
     @property
     def flamsteed(self):
         """Returns the Flamsteed number for the star, if present"""
-        return self.data['flamsteed']
+        return self.data.get('flamsteed')
 
     @property
     def proper_name(self):
         """Returns the proper name for the star, if present"""
-        return self.data['proper_name']
+        return self.data.get('proper_name')
 
     @property
     def identifier_string(self):
@@ -206,48 +393,66 @@ class Star(object):
     @property
     def magnitude(self):
         """Retuns the visual magnitude for the star"""
-        m = [self.data['hp_magnitude'], self.data['vt_magnitude'], self.data['magnitude']]
+        m = [self.data.get('hp_magnitude'), self.data.get('vt_magnitude'), self.data.get('magnitude')]
         return next((item for item in m if item is not None), None)
 
     @property
     def is_variable(self):
         """Returns true if the star is variable"""
-        return (self.data['variability_type'] == "P") or (self.data['tyc_variable_flag'] == "V")
+        if self.data.get('variable'):
+            return True
+        return (self.data.get('variability_type') == "P") or (self.data.get('tyc_variable_flag') == "V")
 
     @property
     def is_multiple(self):
         """Returns True if the star is a binary or multiple star system"""
-        ncomp = self.data['number_of_components']
+        if self.data.get('multiple'):
+            return True
+        ncomp = self.data.get('number_of_components')
         if ncomp is not None and ncomp > 1:
             return True
-        if self.data['tyc_multiple_flag'] == 'D':
+        if self.data.get('tyc_multiple_flag') == 'D':
             return True
         return False
 
     @property
     def min_magnitude(self):
         """Returns the minimum magnitude for variable stars"""
-        return self.data['min_magnitude']
+        return self.data.get('min_magnitude')
 
     @property
     def max_magnitude(self):
         """Returns the maximum magnitude for variable stars"""
-        return self.data['max_magnitude']
+        return self.data.get('max_magnitude')
 
     def propagate_position(self, date=None):
-        """Propagates the position of the star to the given date"""
-        epoch = datetime(2000, 1, 1).date()  # TODO: Use constant, and use that constant epoch as well for building the database
-        return propagate_position(epoch, date, self.right_ascension, self.declination, self.proper_motion_ra, self.proper_motion_dec)
+        """Propagates the position of the star from the epoch of its source to the given date"""
+        return propagate_position(self.epoch, date, self.right_ascension, self.declination, self.proper_motion_ra, self.proper_motion_dec)
+
+    @property
+    def epoch(self):
+        """Returns the epoch of the database position"""
+        return SOURCE_EPOCHS.get(self.data.get('source'), HIPPARCOS_EPOCH)
+
+    @property
+    def proper_motion_ra(self):
+        """Returns the proper motion in right ascension in mas/year, corrected for declination"""
+        return self.data.get('proper_motion_ra')
+
+    @property
+    def proper_motion_dec(self):
+        """Returns the proper motion in declination in mas/year"""
+        return self.data.get('proper_motion_dec')
 
     @property
     def right_ascension(self):
         """Returns the database right ascension for the catalogue epoch in degrees"""
-        return self.data['right_ascension']
+        return self.data.get('right_ascension')
 
     @property
     def declination(self):
         """Returns the database declination for the catalogue epoch in degrees"""
-        return self.data['declination']
+        return self.data.get('declination')
 
     @property
     def position(self):
@@ -257,26 +462,245 @@ class Star(object):
     @property
     def constellation(self):
         """Returns the constellation the star is in"""
-        return self.data['constellation']
+        return self.data.get('constellation')
+
+
+# The fields of a StarTable; NULL integers are stored as 0, NULL floats as NaN
+STAR_TABLE_DTYPE = [
+    ('id', numpy.int32),
+    ('hip', numpy.int32),
+    ('right_ascension', numpy.float64),
+    ('declination', numpy.float64),
+    ('magnitude', numpy.float32),
+    ('min_magnitude', numpy.float32),
+    ('max_magnitude', numpy.float32),
+    ('flags', numpy.uint8),
+    ('constellation', 'S3')
+]
+
+
+class StarTable(object):
+    """
+    A list of stars stored in a NumPy structured array, with the unified magnitude and the variability and multiplicity
+    flags computed once. The names of the stars that have one are kept separately, as most stars have none.
+
+    Indexing the table returns a StarView, which has the same properties as Star.
+    """
+
+    def __init__(self, data, names=None):
+        """
+        :param data: A structured array with dtype STAR_TABLE_DTYPE
+        :param names: Dictionary with a tuple (proper_name, bayer, flamsteed) for the rows that have any of these
+        """
+
+        self.data = data
+        self.names = names or {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Creates a table from skymap_stars records.
+
+        :param rows: A list of database records
+        :return: A StarTable
+        """
+
+        data = numpy.zeros(len(rows), dtype=STAR_TABLE_DTYPE)
+        names = {}
+        for i, row in enumerate(rows):
+            star = Star(row)
+            flags = (FLAG_VARIABLE if star.is_variable else 0) | (FLAG_MULTIPLE if star.is_multiple else 0)
+            data[i] = (
+                row.get('id') or 0, row.get('hip') or 0,
+                nan_if_none(star.right_ascension), nan_if_none(star.declination),
+                nan_if_none(star.magnitude), nan_if_none(star.min_magnitude), nan_if_none(star.max_magnitude),
+                flags, star.constellation or ""
+            )
+            if star.proper_name or star.bayer or star.flamsteed:
+                names[i] = (star.proper_name, star.bayer, star.flamsteed)
+        return cls(data, names)
+
+    @classmethod
+    def from_columns(cls, columns, indices):
+        """
+        Creates a table from rows of a StarColumns store.
+
+        :param columns: A StarColumns instance
+        :param indices: The row indices
+        :return: A StarTable
+        """
+
+        data = numpy.zeros(len(indices), dtype=STAR_TABLE_DTYPE)
+        for name in ('id', 'hip', 'right_ascension', 'declination', 'magnitude', 'flags', 'constellation'):
+            data[name] = columns[name][indices]
+        data['min_magnitude'] = numpy.nan
+        data['max_magnitude'] = numpy.nan
+        return cls(data, columns.star_names(indices))
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Joins a list of tables into one"""
+        names = {}
+        offset = 0
+        for t in tables:
+            for i, n in t.names.items():
+                names[offset + i] = n
+            offset += len(t)
+        return cls(numpy.concatenate([t.data for t in tables] or [numpy.zeros(0, dtype=STAR_TABLE_DTYPE)]), names)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return StarView(self, index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield StarView(self, i)
+
+    @property
+    def is_variable(self):
+        """Returns a boolean array, True for the variable stars"""
+        return (self.data['flags'] & FLAG_VARIABLE) != 0
+
+    @property
+    def is_multiple(self):
+        """Returns a boolean array, True for the binary and multiple star systems"""
+        return (self.data['flags'] & FLAG_MULTIPLE) != 0
+
 
+def nan_if_none(v):
+    return numpy.nan if v is None else v
 
-def build_star_database():
+
+def none_if_nan(v):
+    v = float(v)
+    return None if math.isnan(v) else v
+
+
+class StarView(object):
+    """
+    A single star of a StarTable, with the same properties as Star.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def _name(self, i):
+        names = self.table.names.get(self.index)
+        return names[i] if names else None
+
+    @property
+    def id(self):
+        return int(self.table.data['id'][self.index]) or None
+
+    @property
+    def hip(self):
+        return int(self.table.data['hip'][self.index]) or None
+
+    @property
+    def proper_name(self):
+        """Returns the proper name for the star, if present"""
+        return self._name(0)
+
+    @property
+    def bayer(self):
+        """Returns the Bayer designation for the star, if present"""
+        return self._name(1)
+
+    @property
+    def flamsteed(self):
+        """Returns the Flamsteed number for the star, if present"""
+        return self._name(2)
+
+    @property
+    def identifier_string(self):
+        return ""
+
+    @property
+    def magnitude(self):
+        """Retuns the visual magnitude for the star"""
+        return none_if_nan(self.table.data['magnitude'][self.index])
+
+    @property
+    def min_magnitude(self):
+        """Returns the minimum magnitude for variable stars"""
+        return none_if_nan(self.table.data['min_magnitude'][self.index])
+
+    @property
+    def max_magnitude(self):
+        """Returns the maximum magnitude for variable stars"""
+        return none_if_nan(self.table.data['max_magnitude'][self.index])
+
+    @property
+    def is_variable(self):
+        """Returns true if the star is variable"""
+        return bool(self.table.data['flags'][self.index] & FLAG_VARIABLE)
+
+    @property
+    def is_multiple(self):
+        """Returns True if the star is a binary or multiple star system"""
+        return bool(self.table.data['flags'][self.index] & FLAG_MULTIPLE)
+
+    @property
+    def right_ascension(self):
+        """Returns the database right ascension for the catalogue epoch in degrees"""
+        return none_if_nan(self.table.data['right_ascension'][self.index])
+
+    @property
+    def declination(self):
+        """Returns the database declination for the catalogue epoch in degrees"""
+        return none_if_nan(self.table.data['declination'][self.index])
+
+    @property
+    def position(self):
+        """Returns the position of the star in degrees"""
+        return SphericalPoint(self.right_ascension, self.declination)
+
+    @property
+    def constellation(self):
+        """Returns the constellation the star is in"""
+        return str(self.table.data['constellation'][self.index]) or None
+
+
+def build_star_database(force=False):
     """
     Builds the SkyMapDatabase using data from Tycho 2, Tycho, Hipparcos.
     Adds supplementary data from the HD-DM-GC-HR-HIP-Bayer-Flamsteed Cross Index, the Bright Star Catalog and the IAU list of proper names.
     Adds constellations.
+
+    The completed steps are recorded in the build manifest. Steps whose version and input catalogues did not change
+    since they last completed are skipped, so an interrupted build resumes at the step that was interrupted.
+
+    :param force: If True, all steps are run
     """
 
     db = SkyMapDatabase()
+    BuildManifest(db).run_steps("skymap_stars", STAR_BUILD_STEPS, db, force)
+
+
+def merge_catalogues(db, engine="memory"):
+    """
+    Creates the skymap_stars table from Tycho 2, Tycho and Hipparcos.
+
+    :param db: An open SkyMapDatabase instance
+    :param engine: "memory" to join the catalogues in memory and bulk load the result, or "sql" to join them with
+                   INSERT ... SELECT statements in the database
+    """
+
     create_table(db)
-    add_tycho2(db)
-    add_tycho1(db)
-    add_hipparcos(db)
+    if engine == "memory":
+        merge_catalogues_in_memory(db)
+    elif engine == "sql":
+        add_tycho2(db)
+        add_tycho1(db)
+        add_hipparcos(db)
+    else:
+        raise ValueError("Unknown merge engine {}".format(engine))
     add_indexes(db)
-    add_cross_index(db)
-    add_bright_star_catalog(db)
-    add_proper_names(db)
-    add_constellations(db)
 
 
 def create_table(db):
@@ -331,6 +755,7 @@ def create_table(db):
                         variable BOOL,
                         multiple BOOL,
                         source VARCHAR(2),
+                        pixel INT,
                         
                         PRIMARY KEY (id)
                     )"""
@@ -474,19 +899,15 @@ def add_hipparcos(db):
                     hiptyc_h_dm_com AS d ON d.HIP = h.HIP
                 LEFT JOIN
                     (
-                        (
-                            SELECT 
-                                TYC1, TYC2, TYC3, HIP, CCDM
-                            FROM
-                                tyc2_tyc2
-                        ) 
+                        SELECT 
+                            TYC1, TYC2, TYC3, HIP, CCDM
+                        FROM
+                            tyc2_tyc2
                         UNION ALL 
-                        (
-                            SELECT 
-                                TYC1, TYC2, TYC3, HIP, CCDM
-                            FROM
-                                tyc2_suppl_1
-                        )
+                        SELECT 
+                            TYC1, TYC2, TYC3, HIP, CCDM
+                        FROM
+                            tyc2_suppl_1
                     ) AS t 
                     ON t.HIP = h.HIP
                     AND (
@@ -523,6 +944,42 @@ def add_indexes(db):
     print "{:.1f} s".format(t2 - t1)
 
 
+def add_pixels(db):
+    """
+    Assigns the HEALPix pixel of order PIXEL_ORDER to each star, and indexes the pixel column.
+
+    :param db: An open SkyMapDatabase instance
+    """
+
+    print "Adding sky pixels"
+    t1 = time.time()
+
+    def updates():
+        q = """SELECT id, right_ascension, declination FROM skymap_stars WHERE right_ascension IS NOT NULL AND declination IS NOT NULL"""
+        for rows in db.query_iter(q, row_format="tuple"):
+            ids, ra, dec = zip(*rows)
+            for id, pixel in zip(ids, ang2pix(numpy.array(ra), numpy.array(dec)).tolist()):
+                yield id, pixel
+
+    db.bulk_update("skymap_stars", "id", ["pixel"], updates())
+    db.add_index("skymap_stars", "pixel")
+    t2 = time.time()
+    print "{:.1f} s".format(t2 - t1)
+
+
+def pixel_condition(ranges):
+    """
+    Returns an SQL condition selecting the stars in the given pixel ranges.
+
+    :param ranges: A list of (start, stop) pixel ranges at order PIXEL_ORDER, with stop exclusive
+    :return: The condition
+    """
+
+    if not ranges:
+        return """0"""
+    return """(""" + """ OR """.join("""pixel BETWEEN {} AND {}""".format(start, stop - 1) for start, stop in ranges) + """)"""
+
+
 def add_cross_index(db):
     """
     Add information from the HD-DM-GC-HR-HIP-Bayer-Flamsteed Cross Index (IV/27A). Bayer, Flamsteed, HR numbers.
@@ -567,19 +1024,23 @@ def add_bright_star_catalog(db):
 
 def add_proper_names(db):
     """
-    Adds the IAU proper names to the star database.
+    Adds the IAU proper names to the star database. The stars are looked up by HIP or HD number in the identifier index.
 
     :param db: An open SkyMapDatabase instance
     """
 
     print "Adding proper names"
     t1 = time.time()
+    index = IdentifierIndex()
 
     # Retrieve the proper name list
     url = "https://www.iau.org/public/themes/naming_stars/"
     r = urllib.urlopen(url).read()
     soup = BeautifulSoup(r, "html5lib")
 
+    # Collect the updates per star id; later names for the same star replace earlier ones
+    proper_names = {}
+
     # Loop over all stars in the list
     for tr in soup.find_all("tbody")[0].find_all("tr"):
         tds = tr.find_all("td")
@@ -605,12 +1066,14 @@ def add_proper_names(db):
         if date == '2015-12-15':
             continue
 
-        # Find and update the database record
-        row = db.query_one("""SELECT id FROM skymap_stars WHERE hip={} ORDER BY hp_magnitude ASC LIMIT 1""".format(hip))
-        if row is None:
-            row = db.query_one("""SELECT id FROM skymap_stars WHERE hd1={0} OR hd2={0} ORDER BY hp_magnitude ASC LIMIT 1""".format(hd))
-        q = """UPDATE skymap_stars SET proper_name="{}" WHERE id={}""".format(proper_name, row['id'])
-        db.commit_query(q)
+        # Find the brightest star with the HIP number, or else with the HD number
+        star_id = index.find("HIP", hip) if hip is not None else None
+        if star_id is None and hd is not None:
+            star_id = index.find("HD", hd)
+        if star_id is None:
+            print "Star {} not found".format(proper_name)
+            continue
+        proper_names[star_id] = proper_name
 
     # Add some special cases
     special_cases = {
@@ -624,9 +1087,13 @@ def add_proper_names(db):
     }
 
     for hip, proper_name in special_cases.items():
-        rid = db.query_one("""SELECT id FROM skymap_stars WHERE hip={} ORDER BY hp_magnitude ASC LIMIT 1""".format(hip))['id']
-        q = """UPDATE skymap_stars SET proper_name="{}" WHERE id={}""".format(proper_name, rid)
-        db.commit_query(q)
+        star_id = index.find("HIP", hip)
+        if star_id is None:
+            print "Star {} not found".format(proper_name)
+            continue
+        proper_names[star_id] = proper_name
+
+    db.bulk_update("skymap_stars", "id", ["proper_name"], proper_names.items())
 
     t2 = time.time()
     print "{:.1f} s".format(t2 - t1)
@@ -641,33 +1108,77 @@ def add_constellations(db):
 
     print "Adding constellations"
     t1 = time.time()
-    rows = db.query("""SELECT id, right_ascension, declination, source FROM skymap_stars""")
-    nrecords = len(rows)
-
-    # Prepare ConstellationFinders for Tycho and Hipparcos
-    cftyc = ConstellationFinder(TYCHO2_EPOCH)
-    cfhip = ConstellationFinder(HIPPARCOS_EPOCH)
-
-    # Loop over all stars
-    for i, r in enumerate(rows):
-        # Display progress
-        if i % 1000 == 0:
-            sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / (nrecords - 1)))
+    nrecords = db.query_one("""SELECT COUNT(*) AS n FROM skymap_stars""")['n']
+
+    # Prepare ConstellationFinders for Tycho and Hipparcos, sharing the zones
+    zones = get_constellation_zones()
+    cftyc = ConstellationFinder(TYCHO2_EPOCH, zones)
+    cfhip = ConstellationFinder(HIPPARCOS_EPOCH, zones)
+
+    def updates():
+        # Loop over all stars, a batch at a time
+        i = 0
+        q = """SELECT id, right_ascension, declination, source FROM skymap_stars WHERE right_ascension IS NOT NULL AND declination IS NOT NULL"""
+        dtype = [('id', numpy.int64), ('right_ascension', numpy.float64), ('declination', numpy.float64), ('source', "S2")]
+        for stars in db.query_iter(q, batch_size=100000, row_format="array", dtype=dtype):
+            # Display progress
+            sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / max(nrecords - 1, 1)))
             sys.stdout.flush()
 
-        if r['source'] == 'T2':
-            cf = cftyc
-        else:
-            cf = cfhip
-        c = cf.find(r['right_ascension'], r['declination'])
-        db.commit_query("UPDATE skymap_stars SET constellation='{}' WHERE id={}".format(c, r['id']))
+            constellations = numpy.empty(len(stars), dtype=object)
+            tycho = stars['source'] == "T2"
+            for cf, mask in ((cftyc, tycho), (cfhip, ~tycho)):
+                constellations[mask] = cf.find_many(stars['right_ascension'][mask], stars['declination'][mask])
+            for star_id, constellation in itertools.izip(stars['id'].tolist(), constellations.tolist()):
+                yield star_id, constellation or None
+            i += len(stars)
+
+    db.bulk_update("skymap_stars", "id", ["constellation"], updates())
 
     t2 = time.time()
     print
     print "{:.1f} s".format(t2 - t1)
 
 
-def select_stars(magnitude, constellation=None, ra_range=None, dec_range=None):
+def add_star_counts(db):
+    """
+    Writes the star counts per pixel and magnitude limit of the star column files.
+
+    :param db: An open SkyMapDatabase instance; not used, the counts are computed from the column files
+    """
+
+    export_star_counts(StarColumns())
+
+
+def add_star_tiles(db):
+    """
+    Builds the magnitude-layered tile pyramid from the star column files.
+
+    :param db: An open SkyMapDatabase instance; not used, the tiles are built from the column files
+    """
+
+    export_star_tiles(StarColumns())
+
+
+# The steps of build_star_database as (name, version, input catalogues, function). Increase the version of a step
+# when its function changes; the step and all steps after it are then run again on the next build.
+STAR_BUILD_STEPS = [
+    ("merge", 3, ["tyc2", "tyc2hd", "hiptyc"], merge_catalogues),
+    ("pixels", 1, [], add_pixels),
+    ("cross_index", 1, ["cross_index"], add_cross_index),
+    ("bsc", 1, ["bsc"], add_bright_star_catalog),
+    ("identifiers", 1, [], export_identifier_index),
+    ("proper_names", 2, [], add_proper_names),
+    ("constellations", 1, ["cst_id"], add_constellations),
+    ("pairs", 1, [], build_pairs_table),
+    ("groups", 1, [], build_groups_table),
+    ("columns", 1, [], export_star_columns),
+    ("tiles", 1, [], add_star_tiles),
+    ("counts", 1, [], add_star_counts)
+]
+
+
+def select_stars(magnitude, constellation=None, ra_range=None, dec_range=None, source="database", table=False):
     """
     Select a set of stars brighter than the given magnitude, based on coordinate range and/or constellation membership.
 
@@ -675,9 +1186,34 @@ def select_stars(magnitude, constellation=None, ra_range=None, dec_range=None):
     :param constellation: The constellation name; if given, only stars from that constellation are returned
     :param ra_range: The range (min_ra, max_ra) of right ascension to include, in degrees
     :param dec_range: The range (min_dec, max_dec) of declination to include, in degrees
-    :return: A list of Star objects
+    :param source: "database" to query the skymap_stars table, "columns" to use the memory-mapped column files,
+                   "tiles" to use the tile pyramid
+    :param table: If True, the stars are returned as a StarTable
+    :return: A list of Star objects, or a StarTable
     """
 
+    if ra_range:
+        min_ra, max_ra = ra_range
+        ra_range = (ensure_angle_range(min_ra), ensure_angle_range(max_ra))
+
+    if dec_range:
+        min_dec, max_dec = dec_range
+        if min_dec < -90 or min_dec > 90 or max_dec < -90 or max_dec > 90 or max_dec <= min_dec:
+            raise ValueError("Illegal DEC range!")
+
+    if source == "columns":
+        columns = get_star_columns()
+        indices = columns.select(magnitude, constellation, ra_range, dec_range)
+        if table:
+            return StarTable.from_columns(columns, indices)
+        return [Star(columns.row(i)) for i in indices]
+
+    if source == "tiles":
+        selection = get_star_tiles().select(magnitude, constellation, ra_range, dec_range)
+        if table:
+            return StarTable.concatenate([StarTable.from_columns(band, indices) for band, indices in selection])
+        return [Star(band.row(i)) for band, indices in selection for i in indices]
+
     # Build the query
     q = """SELECT * FROM skymap_stars WHERE magnitude<={0}""".format(magnitude)
 
@@ -686,9 +1222,6 @@ def select_stars(magnitude, constellation=None, ra_range=None, dec_range=None):
 
     if ra_range:
         min_ra, max_ra = ra_range
-        min_ra = ensure_angle_range(min_ra)
-        max_ra = ensure_angle_range(max_ra)
-
         if min_ra < max_ra:
             q += """ AND right_ascension>={0} AND right_ascension<={1}""".format(min_ra, max_ra)
         elif max_ra < min_ra:
@@ -699,21 +1232,29 @@ def select_stars(magnitude, constellation=None, ra_range=None, dec_range=None):
 
     if dec_range:
         min_dec, max_dec = dec_range
-
-        if min_dec < -90 or min_dec > 90 or max_dec < -90 or max_dec > 90 or max_dec <= min_dec:
-            raise ValueError("Illegal DEC range!")
         q += """ AND declination>={0} AND declination<={1}""".format(min_dec, max_dec)
 
+    if ra_range or dec_range:
+        # Restrict the query to the pixels covering the area, so it can use the pixel index. The depth of the cover is
+        # chosen to give a few ranges per side.
+        ra_size = 360.0
+        if ra_range:
+            ra_size = (ra_range[1] - ra_range[0]) % 360 or 360.0
+        dec_size = 180.0
+        if dec_range:
+            dec_size = dec_range[1] - dec_range[0]
+        depth = order_for_size(min(ra_size, dec_size) / 4.0)
+        q += """ AND """ + pixel_condition(cover_box(ra_range, dec_range, PIXEL_ORDER, depth))
+
     # Order stars from brightest to weakest so displaying them is easier
     q += """ ORDER BY magnitude ASC"""
 
     # Execute the query
-    db = SkyMapDatabase()
+    db = shared_database()
     rows = db.query(q)
-    result = [Star(row) for row in rows]
-    db.close()
-
-    return result
+    if table:
+        return StarTable.from_rows(rows)
+    return [Star(row) for row in rows]
 
 
 
@@ -732,12 +1273,12 @@ def sum_magnitudes(m1, m2):
     """
     Computes the combined magnitude of two separate stars. Used when combining multiples into one displayed star.
 
-    :param m1: Magnitude of first star
-    :param m2: Magnitude of second star
+    :param m1: Magnitude of first star; a number or an array
+    :param m2: Magnitude of second star; a number or an array
     :return: The combined magnitude
     """
 
-    return -2.5*math.log10(pow(10, -m1/2.5) + pow(10, -m2/2.5))
+    return -2.5*numpy.log10(numpy.power(10.0, -numpy.asarray(m1)/2.5) + numpy.power(10.0, -numpy.asarray(m2)/2.5))
 
 
 def get_stars_around_coordinate(ra, dec, angular_separation, db):
@@ -748,95 +1289,165 @@ def get_stars_around_coordinate(ra, dec, angular_separation, db):
     :param dec: The declination around which to search, in degrees
     :param angular_separation: The maximum distance from the coordinate to include, in seconds of arc
     :param db: An opened SkyMapDatabase instance
-    :return: A query result containing all found stars
+    :return: A list of star records, ordered by distance
     """
 
-    # Transform the angular separation from seconds of arc to (local) degrees. Multiply by 1.2 for extra margin
-    delta_ra = 1.2 * angular_separation / (3600.0 * math.cos(dec))
-    delta_de = 1.2 * angular_separation / 3600.0
+    rows, distances = cone_search_database(db, [ra], [dec], [angular_separation / 3600.0])[0]
+    return [rows[i] for i in numpy.argsort(distances, kind="mergesort")]
 
-    # Build the query
-    q = """SELECT * FROM skymap_stars WHERE """
 
-    if ra - delta_ra < 0:
-        q += """(right_ascension < {} OR right_ascension > {}) AND """.format(ra + delta_ra, ra - delta_ra + 360)
-    elif ra + delta_ra > 360:
-        q += """(right_ascension < {} OR right_ascension > {}) AND """.format(ra + delta_ra - 360, ra - delta_ra)
-    else:
-        q += """right_ascension > {} AND right_ascension < {} AND """.format(ra - delta_ra, ra + delta_ra)
+def cone_search(ra, dec, radius, magnitude=None, sort="distance", source="columns", table=False):
+    """
+    Selects the stars within a given distance from one or more coordinates.
+
+    Candidates are fetched with an index: the sorted declination column for the column files, or the pixel index for
+    the database. They are then filtered exactly by great-circle distance.
+
+    :param ra: The right ascension of the center, in degrees; a number, or an array for many cones
+    :param dec: The declination of the center, in degrees; a number or an array
+    :param radius: The radius, in degrees; a number or an array
+    :param magnitude: If given, only stars at least this bright are included
+    :param sort: "distance" to order the stars of each cone from near to far, "magnitude" from bright to weak
+    :param source: "columns" to use the memory-mapped column files, "database" to query the skymap_stars table
+    :param table: If True, the stars are returned as a StarTable
+    :return: A tuple (stars, distances) with a list of Star objects or a StarTable, and an array of distances in
+             degrees. For many cones, a list with a tuple per cone.
+    """
 
-    if dec - delta_de < -90:
-        q += """declination < {}""".format(dec + delta_de)
-    elif dec + delta_de > 90:
-        q += """declination > {}""".format(dec - delta_de)
+    if sort not in ("distance", "magnitude"):
+        raise ValueError("Unknown sort order {}".format(sort))
+
+    single = numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0 and numpy.ndim(radius) == 0
+    ra, dec, radius = [numpy.atleast_1d(numpy.asarray(x, dtype=numpy.float64)) for x in (ra, dec, radius)]
+    ra, dec, radius = numpy.broadcast_arrays(ra, dec, radius)
+
+    results = []
+    if source == "columns":
+        columns = get_star_columns()
+        for indices, distances in cone_search_columns(columns, ra, dec, radius, magnitude):
+            order = cone_order(distances, numpy.asarray(columns['magnitude'])[indices], sort)
+            indices = indices[order]
+            if table:
+                stars = StarTable.from_columns(columns, indices)
+            else:
+                stars = [Star(columns.row(i)) for i in indices]
+            results.append((stars, distances[order]))
+    elif source == "database":
+        for rows, distances in cone_search_database(shared_database(), ra, dec, radius, magnitude):
+            stars = [Star(row) for row in rows]
+            magnitudes = numpy.array([nan_if_none(s.magnitude) for s in stars], dtype=numpy.float64)
+            order = cone_order(distances, magnitudes, sort)
+            if table:
+                stars = StarTable.from_rows([rows[i] for i in order])
+            else:
+                stars = [stars[i] for i in order]
+            results.append((stars, distances[order]))
     else:
-        q += """declination > {} AND declination < {}""".format(dec - delta_de, dec + delta_de)
+        raise ValueError("Unknown source {}".format(source))
 
-    return db.query(q)
+    return results[0] if single else results
 
 
-def find_multiples(stars, criterion):
+def cone_order(distances, magnitudes, sort):
     """
-    Find all multiple stars for the given distance criterion.
+    Returns the order of the stars of a cone.
 
-    :param stars: A list of star database records
-    :param criterion: The angular separation below which stars are considered part of a multiple system
-    :return: ?
+    :param distances: Array of distances
+    :param magnitudes: Array of magnitudes, NaN if unknown
+    :param sort: "distance" to order from near to far, "magnitude" from bright to weak with unknown magnitudes last
+    :return: Array of indices
     """
 
-    db = SkyMapDatabase()
-    for s in stars:
-        candidates = get_stars_around_coordinate(s['right_ascension'], s['declination'], criterion, db)
-        for i, ci in enumerate(candidates):
-            for cj in candidates[i+1:]:
+    if sort == "magnitude":
+        return numpy.lexsort((distances, numpy.where(numpy.isnan(magnitudes), numpy.inf, magnitudes)))
+    return numpy.argsort(distances, kind="mergesort")
 
-                ra1 = ci['right_ascension']
-                de1 = ci['declination']
-                ra2 = cj['right_ascension']
-                de2 = cj['declination']
-                d = angular_separation_seconds_of_arc(ra1, de1, ra2, de2)
-                if d < criterion:
-                    #print "{}: {} - {} -> {}".format(current_process().name, ci['id'], cj['id'], d)
-                    pass
 
+def cone_search_columns(columns, ra, dec, radius, magnitude=None):
+    """
+    Selects the stars of the column files within each of the given cones. The declination band of each cone is
+    resolved with a binary search on the sorted declination column.
+
+    :param columns: A StarColumns instance
+    :param ra: Array of right ascensions of the centers, in degrees
+    :param dec: Array of declinations of the centers, in degrees
+    :param radius: Array of radii, in degrees
+    :param magnitude: If given, only stars at least this bright are included
+    :return: A list with for each cone a tuple (indices, distances) of arrays, in the order of the column files
+    """
 
-def chunks(l, n):
+    declination = columns['declination']
+    results = []
+    for c_ra, c_dec, c_radius in zip(ra.tolist(), dec.tolist(), radius.tolist()):
+        start = numpy.searchsorted(declination, c_dec - c_radius, side="left")
+        stop = numpy.searchsorted(declination, c_dec + c_radius, side="right")
+        distances = angular_distances(c_ra, c_dec, columns['right_ascension'][start:stop], declination[start:stop])
+        mask = distances <= c_radius
+        if magnitude is not None:
+            mask &= columns['magnitude'][start:stop] <= magnitude
+        indices = numpy.flatnonzero(mask)
+        results.append((start + indices, distances[indices]))
+    return results
+
+
+def cone_search_database(db, ra, dec, radius, magnitude=None):
     """
-    Yield n successive chunks from l.
+    Selects the stars of the skymap_stars table within each of the given cones. The candidates of all cones are
+    fetched in a single query on the pixel index.
 
-    :param l: The list to divide in chunks
-    :param n: The number of chunks to divide the list into
-    :return: A generator
+    :param db: An open SkyMapDatabase instance
+    :param ra: Array of right ascensions of the centers, in degrees
+    :param dec: Array of declinations of the centers, in degrees
+    :param radius: Array of radii, in degrees
+    :param magnitude: If given, only stars at least this bright are included
+    :return: A list with for each cone a tuple (rows, distances), with rows a list of star records
     """
 
-    newn = int(1.0 * len(l) / n + 0.5)
-    for i in xrange(0, n-1):
-        yield l[i*newn:i*newn+newn]
-    yield l[n*newn-newn:]
+    covers = [cover_cap(c_ra, c_dec, c_radius, PIXEL_ORDER, order_for_size(c_radius))
+              for c_ra, c_dec, c_radius in zip(ra, dec, radius)]
+    ranges = merge_ranges([r for c in covers for r in c])
 
+    q = """SELECT * FROM skymap_stars WHERE right_ascension IS NOT NULL AND declination IS NOT NULL AND """ + pixel_condition(ranges)
+    if magnitude is not None:
+        q += """ AND COALESCE(hp_magnitude, vt_magnitude, johnsonV) <= {}""".format(magnitude)
+    rows = db.query(q)
 
+    # Sort the candidates by pixel, so the candidates of each pixel range are a slice
+    pixels = numpy.array([row['pixel'] for row in rows], dtype=numpy.int64)
+    order = numpy.argsort(pixels, kind="mergesort")
+    pixels = pixels[order]
+    candidate_ra = numpy.array([row['right_ascension'] for row in rows], dtype=numpy.float64)[order]
+    candidate_dec = numpy.array([row['declination'] for row in rows], dtype=numpy.float64)[order]
 
-if __name__ == "__main__":
-    #build_star_database()
+    results = []
+    for c_ra, c_dec, c_radius, c in zip(ra, dec, radius, covers):
+        candidates = numpy.concatenate(
+            [numpy.arange(numpy.searchsorted(pixels, start), numpy.searchsorted(pixels, stop)) for start, stop in c] or [numpy.zeros(0, dtype=numpy.int64)]
+        ).astype(numpy.int64)
+        distances = angular_distances(c_ra, c_dec, candidate_ra[candidates], candidate_dec[candidates])
+        mask = distances <= c_radius
+        results.append(([rows[i] for i in order[candidates[mask]].tolist()], distances[mask]))
+    return results
 
-    nprocs = 100 # Optimum seems to be around 40: must have something to do with the database I suppose
-    n = nprocs * 500
-    criterion = 100
-    db = SkyMapDatabase()
-    stars = db.query("""SELECT id, right_ascension, declination FROM skymap_stars LIMIT {}""".format(n))
-    print len(stars)
 
-    procs = []
+def find_multiples(stars, criterion):
+    """
+    Find all multiple stars for the given distance criterion.
 
-    t1 = time.time()
-    for i, l in enumerate(chunks(stars, nprocs)):
-        print len(l)
-        p = Process(target=find_multiples, args=(l, criterion), name="Chunk #{}".format(i+1))
-        procs.append(p)
-        p.start()
+    :param stars: A list of star database records
+    :param criterion: The angular separation below which stars are considered part of a multiple system, in seconds of arc
+    :return: A list of (id1, id2, separation) tuples, with the separation in seconds of arc
+    """
 
-    for p in procs:
-        p.join()
+    ra = numpy.array([s['right_ascension'] for s in stars], dtype=numpy.float64)
+    dec = numpy.array([s['declination'] for s in stars], dtype=numpy.float64)
+    i, j, separation = find_pairs(ra, dec, criterion)
+    return [(stars[a]['id'], stars[b]['id'], d) for a, b, d in zip(i.tolist(), j.tolist(), separation.tolist())]
 
-    print "Time: {} s".format(time.time()-t1)
 
+if __name__ == "__main__":
+    #build_star_database()
+
+    t1 = time.time()
+    build_pairs_table(SkyMapDatabase(), criterion=100)
+    print "Time: {} s".format(time.time()-t1)
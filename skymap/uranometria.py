@@ -171,7 +171,7 @@ def rightlegend(figure, chart_number, min_longitude, max_longitude, min_latitude
     # Constellations
     l.draw_line(Line(Point(178, 1.5), Point(178, LEGEND_HEIGHT-1.5)))
 
-    constellations = constellations_in_area(min_longitude, max_longitude, min_latitude, max_latitude, nsamples=10000)
+    constellations = constellations_in_area(min_longitude, max_longitude, min_latitude, max_latitude)
     l.draw_label(Label(Point(187.5, 5.0), "\\condensed\\textbf{{{}}}".format(constellations[0].upper()), 90, "LARGE"))
     if len(constellations) > 1:
         l.draw_label(Label(Point(187.5, 1.5), "\\condensed\\textbf{{{}}}".format(", ".join(constellations[1:4]).upper()), 90, "small"))
@@ -6,15 +6,25 @@ import ftplib
 import urllib
 import types
 import gzip
-from functools import partial
+import itertools
+import threading
+import Queue
+import numpy
+import multiprocessing
+from multiprocessing import Pool
 
-from skymap.database import SkyMapDatabase
+from skymap.database import SkyMapDatabase, open_database
+from skymap.manifest import BuildManifest, fingerprint
 
 
 VIZIER_SERVER = "cdsarc.u-strasbg.fr"
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "data")
 BYTE_PATTERN = re.compile("^\s*(\d+)(\-\s*(\d+))?\s+(([A-Z])\d*(\.\d+)?)\s+\S+\s+(\S+)\s")
 VIZIER_FORMATS = {"I": int, "A": str, "F": float}
+NUMPY_FORMATS = {int: numpy.int64, float: numpy.float64}
+
+# Increase to reload all catalogue tables when the way they are loaded changes
+INGEST_VERSION = 1
 
 
 def parse_readme(foldername):
@@ -60,52 +70,332 @@ def parse_readme(foldername):
     return datadicts
 
 
+def compile_record_dtype(datadicts, itemsize=None):
+    """
+    Compiles the byte-by-byte description of a data file into a NumPy dtype, with one fixed-width string field per
+    column at the offset of that column in the record.
+
+    :param datadicts: The column descriptions of the file, as returned by parse_readme
+    :param itemsize: The record size in bytes; defaults to the end of the last column
+    :return: The NumPy dtype
+    """
+
+    if itemsize is None:
+        itemsize = max(d['stopbyte'] for d in datadicts)
+    return numpy.dtype({
+        'names': ["f{}".format(i) for i in range(len(datadicts))],
+        'formats': ["S{}".format(d['stopbyte'] - d['startbyte']) for d in datadicts],
+        'offsets': [d['startbyte'] for d in datadicts],
+        'itemsize': itemsize
+    })
+
+
+def convert_field(s, t):
+    """
+    Converts a single field to the given type. Blank and invalid numbers become None.
+
+    :param s: The field
+    :param t: The type (int, float or str)
+    :return: The converted value
+    """
+
+    if t is str:
+        return s
+    if not s.strip():
+        return None
+    try:
+        return t(s)
+    except ValueError:
+        return None
+
+
+def decode_records(lines, datadicts):
+    """
+    Decodes a block of fixed-width records at once.
+
+    :param lines: The records, as read from the data file
+    :param datadicts: The column descriptions of the file, as returned by parse_readme
+    :return: A list with a NumPy array per column; numerical columns are masked arrays with blank and invalid fields
+             masked
+    """
+
+    width = max(d['stopbyte'] for d in datadicts)
+    buf = "".join(lines)
+    linesize = len(lines[0])
+    if linesize > width and len(buf) == linesize * len(lines) and buf.count("\n") == len(lines):
+        # All records have the same length: decode the block in place
+        dtype = compile_record_dtype(datadicts, linesize)
+    else:
+        # Pad short records with NUL bytes, which NumPy strips from string fields
+        dtype = compile_record_dtype(datadicts, width)
+        buf = "".join(l.rstrip("\n")[:width].ljust(width, "\0") for l in lines)
+    records = numpy.frombuffer(buf, dtype)
+
+    columns = []
+    for i, d in enumerate(datadicts):
+        field = records["f{}".format(i)]
+        t = d['format']
+        if t is str:
+            columns.append(field)
+            continue
+
+        stripped = numpy.char.strip(field)
+        blank = stripped == ""
+        try:
+            values = numpy.where(blank, "0", stripped).astype(NUMPY_FORMATS[t])
+            columns.append(numpy.ma.masked_array(values, blank))
+        except ValueError:
+            # The column contains invalid values: convert field by field
+            values = [convert_field(v, t) for v in field.tolist()]
+            mask = [v is None for v in values]
+            values = [0 if v is None else v for v in values]
+            columns.append(numpy.ma.masked_array(numpy.array(values, dtype=NUMPY_FORMATS[t]), mask))
+    return columns
+
+
+def parse_records(lines, datadicts):
+    """
+    Parses a block of fixed-width records into database rows.
+
+    :param lines: The records, as read from the data file
+    :param datadicts: The column descriptions of the file, as returned by parse_readme
+    :return: A list of rows, with None for blank and invalid numbers
+    """
+
+    if not lines:
+        return []
+    return zip(*[c.tolist() for c in decode_records(lines, datadicts)])
+
+
+def open_datafile(filepath):
+    """
+    Opens a data file for reading.
+
+    :param filepath: The path of the data file
+    :return: A tuple (fp, raw) of the file to read records from and the underlying file on disk. The position of the
+             latter is the number of (compressed) bytes read so far.
+    """
+
+    ext = os.path.splitext(filepath)[-1]
+    if ext not in ['.z', '.gz', '.dat']:
+        raise IOError("Unsupported file type {}".format(ext))
+
+    raw = open(filepath, "rb")
+    if ext == ".dat":
+        return raw, raw
+    return gzip.GzipFile(fileobj=raw), raw
+
+
+def iter_record_blocks(fp, datadicts, batchsize=1000):
+    """
+    Reads and parses the records from an open data file in blocks.
+
+    :param fp: The open data file
+    :param datadicts: The column descriptions of the file, as returned by parse_readme
+    :param batchsize: The number of records per block
+    :return: A generator of lists of rows
+    """
+
+    while True:
+        lines = list(itertools.islice(fp, batchsize))
+        if not lines:
+            break
+        yield parse_records(lines, datadicts)
+
+
+def iter_datafile_blocks(filepath, datadicts, batchsize=1000):
+    """
+    Reads a data file in a single pass and parses its records in blocks.
+
+    :param filepath: The path of the data file
+    :param datadicts: The column descriptions of the file, as returned by parse_readme
+    :param batchsize: The number of records per block
+    :return: A generator of (rows, progress) tuples, with progress the fraction of the file on disk read so far
+    """
+
+    size = float(max(os.path.getsize(filepath), 1))
+    fp, raw = open_datafile(filepath)
+    try:
+        for rows in iter_record_blocks(fp, datadicts, batchsize):
+            yield rows, min(raw.tell() / size, 1.0)
+    finally:
+        fp.close()
+        raw.close()
+
+
+def prefetch(iterable, depth=8):
+    """
+    Iterates over the iterable in a background thread, running at most depth items ahead of the consumer. Used to
+    overlap decompression and parsing with database inserts. The background thread stops when the consumer stops
+    iterating, also when it raises.
+
+    :param iterable: The iterable
+    :param depth: The maximum number of items waiting to be consumed
+    :return: A generator of the items of iterable
+    """
+
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for room in the queue, unless the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+
+
 def parse_datafile(db, foldername, filename, table, datadicts, columns):
     print
     print "Parsing", filename
 
     filepath = os.path.join(DATA_FOLDER, foldername, filename)
-    ext = os.path.splitext(filepath)[-1]
-    if ext in ['.z', '.gz']:
-        fp = gzip.open(filepath)
-        rewind = fp.rewind
-    elif ext == ".dat":
-        fp = open(filepath)
-        rewind = partial(fp.seek, 0)
-    else:
-        raise IOError("Unsupported file type {}".format(ext))
 
-    # Read number of records and rewind to start
-    nrecords = len(fp.readlines())
-    rewind()
-
-    batchsize = 1000
-    batch = []
-    for i, line in enumerate(fp):
-        sys.stdout.write("\r{0:.1f}%".format(i * 100.0 / (nrecords - 1)))
-        sys.stdout.flush()
-        values = []
-        for d in datadicts:
-            s = line[d['startbyte']:d['stopbyte']]
-            if s and s[-1] == "\n":
-                s = s[:-1]
-            t = d['format']
-            if not s and t is not str:
-                v = None
-            else:
-                try:
-                    v = t(s)
-                except ValueError:
-                    v = None
-                # if t == str:
-                #     v = v.rstrip("\n")
-            values.append(v)
-        batch.append(values)
-        if len(batch) == batchsize:
-            db.insert_rows(table, columns, batch)
-            batch = []
-    if batch:
-        db.insert_rows(table, columns, batch)
+    def records():
+        for rows, progress in prefetch(iter_datafile_blocks(filepath, datadicts)):
+            for row in rows:
+                yield row
+            sys.stdout.write("\r{0:.1f}%".format(100.0 * progress))
+            sys.stdout.flush()
+
+    db.bulk_load(table, columns, records())
+
+
+def decode_datafile(job):
+    """
+    Parses a data file in blocks.
+
+    :param job: A tuple (foldername, filename, table, datadicts)
+    :return: A generator of (table, rows) tuples
+    """
+
+    foldername, filename, table, datadicts = job
+    filepath = os.path.join(DATA_FOLDER, foldername, filename)
+    for rows, progress in iter_datafile_blocks(filepath, datadicts):
+        yield table, rows
+
+
+# The queue through which the worker processes of load_datafiles_parallel pass their blocks
+_block_queue = None
+
+
+def init_decoder(queue):
+    global _block_queue
+    _block_queue = queue
+
+
+def stream_datafile(job):
+    """
+    Parses a data file and puts its blocks on the block queue, one at a time; used by the worker processes of
+    load_datafiles_parallel. As the queue is bounded, a worker waits while the writers are behind.
+
+    :param job: A tuple (foldername, filename, table, datadicts)
+    :return: A tuple (filename, n) with n the number of records
+    """
+
+    n = 0
+    for table, rows in decode_datafile(job):
+        _block_queue.put((table, rows))
+        n += len(rows)
+    return job[1], n
+
+
+def write_blocks(queue, table_columns, errors, database=open_database):
+    """
+    Loads the blocks of rows put on the queue until None is received; used by the writer threads of
+    load_datafiles_parallel.
+
+    :param queue: A queue of (table, rows) tuples
+    :param table_columns: Dictionary with the column names for each table
+    :param errors: List to which an exception is appended if inserting fails
+    :param database: Function returning a new database connection
+    """
+
+    db = database()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if errors:
+                # Another writer failed: only drain the queue
+                continue
+            table, rows = item
+            try:
+                db.bulk_load(table, table_columns[table], rows)
+            except Exception as e:
+                errors.append(e)
+    finally:
+        db.close()
+
+
+def load_datafiles_parallel(jobs, table_columns, processes=None, writers=2, depth=8, database=open_database):
+    """
+    Decodes data files in parallel worker processes and bulk loads their blocks through a fixed number of writer
+    connections. The blocks pass through a bounded queue, so at most depth blocks per writer are in flight.
+
+    :param jobs: List of (foldername, filename, table, datadicts) tuples
+    :param table_columns: Dictionary with the column names for each table
+    :param processes: The number of decoding processes; defaults to the number of CPUs
+    :param writers: The number of writer connections
+    :param depth: The number of blocks per writer that may wait to be loaded
+    :param database: Function returning a new database connection, called once per writer
+    :return: The number of records inserted
+    """
+
+    queue = multiprocessing.Queue(maxsize=depth * writers)
+
+    # The worker processes are forked before any thread is started in this process
+    pool = Pool(processes, initializer=init_decoder, initargs=(queue,))
+
+    errors = []
+    threads = [threading.Thread(target=write_blocks, args=(queue, table_columns, errors, database)) for i in range(writers)]
+    for t in threads:
+        t.start()
+
+    nrecords = 0
+    try:
+        for filename, n in pool.imap_unordered(stream_datafile, jobs):
+            print "Decoded {} ({} records)".format(filename, n)
+            nrecords += n
+    finally:
+        pool.close()
+        pool.join()
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return nrecords
 
 
 def get_files(catalogue, foldername):
@@ -140,17 +430,45 @@ def get_files(catalogue, foldername):
     return files
 
 
-def build_database(catalogue, foldername, indices=(), extra_function=None):
+def build_database(catalogue, foldername, indices=(), extra_function=None, processes=None, writers=2, force=False):
+    """
+    Downloads a VizieR catalogue and loads each of its data files into a database table.
+
+    The checksums of the ReadMe and data files are recorded in the build manifest, and only the tables whose input
+    files, columns or indices changed since the last completed load are dropped and reloaded. When a table changed and
+    there is an extra function, all tables of the catalogue are reloaded before it is called, as it alters them.
+
+    :param catalogue: The VizieR catalogue identifier, e.g. "I/259"
+    :param foldername: The local folder name, also used as table name prefix
+    :param indices: The columns to index
+    :param extra_function: Function to call after loading
+    :param processes: If given, the data files are decoded in this many worker processes (0 for one per CPU) and the
+                      indices are created after all files are loaded
+    :param writers: The number of writer connections used with parallel decoding
+    :param force: If True, all tables are reloaded
+    """
+
     print
     print "Building database for {} ({})".format(catalogue, foldername)
     t1 = time.time()
     files = get_files(catalogue, foldername)
 
     datadicts = parse_readme(foldername)
-    db = SkyMapDatabase()
-    for f, dds in datadicts.items():
+    db = open_database()
+    manifest = BuildManifest(db)
+    readme_checksum = manifest.file_checksum(os.path.join(DATA_FOLDER, foldername, "ReadMe"))
+    catalogue_entry = "catalogue:{}".format(foldername)
+    if manifest.get(catalogue_entry) == "running":
+        # The extra function was interrupted, which leaves the tables in an unknown state
+        force = True
+
+    parallel = processes is not None
+    jobs = []
+    table_columns = {}
+    table_fingerprints = {}
+    tables = []
+    for f, dds in sorted(datadicts.items()):
         table = "{}_{}".format(foldername, f.split(".")[0])
-        db.drop_table(table)
 
         columns = []
         lc_columns = []
@@ -171,23 +489,71 @@ def build_database(catalogue, foldername, indices=(), extra_function=None):
             columns.append(c)
             datatypes.append(dd['format'])
 
+        real_files = sorted(fn for fn in files if fn.startswith(f))
+        table_indices = [ind for ind in indices if ind in columns]
+        checksums = [manifest.file_checksum(os.path.join(DATA_FOLDER, foldername, fn)) for fn in real_files]
+        table_fingerprints[table] = fingerprint(
+            INGEST_VERSION, readme_checksum, columns, datatypes, table_indices, zip(real_files, checksums)
+        )
+        tables.append((table, columns, datatypes, real_files, dds, table_indices))
+
+    stale = [table for table, fp in table_fingerprints.items() if force or manifest.get("table:{}".format(table)) != fp]
+    if extra_function and stale:
+        # The extra function alters the tables, so it is rerun on freshly loaded tables only
+        stale = table_fingerprints.keys()
+
+    for table, columns, datatypes, real_files, dds, table_indices in tables:
+        if table not in stale:
+            print "Skipping {}: up to date".format(table)
+            continue
+
+        manifest.forget(catalogue_entry)
+        manifest.forget("table:{}".format(table))
+        db.drop_table(table)
         db.create_table(table, columns, datatypes)
+        table_columns[table] = columns
+
+        if parallel:
+            jobs.extend((foldername, real_file, table, dds) for real_file in real_files)
+            continue
 
-        real_files = [fn for fn in files if fn.startswith(f)]
         for real_file in real_files:
             parse_datafile(db, foldername, real_file, table, dds, columns)
-        for ind in indices:
-            if ind in columns:
-                db.add_index(table, ind)
+        for ind in table_indices:
+            db.add_index(table, ind)
+        manifest.set("table:{}".format(table), table_fingerprints[table])
+
+    if parallel and table_columns:
+        t_load = time.time()
+        nrecords = load_datafiles_parallel(jobs, table_columns, processes or None, writers)
+        t_loaded = time.time()
+
+        print "Adding indices"
+        for table, columns in table_columns.items():
+            for ind in indices:
+                if ind in columns:
+                    db.add_index(table, ind)
+            manifest.set("table:{}".format(table), table_fingerprints[table])
+
+        nbytes = sum(os.path.getsize(os.path.join(DATA_FOLDER, job[0], job[1])) for job in jobs)
+        dt = max(t_loaded - t_load, 1e-6)
+        print
+        print "Loaded {} records from {} files ({:.1f} MB) in {:.1f} s".format(nrecords, len(jobs), nbytes / 1e6, dt)
+        print "Throughput: {:.0f} records/s, {:.2f} MB/s".format(nrecords / dt, nbytes / 1e6 / dt)
+        print "Indices: {:.1f} s".format(time.time() - t_loaded)
+
+    catalogue_fingerprint = fingerprint(*sorted(table_fingerprints.items()))
+    if manifest.get(catalogue_entry) != catalogue_fingerprint:
+        if extra_function:
+            manifest.set(catalogue_entry, "running")
+            extra_function()
+        manifest.set(catalogue_entry, catalogue_fingerprint)
 
     t2 = time.time()
     print
     print
     print "Time: {} s".format(t2-t1)
 
-    if extra_function:
-        extra_function()
-
 
 def split_tyc():
     db = SkyMapDatabase()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.database import open_database
+from skymap.healpix import PIXEL_ORDER, ang2pix, npix, to_vectors
+from skymap.star_columns import StarColumns, STAR_COLUMNS, rows_to_columns
+from skymap.stars import angular_distances, angular_sep_to_local_degrees, cone_order, cone_search_columns, cone_search_database
+from skymap.stars import get_stars_around_coordinate, pixel_condition
+from test_star_columns import star_row
+
+
+def brute_force(ra, dec, radius, star_ra, star_dec):
+    vectors = to_vectors(star_ra, star_dec)
+    d = numpy.degrees(numpy.arccos(numpy.clip(vectors.dot(to_vectors(ra, dec)[0]), -1, 1)))
+    return numpy.flatnonzero(d <= radius)
+
+
+class AngularDistanceTest(unittest.TestCase):
+    def test_angular_distances(self):
+        d = angular_distances(10.0, 20.0, [10.0, 190.0, 370.0], [21.0, -20.0, 20.0])
+        self.assertAlmostEqual(d[0], 1.0, 10)
+        self.assertAlmostEqual(d[1], 180.0, 10)
+        self.assertAlmostEqual(d[2], 0.0, 10)
+
+    def test_local_degrees(self):
+        ra_degrees, dec_degrees = angular_sep_to_local_degrees(0.0, 60.0, 3600.0)
+        self.assertAlmostEqual(ra_degrees, 2.0, 10)
+        self.assertAlmostEqual(dec_degrees, 1.0, 10)
+
+    def test_cone_order(self):
+        distances = numpy.array([0.3, 0.1, 0.2, 0.4])
+        magnitudes = numpy.array([5.0, numpy.nan, 5.0, 1.0])
+        self.assertEqual(list(cone_order(distances, magnitudes, "distance")), [1, 2, 0, 3])
+        self.assertEqual(list(cone_order(distances, magnitudes, "magnitude")), [3, 2, 0, 1])
+
+
+class ConeSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(5)
+        n = 2000
+        self.ra = rng.uniform(0, 360, n)
+        self.dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, n)))
+        self.magnitude = rng.uniform(0, 12, n)
+
+        # Column files are sorted by declination
+        order = numpy.argsort(self.dec)
+        self.ra, self.dec, self.magnitude = self.ra[order], self.dec[order], self.magnitude[order]
+        rows = [star_row(i + 1, self.ra[i], self.dec[i], self.magnitude[i]) for i in range(n)]
+        columns = rows_to_columns(rows)
+        for name, dtype in STAR_COLUMNS:
+            numpy.save(os.path.join(self.folder, "{}.npy".format(name)), columns[name])
+        self.columns = StarColumns(self.folder)
+
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+        names = ["id", "right_ascension", "declination", "hp_magnitude", "pixel"]
+        self.db.create_table("skymap_stars", names, [int, float, float, float, int])
+        pixels = ang2pix(self.ra, self.dec)
+        self.db.insert_rows("skymap_stars", names, [
+            [i + 1, self.ra[i], self.dec[i], self.magnitude[i], int(pixels[i])] for i in range(n)
+        ])
+
+        self.cones = [(10.0, 20.0, 15.0), (359.0, -5.0, 8.0), (123.0, 89.0, 3.0), (200.0, -60.0, 0.5)]
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_columns(self):
+        ra, dec, radius = [numpy.array(x) for x in zip(*self.cones)]
+        results = cone_search_columns(self.columns, ra, dec, radius)
+        for (c_ra, c_dec, c_radius), (indices, distances) in zip(self.cones, results):
+            self.assertEqual(sorted(indices), list(brute_force(c_ra, c_dec, c_radius, self.ra, self.dec)))
+            self.assertTrue((distances <= c_radius).all())
+
+    def test_magnitude(self):
+        indices, distances = cone_search_columns(self.columns, numpy.array([10.0]), numpy.array([20.0]), numpy.array([30.0]), 6.0)[0]
+        expected = brute_force(10.0, 20.0, 30.0, self.ra, self.dec)
+        self.assertEqual(sorted(indices), [i for i in expected if self.magnitude[i] <= 6.0])
+
+    def test_database(self):
+        ra, dec, radius = [numpy.array(x) for x in zip(*self.cones)]
+        results = cone_search_database(self.db, ra, dec, radius)
+        for (c_ra, c_dec, c_radius), (rows, distances) in zip(self.cones, results):
+            expected = brute_force(c_ra, c_dec, c_radius, self.ra, self.dec)
+            self.assertEqual(sorted(r['id'] - 1 for r in rows), list(expected))
+            self.assertEqual(len(distances), len(rows))
+
+    def test_pixel_condition(self):
+        q = """SELECT COUNT(*) AS n FROM skymap_stars WHERE """
+        self.assertEqual(self.db.query(q + pixel_condition([]))[0]['n'], 0)
+        self.assertEqual(self.db.query(q + pixel_condition([(0, npix(PIXEL_ORDER))]))[0]['n'], len(self.ra))
+
+    def test_stars_around_coordinate(self):
+        rows = get_stars_around_coordinate(10.0, 20.0, 15.0 * 3600, self.db)
+        self.assertEqual(sorted(r['id'] - 1 for r in rows), list(brute_force(10.0, 20.0, 15.0, self.ra, self.dec)))
+        distances = angular_distances(10.0, 20.0, [r['right_ascension'] for r in rows], [r['declination'] for r in rows])
+        self.assertTrue((numpy.diff(distances) >= 0).all())
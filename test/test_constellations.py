@@ -1,7 +1,224 @@
+import os
+import shutil
+import tempfile
 import unittest
+import numpy
 from skymap.geometry import SphericalPoint
+from skymap.coordinates import PrecessionCalculator, REFERENCE_EPOCH
+from skymap.database import open_database
+from skymap.constellations import ConstellationZones, ConstellationFinder, CONST_BOUND_EPOCH, constellation_areas, box_loops
+from skymap.constellations import BoundaryEdge, build_constellation_boundary_database, edge_key, POLYGONS_TABLE
+from skymap.constellations import ConstellationBoundaries
+
+
+def first_match(ra_low, ra_up, de_low, constellations, ra, dec):
+    for z in range(len(de_low)):
+        if de_low[z] < dec and ra_low[z] <= ra / 15.0 < ra_up[z]:
+            return constellations[z].lower()
+    return ""
 
 
 class TestBoundaryEdge(unittest.TestCase):
     def test_interpolation(self):
         pass
+
+
+def quadratic_edges(rows):
+    # The original all-pairs construction of the extended edges
+    edges = []
+    prev_point = None
+    for row in rows:
+        if not row[3]:
+            prev_point = None
+        point = SphericalPoint(15.0 * row[0], row[1])
+        if prev_point is not None:
+            e = BoundaryEdge(prev_point, point)
+            if e not in edges:
+                edges.append(e)
+        prev_point = point
+    for i, e1 in enumerate(edges):
+        for e2 in edges[i + 1:]:
+            e1.connect(e2)
+    result = []
+    for e in edges:
+        ee = e.extended_edge
+        if ee not in result:
+            result.append(ee)
+    return result
+
+
+class TestBoundaryDatabase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+
+        # Two boxes sharing the meridian at 2h, the first one in two runs, the second one crossing 0h
+        self.rows = [
+            (0.0, 0.0, "AAA", 0), (1.0, 0.0, "AAA", 1), (2.0, 0.0, "AAA", 1), (2.0, 10.0, "AAA", 1), (2.0, 20.0, "AAA", 1),
+            (1.0, 20.0, "AAA", 0), (0.0, 20.0, "AAA", 1), (0.0, 10.0, "AAA", 1), (0.0, 0.0, "AAA", 1),
+            (2.0, 20.0, "AAA", 0), (1.0, 20.0, "AAA", 1),
+            (2.0, 0.0, "BBB", 0), (4.0, 0.0, "BBB", 1), (4.0, 20.0, "BBB", 1), (2.0, 20.0, "BBB", 1),
+            (2.0, 10.0, "BBB", 1), (2.0, 0.0, "BBB", 1),
+            (23.0, -10.0, "CCC", 0), (1.0, -10.0, "CCC", 1), (1.0, -5.0, "CCC", 1), (23.0, -5.0, "CCC", 1),
+            (23.0, -10.0, "CCC", 1),
+        ]
+        self.db.create_table("cst_bound_constbnd", ["RAhr", "DEdeg", "cst", "adj"], [float, float, str, int])
+        self.db.insert_rows("cst_bound_constbnd", ["RAhr", "DEdeg", "cst", "adj"], self.rows)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_edges(self):
+        build_constellation_boundary_database(self.db, self.folder)
+        edges = self.db.query("""SELECT * FROM skymap_constellation_boundaries ORDER BY pk""")
+        result = [edge_key(BoundaryEdge(SphericalPoint(e['ra1'], e['dec1']), SphericalPoint(e['ra2'], e['dec2']))) for e in edges]
+        self.assertEqual(result, [edge_key(e) for e in quadratic_edges(self.rows)])
+        self.assertIn(edge_key(BoundaryEdge(SphericalPoint(30.0, 0.0), SphericalPoint(30.0, 20.0))), result)
+
+    def test_polygons(self):
+        build_constellation_boundary_database(self.db, self.folder)
+        points = self.db.query("""SELECT * FROM {} ORDER BY polygon, point""".format(POLYGONS_TABLE))
+        polygons = {}
+        for p in points:
+            polygons.setdefault((p['constellation'], p['polygon']), []).append((round(p['ra'], 6), round(p['dec'], 6)))
+        self.assertEqual(sorted(c for c, i in polygons), ["aaa", "bbb", "ccc"])
+        for (c, i), polygon in polygons.items():
+            self.assertEqual(polygon[0], polygon[-1])
+        aaa = [polygon for (c, i), polygon in polygons.items() if c == "aaa"][0]
+        self.assertEqual(len(aaa), 9)
+        self.assertEqual(len(set(aaa)), 8)
+
+
+class TestConstellationBoundaries(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+        self.rows = [
+            (10.0, 20.0, 10.0, 35.5), (10.0, 35.5, 40.25, 35.5), (355.5, -10.0, 2.0, -10.0), (120.0, -60.0, 120.0, -75.0)
+        ]
+        self.db.create_table("skymap_constellation_boundaries", ["ra1", "dec1", "ra2", "dec2"], [float, float, float, float])
+        self.db.insert_rows("skymap_constellation_boundaries", ["ra1", "dec1", "ra2", "dec2"], self.rows)
+        self.boundaries = ConstellationBoundaries.from_database(self.db)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_precession(self):
+        boundaries = self.boundaries.precessed(REFERENCE_EPOCH)
+        pc = PrecessionCalculator(CONST_BOUND_EPOCH, REFERENCE_EPOCH)
+        for i, row in enumerate(self.rows):
+            expected = BoundaryEdge(SphericalPoint(row[0], row[1]), SphericalPoint(row[2], row[3]))
+            expected.precess(pc)
+            e = boundaries.edge(i)
+            self.assertEqual(e.epoch, REFERENCE_EPOCH)
+            self.assertEqual(len(e.interpolated_points), len(expected.interpolated_points))
+            for p, q in zip(e.interpolated_points, expected.interpolated_points):
+                self.assertAlmostEqual(p.ra, q.ra, 9)
+                self.assertAlmostEqual(p.dec, q.dec, 9)
+
+    def test_save(self):
+        path = os.path.join(self.folder, "boundaries", "boundaries.npz")
+        boundaries = self.boundaries.precessed(REFERENCE_EPOCH)
+        boundaries.save(path)
+        loaded = ConstellationBoundaries.load(path)
+        self.assertEqual(loaded.epoch, REFERENCE_EPOCH)
+        self.assertTrue(numpy.array_equal(loaded.ra, boundaries.ra))
+        self.assertTrue(numpy.array_equal(loaded.offsets, boundaries.offsets))
+
+    def test_edges_in_area(self):
+        self.assertEqual(list(self.boundaries.edges_in_area(0, 30, 0, 30)), [0])
+        self.assertEqual(list(self.boundaries.edges_in_area(0, 45, 30, 40)), [0, 1])
+        self.assertEqual(list(self.boundaries.edges_in_area(350, 5, -20, 0)), [2])
+        self.assertEqual(list(self.boundaries.edges_in_area(0, 0, -90, -70)), [3])
+
+    def test_crossing_edges(self):
+        # Areas between the interpolated points of an edge
+        self.assertEqual(list(self.boundaries.edges_in_area(20.2, 20.8, 35, 36)), [1])
+        self.assertEqual(list(self.boundaries.edges_in_area(9.5, 10.5, 25.2, 25.8)), [0])
+        self.assertEqual(list(self.boundaries.edges_in_area(359.2, 359.8, -11, -9)), [2])
+        self.assertEqual(list(self.boundaries.edges_in_area(-0.9, -0.1, -11, -9)), [2])
+        self.assertEqual(list(self.boundaries.edges_in_area(20.2, 20.8, 36, 37)), [])
+
+
+class TestConstellationZones(unittest.TestCase):
+    def setUp(self):
+        # Zones in Delporte order: from north to south, but with overlaps so the table order matters
+        self.ra_low = [0.0, 6.0, 0.0, 3.0, 12.0, 0.0, 0.0]
+        self.ra_up = [24.0, 12.0, 6.0, 9.0, 24.0, 24.0, 12.0]
+        self.de_low = [80.0, 30.0, 30.0, 0.0, 0.0, -30.0, -90.0]
+        self.constellations = ["UMi", "UMa", "Cas", "Ori", "Vir ", "Hya", "Oct"]
+        self.zones = ConstellationZones(self.ra_low, self.ra_up, self.de_low, self.constellations)
+
+    def test_first_match(self):
+        rng = numpy.random.RandomState(11)
+        ra = numpy.concatenate((rng.uniform(0, 360, 2000), [0.0, 45.0, 90.0, 135.0, 180.0, 359.9]))
+        dec = numpy.concatenate((rng.uniform(-90, 90, 2000), [30.0, 0.0, 30.0, 0.0, -30.0, 80.0]))
+        found = self.zones.find(ra, dec)
+        for i in range(len(ra)):
+            expected = first_match(self.ra_low, self.ra_up, self.de_low, self.constellations, ra[i], dec[i])
+            self.assertEqual(found[i], expected.strip())
+
+    def test_finder(self):
+        cf = ConstellationFinder(CONST_BOUND_EPOCH, self.zones)
+        self.assertEqual(cf.find(100.0, 40.0), "uma")
+        self.assertIsNone(cf.find(100.0, -90.0))
+        self.assertEqual(list(cf.find_many([100.0, 200.0], [40.0, 10.0])), ["uma", "vir"])
+
+
+class TestConstellationAreas(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(13)
+        n = 60
+        ra_low = numpy.round(rng.uniform(0, 24, n), 2)
+        ra_up = numpy.minimum(ra_low + numpy.round(rng.uniform(0.5, 8, n), 2), 24)
+        de_low = -numpy.sort(-numpy.round(rng.uniform(-89, 88, n), 1))
+        self.zones = ConstellationZones(
+            numpy.append(ra_low, 0.0), numpy.append(ra_up, 24.0), numpy.append(de_low, -90.0),
+            ["c{}".format(i % 12) for i in range(n + 1)]
+        )
+        self.finder = ConstellationFinder(REFERENCE_EPOCH, self.zones)
+
+    def sampled_fractions(self, min_ra, width, min_dec, max_dec, n=500):
+        # A regular grid of equal-area cells
+        u = (numpy.arange(n) + 0.5) / n
+        ra = (min_ra + width * u[:, None] + numpy.zeros(n)[None, :]).ravel() % 360
+        y0, y1 = numpy.sin(numpy.radians(min_dec)), numpy.sin(numpy.radians(max_dec))
+        dec = numpy.degrees(numpy.arcsin(y0 + (y1 - y0) * (numpy.zeros(n)[:, None] + u[None, :]))).ravel()
+        names, counts = numpy.unique(self.finder.find_many(ra, dec), return_counts=True)
+        return dict(zip(names, counts / float(len(ra))))
+
+    def test_fractions(self):
+        for min_ra, max_ra, min_dec, max_dec in [(10, 40, -20, 10), (350, 20, 30, 60), (0, 0, 75, 90), (0, 0, -90, -70), (100, 160, 85, 90)]:
+            width = (max_ra - min_ra) % 360 or 360
+            sampled = self.sampled_fractions(min_ra, width, min_dec, max_dec)
+            areas = constellation_areas(min_ra, max_ra, min_dec, max_dec, zones=self.zones)
+            self.assertAlmostEqual(sum(f for f, c in areas), 1.0, 10)
+            for fraction, c in areas:
+                self.assertAlmostEqual(fraction, sampled.get(c, 0.0), 2)
+            self.assertEqual(areas, constellation_areas(min_ra, max_ra, min_dec, max_dec, zones=self.zones))
+
+    def test_loop_area(self):
+        pc = PrecessionCalculator(REFERENCE_EPOCH, CONST_BOUND_EPOCH)
+        ra, dec = box_loops(10.0, 30.0, -20.0, 10.0)[0]
+        area = self.zones.loop_areas(*pc.precess_arrays(ra, dec)).sum()
+        expected = numpy.radians(30.0) * (numpy.sin(numpy.radians(10.0)) - numpy.sin(numpy.radians(-20.0)))
+        self.assertAlmostEqual(area, expected, 8)
+
+        # Around the pole the loops give the area down to the south pole
+        area = sum(self.zones.loop_areas(*pc.precess_arrays(ra, dec)).sum() for ra, dec in box_loops(0.0, 360.0, 80.0, 90.0))
+        self.assertAlmostEqual(area + self.zones.sphere_areas().sum(), 2 * numpy.pi * (1 - numpy.sin(numpy.radians(80.0))), 8)
+
+
+class TestPrecession(unittest.TestCase):
+    def test_precess_arrays(self):
+        pc = PrecessionCalculator(REFERENCE_EPOCH, CONST_BOUND_EPOCH)
+        rng = numpy.random.RandomState(12)
+        ra = rng.uniform(0, 360, 100)
+        dec = rng.uniform(-89, 89, 100)
+        ra2, dec2 = pc.precess_arrays(ra, dec)
+        for i in range(len(ra)):
+            expected = pc.precess(ra[i], dec[i])
+            self.assertAlmostEqual(ra2[i], expected[0], 10)
+            self.assertAlmostEqual(dec2[i], expected[1], 10)
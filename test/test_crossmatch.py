@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.database import open_database
+from skymap.crossmatch import merge_catalogues_in_memory, component_match, not_in, SKYMAP_STARS_COLUMNS, NULL_INT
+from skymap.stars import add_tycho2, add_tycho1, add_hipparcos
+
+
+TYC_COLUMNS = ["TYC1", "TYC2", "TYC3"]
+
+
+def create_table(db, table, columns, rows):
+    datatypes = [type(next((r[i] for r in rows if r[i] is not None), 0)) for i in range(len(columns))]
+    db.create_table(table, columns, datatypes)
+    db.insert_rows(table, columns, rows)
+
+
+class CrossmatchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+
+        create_table(self.db, "tyc2_tyc2", TYC_COLUMNS + ["HIP", "CCDM", "TYC", "RAmdeg", "DEmdeg", "RAdeg", "DEdeg", "pmRA", "pmDE", "BTmag", "VTmag"], [
+            [1, 1, 1, None, "   ", " ", 10.0, 20.0, 10.1, 20.1, 5.0, -5.0, 9.0, 8.0],     # Tycho-2 star with two HD numbers
+            [1, 2, 1, None, "   ", " ", None, None, 11.1, 21.1, None, None, 9.5, 9.0],    # Tycho-2 star without mean position
+            [1, 3, 1, None, "   ", "T", 12.0, 22.0, 12.0, 22.0, None, None, 9.0, 9.0],   # Tycho-1 star, excluded
+            [1, 4, 1, None, "   ", " ", 13.0, 23.0, 13.0, 23.0, None, None, 9.0, 9.0],   # In Tycho-1, excluded
+            [2, 1, 1, 100, "AB ", " ", 30.0, 40.0, 30.0, 40.0, None, None, 6.0, 5.0],    # Hipparcos components A and B
+            [2, 2, 1, 100, "C  ", " ", 30.1, 40.1, 30.1, 40.1, None, None, 7.0, 6.0],    # Hipparcos component C
+            [2, 3, 1, 200, "   ", " ", 50.0, 60.0, 50.0, 60.0, None, None, 4.0, 3.0],    # Single Hipparcos star
+        ])
+        create_table(self.db, "tyc2_suppl_1", TYC_COLUMNS + ["HIP", "CCDM"], [
+            [3, 1, 1, 300, "b  "]
+        ])
+        create_table(self.db, "tyc2_suppl_2", TYC_COLUMNS, [
+            [4, 2, 1]
+        ])
+        create_table(self.db, "tyc2hd_tyc2_hd", TYC_COLUMNS + ["HD", "Rem"], [
+            [1, 1, 1, 1002, " "], [1, 1, 1, 1001, " "], [1, 1, 1, 1000, "D"], [1, 2, 1, 1003, " "]
+        ])
+        create_table(self.db, "hiptyc_tyc_main", TYC_COLUMNS + [
+            "RAdeg", "DEdeg", "pmRA", "pmDE", "Vmag", "B-V", "BTmag", "VTmag", "VTmax", "VTmin",
+            "HD", "BD", "CoD", "CPD", "MultFlag", "VarFlag", "HIP", "Q"
+        ], [
+            [1, 4, 1, 13.0, 23.0, 1.0, 2.0, 9.1, 0.5, 9.6, 9.1, None, None, 5000, "+10 100", " ", " ", "D", " ", None, 1],
+            [4, 1, 1, 14.0, 24.0, None, None, 9.2, None, 9.7, 9.2, 9.0, 9.5, None, " ", " ", " ", " ", "V", None, 2],
+            [4, 2, 1, 15.0, 25.0, None, None, 9.3, None, 9.8, 9.3, None, None, None, " ", " ", " ", " ", " ", None, 1],   # In supplement 2
+            [4, 3, 1, 16.0, 26.0, None, None, 9.4, None, 9.9, 9.4, None, None, None, " ", " ", " ", " ", " ", None, 9],   # Quality flag 9
+            [4, 4, 1, 17.0, 27.0, None, None, 9.4, None, 9.9, 9.4, None, None, None, " ", " ", " ", " ", " ", None, None],
+            [2, 3, 1, 50.0, 60.0, None, None, 3.5, None, 4.0, 3.0, None, None, None, " ", " ", " ", " ", " ", 200, 1],   # Hipparcos
+        ])
+        create_table(self.db, "hiptyc_hip_main", [
+            "HIP", "RAdeg", "DEdeg", "pmRA", "pmDE", "Vmag", "B-V", "BTmag", "VTmag", "Hpmag", "Hpmax", "Hpmin",
+            "HVarType", "HD", "BD", "CoD", "CPD"
+        ], [
+            [100, 30.0, 40.0, 1.0, 1.0, 5.0, 0.5, 6.0, 5.0, 5.1, 5.0, 5.3, "U", 2000, " ", "-30 200", " "],
+            [200, 50.0, 60.0, 2.0, 2.0, 3.5, 0.4, 4.0, 3.0, 3.1, 3.0, 3.1, "U", None, " ", " ", " "],
+            [300, 70.0, 80.0, None, None, 7.0, 0.3, 8.0, 7.0, 7.1, None, None, "p", None, " ", " ", " "],
+            [400, None, None, None, None, 7.0, 0.3, 8.0, 7.0, 7.1, None, None, " ", None, " ", " ", " "],   # No position
+        ])
+        create_table(self.db, "hiptyc_h_dm_com", ["HIP", "CCDM", "comp_id", "RAdeg", "DEdeg", "pmRA", "pmDE", "BT", "VT", "Hp"], [
+            [100, "01234+5678", "A", 30.0, 40.0, None, None, 6.5, 5.5, 5.6],
+            [100, "01234+5678", "B", 30.001, 40.001, None, None, 7.5, 6.5, 6.6],
+            [100, "01234+5678", "C", 30.1, 40.1, None, None, 8.5, 7.5, 7.6],
+            [300, "04321-1234", "B", None, None, None, None, None, None, None],
+        ])
+        self.db.create_table("skymap_stars", SKYMAP_STARS_COLUMNS, [
+            int, int, int, int, str, str, int, int, str, str, str,
+            float, float, float, float, float, float, float, float, float, float, float, float, float,
+            int, int, str
+        ])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def stars(self, source):
+        return self.db.query("""SELECT * FROM skymap_stars WHERE source=? ORDER BY pk""", (source,))
+
+    def test_tycho2(self):
+        self.assertEqual(merge_catalogues_in_memory(self.db), 2 + 2 + 5)
+        stars = self.stars("T2")
+        self.assertEqual([(s['tyc1'], s['tyc2'], s['tyc3']) for s in stars], [(1, 1, 1), (1, 2, 1)])
+        self.assertEqual((stars[0]['hd1'], stars[0]['hd2']), (1001, 1002))
+        self.assertEqual((stars[1]['hd1'], stars[1]['hd2']), (1003, None))
+        self.assertEqual((stars[0]['right_ascension'], stars[1]['right_ascension']), (10.0, 11.1))
+        self.assertAlmostEqual(stars[0]['johnsonV'], 8.0 - 0.090 * 1.0)
+        self.assertAlmostEqual(stars[0]['johnsonBV'], 0.085)
+        self.assertIsNone(stars[1]['proper_motion_ra'])
+
+    def test_tycho1(self):
+        merge_catalogues_in_memory(self.db)
+        stars = self.stars("T1")
+        self.assertEqual([(s['tyc1'], s['tyc2'], s['tyc3']) for s in stars], [(1, 4, 1), (4, 1, 1)])
+        self.assertEqual((stars[0]['multiple'], stars[0]['variable'], stars[0]['hd1'], stars[0]['bd']), (1, 0, 5000, "+10 100"))
+        self.assertEqual((stars[1]['multiple'], stars[1]['variable'], stars[1]['vt_min']), (0, 1, 9.5))
+
+    def test_hipparcos(self):
+        merge_catalogues_in_memory(self.db)
+        stars = self.stars("H")
+        self.assertEqual(
+            [(s['hip'], s['ccdm_comp'], s['tyc1'], s['tyc2'], s['tyc3']) for s in stars],
+            [(100, "A", 2, 1, 1), (100, "B", 2, 1, 1), (100, "C", 2, 2, 1), (200, None, 2, 3, 1), (300, "B", 3, 1, 1)]
+        )
+        self.assertEqual([s['variable'] for s in stars], [1, 1, 1, 0, 1])
+        self.assertEqual((stars[1]['right_ascension'], stars[1]['hp_magnitude'], stars[1]['proper_motion_ra']), (30.001, 6.6, 1.0))
+        self.assertEqual((stars[4]['right_ascension'], stars[4]['hp_magnitude']), (70.0, 7.1))
+        self.assertEqual(stars[0]['cod'], "-30 200")
+
+    def test_sql_merge(self):
+        # SQLite compares strings case sensitively, unlike the MySQL collations the SQL merge was written for
+        self.db.commit_query("""UPDATE hiptyc_hip_main SET HVarType=UPPER(HVarType)""")
+        self.db.commit_query("""UPDATE tyc2_suppl_1 SET CCDM=UPPER(CCDM)""")
+        self.db.conn.create_function("CONCAT", -1, lambda *a: None if None in a else "".join(str(v) for v in a))
+
+        columns = ", ".join("`{}`".format(c) for c in SKYMAP_STARS_COLUMNS)
+        merge_catalogues_in_memory(self.db)
+        memory = self.db.query("""SELECT {} FROM skymap_stars ORDER BY pk""".format(columns))
+        self.db.commit_query("""DELETE FROM skymap_stars""")
+        add_tycho2(self.db)
+        add_tycho1(self.db)
+        add_hipparcos(self.db)
+        sql = self.db.query("""SELECT {} FROM skymap_stars ORDER BY pk""".format(columns))
+
+        def values(rows):
+            return sorted(tuple(round(v, 9) if isinstance(v, float) else v for v in (r[c] for c in SKYMAP_STARS_COLUMNS)) for r in rows)
+
+        self.assertEqual(len(memory), 9)
+        self.assertEqual(values(memory), values(sql))
+
+
+class JoinConditionTest(unittest.TestCase):
+    def test_component_match(self):
+        self.assertTrue(component_match(None, "   "))
+        self.assertTrue(component_match("A", "A  "))
+        self.assertTrue(component_match("b", "AB "))
+        self.assertFalse(component_match("C", "AB "))
+        self.assertFalse(component_match(None, "AB "))
+
+    def test_not_in(self):
+        keys = numpy.array([1, 2, NULL_INT])
+        self.assertEqual(list(not_in(keys, numpy.array([2]))), [True, False, False])
+        self.assertEqual(list(not_in(keys, numpy.array([2, NULL_INT]))), [False, False, False])
@@ -0,0 +1,121 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy
+from skymap import database
+from skymap.database import SQLiteDatabase, open_database, shared_database, close_shared_databases, tsv_field
+
+
+class SQLiteDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "skymap.db")
+        self.db = open_database("sqlite", path=self.path)
+        self.db.create_table("stars", ["HIP", "name", "Vmag"], [int, str, float])
+        self.db.insert_rows("stars", ["HIP", "name", "Vmag"], [[32349, "Sirius", -1.46], [30438, "Canopus", -0.74]])
+        self.db.insert_row("stars", ["HIP", "name", "Vmag"], [91262, "Vega", 0.03])
+        self.db.add_index("stars", "HIP", unique=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_query(self):
+        rows = self.db.query("""SELECT * FROM stars ORDER BY Vmag""")
+        self.assertEqual([r['name'] for r in rows], ["Sirius", "Canopus", "Vega"])
+        self.assertEqual(rows[0]['pk'], 1)
+        self.assertEqual(self.db.query_one("""SELECT name FROM stars WHERE HIP=?""", (91262,))['name'], "Vega")
+        self.assertIsNone(self.db.query_one("""SELECT name FROM stars WHERE HIP=1"""))
+
+    def test_query_iter(self):
+        q = """SELECT HIP, name, Vmag FROM stars ORDER BY Vmag"""
+        batches = list(self.db.query_iter(q, batch_size=2))
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(batches[1][0]['name'], "Vega")
+
+        rows = [r for b in self.db.query_iter(q, row_format="tuple") for r in b]
+        self.assertEqual(rows[0], (32349, "Sirius", -1.46))
+
+        self.db.insert_row("stars", ["HIP"], [1])
+        dtype = [('HIP', numpy.int32), ('name', 'S16'), ('Vmag', numpy.float64)]
+        array = numpy.concatenate(list(self.db.query_iter(q, batch_size=2, row_format="array", dtype=dtype)))
+        self.assertEqual(list(array['HIP']), [1, 32349, 30438, 91262])
+        self.assertTrue(numpy.isnan(array['Vmag'][0]))
+        self.assertEqual(array['name'][0], "")
+
+    def test_bulk_update(self):
+        self.db.bulk_update("stars", "HIP", ["name", "Vmag"], iter([(32349, "alpha CMa", -1.5), (91262, "alpha Lyr", 0.0)]), batch_size=1)
+        rows = self.db.query("""SELECT name, Vmag FROM stars ORDER BY pk""")
+        self.assertEqual([(r['name'], r['Vmag']) for r in rows], [("alpha CMa", -1.5), ("Canopus", -0.74), ("alpha Lyr", 0.0)])
+
+    def test_bulk_load(self):
+        rows = ((i, "star {}".format(i), i / 10.0) for i in range(1, 26))
+        self.assertEqual(self.db.bulk_load("stars", ["HIP", "name", "Vmag"], rows, batch_size=10), 25)
+        self.assertEqual(self.db.query_one("""SELECT COUNT(*) AS n FROM stars""")['n'], 28)
+        self.assertEqual(self.db.query_one("""SELECT name FROM stars WHERE HIP=25""")['name'], "star 25")
+
+    def test_transaction(self):
+        try:
+            with self.db.transaction():
+                self.db.insert_row("stars", ["HIP"], [1])
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.db.query_one("""SELECT COUNT(*) AS n FROM stars""")['n'], 3)
+
+        with self.db.transaction():
+            self.db.insert_row("stars", ["HIP"], [1])
+            with self.db.transaction():
+                self.db.insert_row("stars", ["HIP"], [2])
+        self.assertEqual(self.db.query_one("""SELECT COUNT(*) AS n FROM stars""")['n'], 5)
+
+    def test_wal(self):
+        self.assertEqual(self.db.query_one("""PRAGMA journal_mode""")['journal_mode'], "wal")
+
+    def test_read_only(self):
+        reader = SQLiteDatabase(self.path, read_only=True)
+        self.assertEqual(reader.query_one("""SELECT COUNT(*) AS n FROM stars""")['n'], 3)
+        self.assertRaises(sqlite3.OperationalError, reader.insert_row, "stars", ["HIP"], [1])
+        reader.close()
+
+    def test_drop_table(self):
+        self.db.drop_table("stars")
+        self.db.drop_table("stars")
+        self.assertRaises(sqlite3.OperationalError, self.db.query, """SELECT * FROM stars""")
+
+
+class SharedDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "skymap.db")
+
+    def tearDown(self):
+        close_shared_databases()
+        shutil.rmtree(self.folder)
+
+    def test_reuse(self):
+        db1 = shared_database("sqlite", path=self.path)
+        db2 = shared_database("sqlite", path=self.path)
+        self.assertIs(db1, db2)
+        self.assertIsNot(db1, shared_database("sqlite", path=self.path, read_only=True))
+
+    def test_fork(self):
+        db1 = shared_database("sqlite", path=self.path)
+        # Pretend the connection was opened by a parent process
+        database._shared_pid = -1
+        db2 = shared_database("sqlite", path=self.path)
+        self.assertIsNot(db1, db2)
+        self.assertIn(db1, database._inherited_databases)
+
+
+class TSVFieldTest(unittest.TestCase):
+    def test_tsv_field(self):
+        self.assertEqual(tsv_field(None), "\\N")
+        self.assertEqual(tsv_field(float("nan")), "\\N")
+        self.assertEqual(tsv_field(True), "1")
+        self.assertEqual(tsv_field(0.1), "0.1")
+        self.assertEqual(tsv_field(12), "12")
+        self.assertEqual(tsv_field("a\tb\\c\n"), "a\\tb\\\\c\\n")
+        self.assertEqual(tsv_field(u"\u03b1 CMa"), "\xce\xb1 CMa")
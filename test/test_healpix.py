@@ -0,0 +1,99 @@
+import math
+import unittest
+import numpy
+from skymap.healpix import ang2pix, pix2ang, npix, pixel_area, max_pixel_radius, to_vectors, merge_ranges
+from skymap.healpix import cover_cap, cover_box, cover_polygon
+
+
+def random_points(n, seed=1):
+    rng = numpy.random.RandomState(seed)
+    ra = rng.uniform(0, 360, n)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, n)))
+    return ra, dec
+
+
+def in_ranges(pixels, ranges):
+    result = numpy.zeros(len(pixels), dtype=bool)
+    for start, stop in ranges:
+        result |= (pixels >= start) & (pixels < stop)
+    return result
+
+
+class PixelTest(unittest.TestCase):
+    def test_round_trip(self):
+        for order in range(5):
+            pixels = numpy.arange(npix(order))
+            ra, dec = pix2ang(pixels, order)
+            self.assertTrue((ang2pix(ra, dec, order) == pixels).all())
+
+    def test_known_pixels(self):
+        self.assertEqual(ang2pix(0.0, 90.0, 2), 15)
+        self.assertEqual(ang2pix(359.9, -90.0, 2), 176)
+        self.assertEqual(ang2pix(0.0, 0.0, 0), 4)
+        self.assertEqual(ang2pix(90.0, 0.0, 0), 5)
+
+    def test_equal_area(self):
+        ra, dec = random_points(120000)
+        counts = numpy.bincount(ang2pix(ra, dec, 2), minlength=npix(2))
+        self.assertLess(counts.max(), 1.15 * 120000 / npix(2))
+        self.assertGreater(counts.min(), 0.85 * 120000 / npix(2))
+
+    def test_max_pixel_radius(self):
+        ra, dec = random_points(200000)
+        for order in (0, 1, 3, 6):
+            cra, cdec = pix2ang(ang2pix(ra, dec, order), order)
+            d = numpy.arccos(numpy.clip((to_vectors(ra, dec) * to_vectors(cra, cdec)).sum(axis=1), -1, 1))
+            self.assertLessEqual(d.max(), max_pixel_radius(order))
+            self.assertLess(d.max(), 1.1 * math.sqrt(pixel_area(order)))
+
+
+class CoverTest(unittest.TestCase):
+    def setUp(self):
+        self.ra, self.dec = random_points(200000)
+        self.pixels = ang2pix(self.ra, self.dec, 8)
+
+    def check_cover(self, ranges, mask):
+        covered = in_ranges(self.pixels, ranges)
+        self.assertTrue(covered[mask].all())
+        # The cover should not be much larger than the region
+        self.assertLess(covered.sum(), 2 * mask.sum() + 500)
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([(5, 8), (0, 2), (2, 4), (7, 9)]), [(0, 4), (5, 9)])
+
+    def test_cap(self):
+        for ra, dec, radius in ((10.0, 20.0, 5.0), (0.0, 89.0, 3.0), (359.0, -45.0, 10.0)):
+            ranges = cover_cap(ra, dec, radius, order=8)
+            center = to_vectors(ra, dec)[0]
+            d = numpy.degrees(numpy.arccos(numpy.clip(to_vectors(self.ra, self.dec).dot(center), -1, 1)))
+            self.check_cover(ranges, d <= radius)
+
+    def test_box(self):
+        for ra_range, dec_range in (((10.0, 30.0), (-10.0, 10.0)), ((350.0, 20.0), (40.0, 60.0)), ((0.0, 0.0), (80.0, 90.0))):
+            ranges = cover_box(ra_range, dec_range, order=8)
+            min_ra, max_ra = ra_range
+            if min_ra < max_ra:
+                mask = (self.ra >= min_ra) & (self.ra <= max_ra)
+            elif max_ra < min_ra:
+                mask = (self.ra >= min_ra) | (self.ra <= max_ra)
+            else:
+                mask = numpy.ones(len(self.ra), dtype=bool)
+            mask &= (self.dec >= dec_range[0]) & (self.dec <= dec_range[1])
+            self.check_cover(ranges, mask)
+
+    def test_polygon(self):
+        vertices = [(10.0, 0.0), (30.0, 0.0), (30.0, 20.0), (10.0, 20.0)]
+        ranges = cover_polygon(vertices[::-1], order=8)
+        points = to_vectors(self.ra, self.dec)
+        corners = to_vectors([v[0] for v in vertices], [v[1] for v in vertices])
+        mask = numpy.ones(len(points), dtype=bool)
+        for i in range(len(corners)):
+            mask &= points.dot(numpy.cross(corners[i], corners[(i + 1) % len(corners)])) >= 0
+        self.check_cover(ranges, mask)
+
+    def test_depth(self):
+        fine = cover_cap(10.0, 20.0, 5.0, order=8)
+        coarse = cover_cap(10.0, 20.0, 5.0, order=8, depth=4)
+        self.assertLess(len(coarse), len(fine))
+        for start, stop in fine:
+            self.assertTrue(any(s <= start and stop <= e for s, e in coarse))
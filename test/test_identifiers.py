@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+from skymap.database import open_database
+from skymap.identifiers import IdentifierIndex, export_identifier_index, parse_designation, tyc_key
+
+
+class IdentifierIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+        columns = ["id", "hip", "tyc1", "tyc2", "tyc3", "hd1", "hd2", "hr", "hp_magnitude", "vt_magnitude", "johnsonV"]
+        self.db.create_table("skymap_stars", columns, [int] * 8 + [float] * 3)
+        self.db.insert_rows("skymap_stars", columns, [
+            [1, 32349, None, None, None, 48915, None, 2491, -1.1, None, None],
+            [2, 32349, None, None, None, None, None, None, 8.5, None, None],
+            [3, None, 5949, 2777, 1, 48915, 48916, None, None, 9.0, None],
+            [4, None, 1, 2, 1, None, 48915, None, None, None, None],
+        ])
+        export_identifier_index(self.db, os.path.join(self.folder, "identifiers"))
+        self.index = IdentifierIndex(os.path.join(self.folder, "identifiers"))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_find_star(self):
+        self.assertEqual(self.index.find_star("HIP 32349"), 1)
+        self.assertEqual(self.index.find_star("hr2491"), 1)
+        self.assertEqual(self.index.find_star("TYC 5949-2777-1"), 3)
+        self.assertEqual(self.index.find_star("HD 48916"), 3)
+        self.assertIsNone(self.index.find_star("HIP 1"))
+        self.assertRaises(ValueError, self.index.find_star, "Sirius")
+        self.assertRaises(ValueError, self.index.find_star, "TYC 5949")
+
+    def test_find_all(self):
+        # From bright to faint, stars without magnitude last
+        self.assertEqual(self.index.find_all("HD", 48915), [1, 3, 4])
+        self.assertEqual(self.index.find_all("HIP", 32349), [1, 2])
+
+    def test_find_many(self):
+        self.assertEqual(list(self.index.find_many("HD", [48916, 1, 48915])), [3, 0, 1])
+        self.assertEqual(list(self.index.find_many("TYC", [tyc_key(1, 2, 1)])), [4])
+
+    def test_unknown_catalogue(self):
+        self.assertRaises(ValueError, self.index.find, "BD", 1)
+
+    def test_parse_designation(self):
+        self.assertEqual(parse_designation("HIP 32349"), ("HIP", 32349))
+        self.assertEqual(parse_designation(" tyc 1-2-1 "), ("TYC", tyc_key(1, 2, 1)))
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from skymap.database import open_database
+from skymap.manifest import BuildManifest
+
+
+class BuildManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+        self.manifest = BuildManifest(self.db)
+        self.calls = []
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def step(self, name, fail=False):
+        def function(db):
+            if fail:
+                raise RuntimeError(name)
+            self.calls.append(name)
+        return function
+
+    def test_entries(self):
+        self.assertIsNone(self.manifest.get("a"))
+        self.manifest.set("a", "1")
+        self.manifest.set("a", "2")
+        self.assertEqual(self.manifest.get("a"), "2")
+        self.manifest.forget("a")
+        self.assertIsNone(self.manifest.get("a"))
+
+    def test_file_checksum(self):
+        path = os.path.join(self.folder, "data.dat")
+        with open(path, "w") as fp:
+            fp.write("abc")
+        self.assertEqual(self.manifest.file_checksum(path), "900150983cd24fb0d6963f7d28e17f72")
+        self.assertEqual(self.manifest.file_checksum(path), "900150983cd24fb0d6963f7d28e17f72")
+        with open(path, "w") as fp:
+            fp.write("abcd")
+        self.assertEqual(self.manifest.file_checksum(path), "e2fc714c4727ee9395f324cd2e7f331f")
+
+    def test_run_steps(self):
+        steps = [("a", 1, ["cat"], self.step("a")), ("b", 1, [], self.step("b")), ("c", 1, [], self.step("c"))]
+        self.manifest.run_steps("test", steps, self.db)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+        self.manifest.run_steps("test", steps, self.db)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+        # A new version of a step runs it and all later steps
+        steps[1] = ("b", 2, [], self.step("b"))
+        self.manifest.run_steps("test", steps, self.db)
+        self.assertEqual(self.calls, ["a", "b", "c", "b", "c"])
+
+        # A changed input catalogue
+        self.calls = []
+        self.manifest.set("catalogue:cat", "x")
+        self.manifest.run_steps("test", steps, self.db)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+    def test_resume(self):
+        steps = [("a", 1, [], self.step("a")), ("b", 1, [], self.step("b", fail=True)), ("c", 1, [], self.step("c"))]
+        self.assertRaises(RuntimeError, self.manifest.run_steps, "test", steps, self.db)
+        self.assertEqual(self.calls, ["a"])
+
+        steps[1] = ("b", 1, [], self.step("b"))
+        self.manifest.run_steps("test", steps, self.db)
+        self.assertEqual(self.calls, ["a", "b", "c"])
@@ -0,0 +1,48 @@
+import unittest
+import numpy
+from skymap.geometry import Point, SphericalPoint
+from skymap.map import EquidistantConicMapArea
+from skymap.coordinates import REFERENCE_EPOCH
+from skymap.constellations import ConstellationBoundaries
+
+
+class VisibleExtentTest(unittest.TestCase):
+    def setUp(self):
+        # The left page of the first north conic chart of the atlas: nominally 0 to 35 degrees, 73 to 85 degrees
+        llcorner = Point(14, 28)
+        urcorner = llcorner + Point(197, 12 * 18.5)
+        self.m = EquidistantConicMapArea(
+            llcorner, urcorner, hmargin=0, vmargin=0, center=(0, 79), standard_parallel1=75, standard_parallel2=83,
+            latitude_range=12, origin=llcorner + Point(197, 6 * 18.5), celestial=True, box=False
+        )
+        self.m.min_longitude = 0
+        self.m.max_longitude = 35
+        self.m.min_latitude = 73
+        self.m.max_latitude = 85
+
+    def test_corners(self):
+        min_longitude, max_longitude, min_latitude, max_latitude = self.m.visible_extent()
+        for corner in (self.m.map_llcoordinates, self.m.map_ulcoordinates, self.m.map_urcoordinates, self.m.map_lrcoordinates):
+            self.assertTrue(min_longitude <= corner.longitude <= max_longitude)
+            self.assertTrue(min_latitude <= corner.latitude <= max_latitude)
+        self.assertGreater(self.m.map_ulcoordinates.longitude, 60)
+
+    def test_corner_edge(self):
+        # A boundary edge visible only in the upper left corner of the page
+        p = self.m.projection(self.m.map_ulcorner + Point(2, -2), True)
+        self.assertGreater(p.longitude, 35)
+        self.assertTrue(self.m.min_latitude < p.latitude < self.m.max_latitude)
+        self.assertTrue(self.m.inside_maparea(self.m.map_point(SphericalPoint(p.longitude, p.latitude))))
+
+        boundaries = ConstellationBoundaries(
+            REFERENCE_EPOCH, numpy.array([p.longitude, p.longitude]), numpy.array([p.latitude - 0.3, p.latitude + 0.3]),
+            numpy.array([0, 2])
+        )
+        self.assertEqual(list(boundaries.edges_in_area(0, 35, 73, 85)), [])
+        self.assertEqual(list(boundaries.edges_in_area(*self.m.visible_extent())), [0])
+
+    def test_full_circle(self):
+        self.m.min_longitude = 0
+        self.m.max_longitude = 360
+        min_longitude, max_longitude, min_latitude, max_latitude = self.m.visible_extent()
+        self.assertEqual(min_longitude, max_longitude)
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.database import open_database
+from skymap.multiples import find_pairs, build_pairs_table, PAIRS_TABLE
+from skymap.multiples import union_find, group_magnitudes, find_groups, build_groups_table, GROUPS_TABLE
+from skymap.stars import angular_separation_seconds_of_arc, find_multiples, sum_magnitudes
+from skymap.healpix import to_vectors
+
+
+def random_stars(n, seed=4):
+    rng = numpy.random.RandomState(seed)
+    ra = rng.uniform(0, 5, n)
+    dec = rng.uniform(-2, 2, n)
+    return ra, dec
+
+
+class FindPairsTest(unittest.TestCase):
+    def test_brute_force(self):
+        ra, dec = random_stars(400)
+        criterion = 600.0
+        i, j, separation = find_pairs(ra, dec, criterion)
+
+        vectors = to_vectors(ra, dec)
+        expected = []
+        for a in range(len(ra)):
+            d = 3600 * numpy.degrees(numpy.arccos(numpy.clip(vectors[a + 1:].dot(vectors[a]), -1, 1)))
+            expected.extend((a, a + 1 + b) for b in numpy.flatnonzero(d < criterion))
+        self.assertEqual(zip(i.tolist(), j.tolist()), expected)
+        self.assertTrue((separation < criterion).all())
+
+    def test_separation(self):
+        i, j, separation = find_pairs([10.0, 10.01, 50.0], [20.0, 20.0, 20.0], 100)
+        self.assertEqual((list(i), list(j)), ([0], [1]))
+        self.assertAlmostEqual(separation[0], angular_separation_seconds_of_arc(10.0, 20.0, 10.01, 20.0), 1)
+
+    def test_wrap(self):
+        i, j, separation = find_pairs([359.999, 0.001], [0.0, 0.0], 10)
+        self.assertEqual(len(i), 1)
+        self.assertAlmostEqual(separation[0], 7.2, 5)
+
+    def test_find_multiples(self):
+        stars = [
+            {'id': 7, 'right_ascension': 10.0, 'declination': 20.0},
+            {'id': 8, 'right_ascension': 30.0, 'declination': 20.0},
+            {'id': 9, 'right_ascension': 10.0, 'declination': 20.01}
+        ]
+        pairs = find_multiples(stars, 100)
+        self.assertEqual([(p[0], p[1]) for p in pairs], [(7, 9)])
+
+
+class GroupsTest(unittest.TestCase):
+    def test_union_find(self):
+        roots = union_find(7, numpy.array([5, 1, 3, 2]), numpy.array([6, 3, 4, 4]))
+        self.assertEqual(list(roots), [0, 1, 1, 1, 1, 5, 5])
+
+    def test_group_magnitudes(self):
+        combined = group_magnitudes([1.0, 2.0, 3.0, numpy.nan], numpy.array([0, 0, 1, 1]))
+        self.assertAlmostEqual(combined[0], sum_magnitudes(1.0, 2.0))
+        self.assertAlmostEqual(combined[1], 3.0)
+        self.assertAlmostEqual(sum_magnitudes(numpy.array([1.0]), numpy.array([2.0]))[0], sum_magnitudes(1.0, 2.0))
+
+    def test_find_groups(self):
+        # A chain of three stars, a pair, and a single star
+        ra = [10.0, 10.0, 10.0, 50.0, 50.0, 90.0]
+        dec = [0.0, 0.02, 0.04, 0.0, 0.01, 0.0]
+        magnitudes = [5.0, 4.0, 6.0, numpy.nan, 8.0, 1.0]
+        members, group, primary, separation, magnitude = find_groups(ra, dec, magnitudes, 100)
+        self.assertEqual(list(members), [0, 1, 2, 3, 4])
+        self.assertEqual(list(group), [0, 0, 0, 1, 1])
+        self.assertEqual(list(primary), [1, 1, 1, 4, 4])
+        self.assertAlmostEqual(separation[0], 72.0, 5)
+        self.assertAlmostEqual(separation[1], 0.0, 5)
+        self.assertAlmostEqual(magnitude[0], sum_magnitudes(sum_magnitudes(5.0, 4.0), 6.0))
+        self.assertAlmostEqual(magnitude[3], 8.0)
+
+
+class PairsTableTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = open_database("sqlite", path=os.path.join(self.folder, "skymap.db"))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_build_pairs_table(self):
+        self.db.create_table("skymap_stars", ["id", "right_ascension", "declination"], [int, float, float])
+        self.db.insert_rows("skymap_stars", ["id", "right_ascension", "declination"], [
+            [1, 10.0, 20.0], [2, 10.0, 20.02], [3, 10.0, 20.01], [4, 180.0, 0.0], [5, None, None]
+        ])
+        self.assertEqual(build_pairs_table(self.db, criterion=40), 2)
+        rows = self.db.query("""SELECT star1, star2 FROM {} ORDER BY star1, star2""".format(PAIRS_TABLE))
+        self.assertEqual([(r['star1'], r['star2']) for r in rows], [(1, 3), (2, 3)])
+
+    def test_build_groups_table(self):
+        self.db.create_table("skymap_stars", ["id", "right_ascension", "declination", "hp_magnitude", "vt_magnitude", "johnsonV"], [int, float, float, float, float, float])
+        self.db.insert_rows("skymap_stars", ["id", "right_ascension", "declination", "hp_magnitude", "vt_magnitude", "johnsonV"], [
+            [1, 10.0, 20.0, 5.0, None, None], [2, 10.0, 20.02, None, 3.0, None], [3, 10.0, 20.01, None, None, 4.0], [4, 180.0, 0.0, 1.0, None, None]
+        ])
+        self.assertEqual(build_groups_table(self.db, criterion=40), 1)
+        rows = self.db.query("""SELECT * FROM {} ORDER BY star_id""".format(GROUPS_TABLE))
+        self.assertEqual([(r['star_id'], r['group_id'], r['primary_id']) for r in rows], [(1, 1, 2), (2, 1, 2), (3, 1, 2)])
+        self.assertAlmostEqual(rows[0]['separation'], 72.0, 5)
+        self.assertAlmostEqual(rows[0]['magnitude'], sum_magnitudes(sum_magnitudes(5.0, 3.0), 4.0))
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from datetime import datetime
+from skymap.coordinates import julian_year_difference
+from skymap.star_columns import StarColumns, STAR_COLUMNS, EPOCHS_FOLDER, rows_to_columns
+from skymap.stars import propagate_position, propagate_position2, propagate_positions, propagate_positions2
+from skymap.stars import positions_at_epoch, source_epoch_differences, HIPPARCOS_EPOCH, TYCHO2_EPOCH
+from test_star_columns import star_row
+
+
+class PropagationTest(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(3)
+        n = 50
+        self.ra = rng.uniform(0, 360, n)
+        self.dec = rng.uniform(-80, 80, n)
+        self.pm_ra = rng.uniform(-2000, 2000, n)
+        self.pm_dec = rng.uniform(-2000, 2000, n)
+        self.distance = rng.uniform(1, 100, n)
+        self.radial_velocity = rng.uniform(-100, 100, n)
+        self.epochs = [HIPPARCOS_EPOCH if i % 2 else TYCHO2_EPOCH for i in range(n)]
+        self.to_epoch = datetime(2050, 1, 1).date()
+
+    def test_propagate_positions(self):
+        ra, dec = propagate_positions(self.epochs, self.to_epoch, self.ra, self.dec, self.pm_ra, self.pm_dec)
+        for i in range(len(self.ra)):
+            expected = propagate_position(self.epochs[i], self.to_epoch, self.ra[i], self.dec[i], self.pm_ra[i], self.pm_dec[i])
+            self.assertAlmostEqual(ra[i], expected[0], 10)
+            self.assertAlmostEqual(dec[i], expected[1], 10)
+
+    def test_propagate_positions2(self):
+        ra, dec = propagate_positions2(
+            self.epochs, self.to_epoch, self.ra, self.dec, self.pm_ra, self.pm_dec, self.distance, self.radial_velocity
+        )
+        for i in range(len(self.ra)):
+            expected = propagate_position2(
+                self.epochs[i], self.to_epoch, self.ra[i], self.dec[i], self.pm_ra[i], self.pm_dec[i],
+                self.distance[i], self.radial_velocity[i]
+            )
+            self.assertAlmostEqual(ra[i], expected[0], 8)
+            self.assertAlmostEqual(dec[i], expected[1], 8)
+
+    def test_unknown_proper_motion(self):
+        ra, dec = propagate_positions(TYCHO2_EPOCH, self.to_epoch, [10.0], [20.0], [numpy.nan], [numpy.nan])
+        self.assertEqual((ra[0], dec[0]), (10.0, 20.0))
+
+
+class SourceEpochTest(unittest.TestCase):
+    def test_source_epoch_differences(self):
+        epoch = datetime(2050, 1, 1).date()
+        dt = source_epoch_differences(epoch, numpy.array(["T2", "H", "T1", ""]))
+        self.assertAlmostEqual(dt[0], julian_year_difference(epoch, TYCHO2_EPOCH), 10)
+        for i in (1, 2, 3):
+            self.assertAlmostEqual(dt[i], julian_year_difference(epoch, HIPPARCOS_EPOCH), 10)
+
+
+class EpochSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rows = [star_row(1, 10.0, -5.0, 6.0), star_row(2, 355.0, 1.0, 4.0)]
+        rows[0].update({'proper_motion_ra': 1000.0, 'proper_motion_dec': -500.0, 'source': "H"})
+        columns = rows_to_columns(rows)
+        for name, dtype in STAR_COLUMNS:
+            numpy.save(os.path.join(self.folder, "{}.npy".format(name)), columns[name])
+        self.columns = StarColumns(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_snapshot(self):
+        epoch = datetime(2050, 1, 1).date()
+        ra, dec = positions_at_epoch(self.columns, epoch)
+        expected = propagate_position(HIPPARCOS_EPOCH, epoch, 10.0, -5.0, 1000.0, -500.0)
+        self.assertAlmostEqual(ra[0], expected[0], 10)
+        self.assertAlmostEqual(dec[0], expected[1], 10)
+        self.assertEqual((ra[1], dec[1]), (355.0, 1.0))
+        self.assertIs(positions_at_epoch(self.columns, epoch)[0], ra)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, EPOCHS_FOLDER, "2050-01-01_ra.npy")))
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.star_columns import StarColumns, STAR_COLUMNS, ID_COLUMNS, rows_to_columns
+
+
+def star_row(id, ra, dec, magnitude, constellation="ori", variable=False, multiple=False):
+    row = dict((c, None) for c in ID_COLUMNS)
+    row.update({
+        'id': id,
+        'right_ascension': ra,
+        'declination': dec,
+        'proper_motion_ra': None,
+        'proper_motion_dec': None,
+        'magnitude': magnitude,
+        'variable': variable,
+        'multiple': multiple,
+        'source': "T2",
+        'constellation': constellation
+    })
+    return row
+
+
+class StarColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rows = [
+            star_row(1, 10.0, -5.0, 6.0),
+            star_row(2, 355.0, 1.0, 4.0, variable=True),
+            star_row(3, 5.0, 2.0, 9.0, constellation="psc"),
+            star_row(4, 180.0, 3.0, 2.0),
+            star_row(5, 2.0, 40.0, 1.0, multiple=True),
+        ]
+        columns = rows_to_columns(rows)
+        order = numpy.argsort(columns['declination'])
+        for name, dtype in STAR_COLUMNS:
+            numpy.save(os.path.join(self.folder, "{}.npy".format(name)), columns[name][order])
+        self.columns = StarColumns(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def ids(self, indices):
+        return [self.columns.row(i)['id'] for i in indices]
+
+    def test_select(self):
+        self.assertEqual(self.ids(self.columns.select(7.0)), [5, 4, 2, 1])
+        self.assertEqual(self.ids(self.columns.select(10.0, dec_range=(-10, 10))), [4, 2, 1, 3])
+        self.assertEqual(self.ids(self.columns.select(10.0, ra_range=(350, 20), dec_range=(-10, 10))), [2, 1, 3])
+        self.assertEqual(self.ids(self.columns.select(10.0, constellation="psc")), [3])
+
+    def test_row(self):
+        row = self.columns.row(self.columns.select(1.0)[0])
+        self.assertEqual(row['id'], 5)
+        self.assertTrue(row['multiple'])
+        self.assertFalse(row['variable'])
+        self.assertIsNone(row['hip'])
+        self.assertIsNone(row['proper_motion_ra'])
+        self.assertEqual(row['constellation'], "ori")
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.healpix import npix
+from skymap.star_counts import StarCounts, count_stars, box_solid_angle, MAGNITUDE_LIMITS, COUNTS_ORDER
+
+
+class StarCountsTest(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(7)
+        n = 200000
+        self.ra = rng.uniform(0, 360, n)
+        self.dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, n)))
+        self.magnitude = rng.uniform(0, 12, n)
+        self.magnitude[:10] = numpy.nan
+        self.counts = StarCounts(counts=count_stars(self.ra, self.dec, self.magnitude))
+
+    def test_count_stars(self):
+        counts = count_stars(self.ra, self.dec, self.magnitude)
+        self.assertEqual(counts.shape, (npix(COUNTS_ORDER), len(MAGNITUDE_LIMITS)))
+        for k in (0, 20, 40, len(MAGNITUDE_LIMITS) - 1):
+            self.assertEqual(counts[:, k].sum(), (self.magnitude <= MAGNITUDE_LIMITS[k]).sum())
+
+    def test_box_solid_angle(self):
+        self.assertAlmostEqual(box_solid_angle(None, None), 4 * numpy.pi)
+        self.assertAlmostEqual(box_solid_angle((350, 10), (0, 90)), 2 * numpy.pi * 20 / 360.0)
+        self.assertAlmostEqual(box_solid_angle((0, 360), (-90, 90)), 4 * numpy.pi)
+        self.assertAlmostEqual(box_solid_angle((-180, 180), (0, 90)), 2 * numpy.pi)
+
+    def test_estimate(self):
+        for ra_range, dec_range in [((10, 50), (-20, 20)), ((340, 20), (30, 60)), ((0, 0), (-90, -60)), ((0, 360), (60, 90)), ((100, 101), (5, 6))]:
+            estimate = self.counts.estimate(ra_range, dec_range)[-1]
+            expected = box_solid_angle(ra_range, dec_range) / (4 * numpy.pi) * (len(self.ra) - 10)
+            self.assertLess(abs(estimate - expected), 0.25 * expected + 20)
+
+    def test_limiting_magnitude(self):
+        ra_range, dec_range = (10, 50), (-20, 20)
+        limit = self.counts.limiting_magnitude(500, ra_range, dec_range, 12)
+        self.assertLessEqual(self.counts.estimate(ra_range, dec_range)[MAGNITUDE_LIMITS == limit][0], 500)
+        self.assertGreater(self.counts.estimate(ra_range, dec_range)[MAGNITUDE_LIMITS == limit + 0.25][0], 500)
+        self.assertEqual(self.counts.limiting_magnitude(10 ** 7, ra_range, dec_range, 12), 12)
+        self.assertEqual(self.counts.limiting_magnitude(-1, ra_range, dec_range, 12), MAGNITUDE_LIMITS[0])
+
+    def test_polar_limiting_magnitude(self):
+        # Polar charts cover right ascensions 0 to 360
+        self.assertEqual(self.counts.limiting_magnitude(100, (0, 360), (60, 90), 12),
+                         self.counts.limiting_magnitude(100, (0, 0), (60, 90), 12))
+        self.assertLess(self.counts.limiting_magnitude(100, (0, 360), (60, 90), 12), 12)
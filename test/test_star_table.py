@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.star_columns import StarColumns, rows_to_columns, save_columns
+from skymap.stars import Star, StarTable
+from test_star_columns import star_row
+
+
+ROWS = [
+    {'id': 1, 'hip': 32349, 'right_ascension': 101.3, 'declination': -16.7, 'hp_magnitude': -1.1, 'vt_magnitude': -1.0,
+     'proper_name': "Sirius", 'bayer': "alp", 'constellation': "cma", 'number_of_components': 2},
+    {'id': 2, 'hip': None, 'right_ascension': 88.8, 'declination': 7.4, 'hp_magnitude': None, 'vt_magnitude': 0.6,
+     'variability_type': "P", 'min_magnitude': 1.6, 'max_magnitude': 0.0, 'constellation': "ori"},
+    {'id': 3, 'hip': 5, 'right_ascension': 1.0, 'declination': 2.0, 'hp_magnitude': None, 'vt_magnitude': None}
+]
+
+
+class StarTableTest(unittest.TestCase):
+    def test_from_rows(self):
+        table = StarTable.from_rows(ROWS)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table.is_variable), [False, True, False])
+        self.assertEqual(list(table.is_multiple), [True, False, False])
+        self.assertEqual(table.names, {0: ("Sirius", "alp", None)})
+
+        for view, row in zip(table, ROWS):
+            star = Star(row)
+            for p in ('hip', 'proper_name', 'bayer', 'flamsteed', 'is_variable', 'is_multiple', 'constellation'):
+                self.assertEqual(getattr(view, p), getattr(star, p))
+            for p in ('magnitude', 'min_magnitude', 'max_magnitude', 'right_ascension', 'declination'):
+                if getattr(star, p) is None:
+                    self.assertIsNone(getattr(view, p))
+                else:
+                    self.assertAlmostEqual(getattr(view, p), getattr(star, p), 5)
+
+    def test_slots(self):
+        view = StarTable.from_rows(ROWS)[0]
+        self.assertRaises(AttributeError, setattr, view, "extra", 1)
+
+    def test_from_columns(self):
+        folder = tempfile.mkdtemp()
+        try:
+            rows = [star_row(1, 10.0, -5.0, 6.0, variable=True), star_row(2, 20.0, 5.0, 4.0, multiple=True)]
+            rows[1].update({'proper_name': "Betelgeuse", 'bayer': "alp", 'flamsteed': 58})
+            save_columns(folder, rows_to_columns(rows), numpy.arange(2))
+            table = StarTable.concatenate([StarTable.from_columns(StarColumns(folder), [1]), StarTable.from_columns(StarColumns(folder), [0])])
+            self.assertEqual([s.id for s in table], [2, 1])
+            self.assertEqual(list(table.is_variable), [False, True])
+            self.assertTrue(table[0].is_multiple)
+            self.assertEqual(table[1].magnitude, 6.0)
+            self.assertIsNone(table[1].min_magnitude)
+            self.assertEqual(table.names, {0: ("Betelgeuse", "alp", 58)})
+            self.assertEqual(table[0].proper_name, "Betelgeuse")
+            self.assertIsNone(table[1].bayer)
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from skymap.star_columns import StarColumns, rows_to_columns, save_columns
+from skymap.star_tiles import StarTiles, export_star_tiles, merge_runs
+from skymap.stars import StarTable
+from test_star_columns import star_row
+
+
+class StarTilesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(2)
+        n = 5000
+        ra = rng.uniform(0, 360, n)
+        dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, n)))
+        magnitude = rng.uniform(-1, 14, n)
+        constellation = rng.choice(["ori", "psc"], n)
+        rows = [star_row(i + 1, ra[i], dec[i], magnitude[i], constellation[i]) for i in range(n)]
+        for row in rows[::50]:
+            row['proper_name'] = "Star {}".format(row['id'])
+
+        columns = rows_to_columns(rows)
+        order = numpy.argsort(columns['declination'])
+        columns_folder = os.path.join(self.folder, "columns")
+        os.makedirs(columns_folder)
+        save_columns(columns_folder, columns, order)
+        self.columns = StarColumns(columns_folder)
+
+        export_star_tiles(self.columns, os.path.join(self.folder, "tiles"))
+        self.tiles = StarTiles(os.path.join(self.folder, "tiles"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_select(self, *args):
+        expected = [self.columns.row(i)['id'] for i in self.columns.select(*args)]
+        rows = [band.row(i) for band, indices in self.tiles.select(*args) for i in indices]
+        self.assertEqual([r['id'] for r in rows], expected)
+
+    def test_select(self):
+        self.check_select(5.0)
+        self.check_select(12.0)
+        self.check_select(9.0, None, (350.0, 40.0), (-30.0, 30.0))
+        self.check_select(13.0, None, (100.0, 130.0), (60.0, 90.0))
+        self.check_select(14.0, "psc", (200.0, 250.0), (-20.0, -5.0))
+
+    def test_names(self):
+        named = 0
+        for band, indices in self.tiles.select(14.0, None, (350.0, 40.0), (-30.0, 30.0)):
+            table = StarTable.from_columns(band, indices)
+            for star in table:
+                if star.id % 50 == 1:
+                    self.assertEqual(star.proper_name, "Star {}".format(star.id))
+                    named += 1
+                else:
+                    self.assertIsNone(star.proper_name)
+        self.assertGreater(named, 0)
+
+    def test_merge_runs(self):
+        values = numpy.array([1.0, 3.0, 5.0, 2.0, 3.0, 0.0, 6.0])
+        runs = [numpy.array([0, 1, 2]), numpy.array([3, 4]), numpy.array([5, 6])]
+        self.assertEqual(list(merge_runs(runs, values)), [5, 0, 3, 1, 4, 2, 6])
@@ -0,0 +1,122 @@
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+from skymap.database import open_database
+from skymap.vizier import parse_records, convert_field, prefetch, decode_datafile, load_datafiles_parallel
+
+
+DATADICTS = [
+    {'startbyte': 0, 'stopbyte': 6, 'format': int, 'label': "HIP"},
+    {'startbyte': 7, 'stopbyte': 8, 'format': str, 'label': "Flag"},
+    {'startbyte': 9, 'stopbyte': 15, 'format': float, 'label': "Vmag"},
+    {'startbyte': 16, 'stopbyte': 20, 'format': str, 'label': "Comp"}
+]
+
+
+def parse_line(line, datadicts):
+    values = []
+    for d in datadicts:
+        s = line[d['startbyte']:d['stopbyte']]
+        if s and s[-1] == "\n":
+            s = s[:-1]
+        values.append(convert_field(s, d['format']))
+    return tuple(values)
+
+
+class ParseRecordsTest(unittest.TestCase):
+    def test_fixed_length(self):
+        lines = [
+            "    12 A  1.234 AB  \n",
+            "123456    -0.5      \n",
+            "       B        C   \n",
+        ]
+        rows = parse_records(lines, DATADICTS)
+        self.assertEqual(rows, [parse_line(l, DATADICTS) for l in lines])
+        self.assertEqual(rows[0], (12, "A", 1.234, "AB  "))
+        self.assertEqual(rows[2], (None, "B", None, "C   "))
+
+    def test_variable_length(self):
+        lines = [
+            "    12 A  1.234\n",
+            "     7\n",
+            "    13 V   7.10 A",
+        ]
+        rows = parse_records(lines, DATADICTS)
+        self.assertEqual(rows, [parse_line(l, DATADICTS) for l in lines])
+        self.assertEqual(rows[1], (7, "", None, ""))
+
+    def test_invalid(self):
+        lines = [
+            "   1.5 A  1.234 AB  \n",
+            "    12 A    --- AB  \n",
+        ]
+        rows = parse_records(lines, DATADICTS)
+        self.assertEqual(rows, [parse_line(l, DATADICTS) for l in lines])
+        self.assertEqual(rows[0][0], None)
+        self.assertEqual(rows[1][2], None)
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(iter(range(100)), depth=2)), range(100))
+
+    def test_consumer_error(self):
+        # The producer thread must not wait forever for room in the queue
+        nthreads = threading.active_count()
+        try:
+            for item in prefetch(iter(range(100)), depth=2):
+                raise KeyError(item)
+        except KeyError:
+            pass
+        for i in range(50):
+            if threading.active_count() == nthreads:
+                break
+            threading.Event().wait(0.1)
+        self.assertEqual(threading.active_count(), nthreads)
+
+
+class ParallelLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "skymap.db")
+        self.lines = ["{:6d} A {:6.3f} AB  \n".format(i, i / 1000.0) for i in range(1, 2501)]
+        with open(os.path.join(self.folder, "main.dat"), "w") as fp:
+            fp.writelines(self.lines[:1200])
+        fp = gzip.open(os.path.join(self.folder, "main2.dat.gz"), "wb")
+        fp.writelines(self.lines[1200:])
+        fp.close()
+        self.jobs = [(self.folder, "main.dat", "cat_main", DATADICTS), (self.folder, "main2.dat.gz", "cat_main", DATADICTS)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_decode_datafile(self):
+        blocks = list(decode_datafile(self.jobs[0]))
+        self.assertEqual([len(rows) for table, rows in blocks], [1000, 200])
+        self.assertEqual(blocks[1][1][-1], parse_line(self.lines[1199], DATADICTS))
+
+    def test_load(self):
+        columns = [d['label'] for d in DATADICTS]
+        db = open_database("sqlite", path=self.path)
+        db.create_table("cat_main", columns, [d['format'] for d in DATADICTS])
+
+        n = load_datafiles_parallel(self.jobs, {"cat_main": columns}, processes=2, writers=1, depth=1,
+                                    database=lambda: open_database("sqlite", path=self.path))
+        self.assertEqual(n, len(self.lines))
+        rows = db.query("""SELECT HIP FROM cat_main ORDER BY HIP""")
+        self.assertEqual([r['HIP'] for r in rows], range(1, len(self.lines) + 1))
+        db.close()
+
+    def test_worker_error(self):
+        columns = [d['label'] for d in DATADICTS]
+        db = open_database("sqlite", path=self.path)
+        db.create_table("cat_main", columns, [d['format'] for d in DATADICTS])
+        with open(os.path.join(self.folder, "main.txt"), "w") as fp:
+            fp.writelines(self.lines)
+        jobs = self.jobs + [(self.folder, "main.txt", "cat_main", DATADICTS)]
+        self.assertRaises(IOError, load_datafiles_parallel, jobs, {"cat_main": columns}, processes=2, writers=1, depth=1,
+                          database=lambda: open_database("sqlite", path=self.path))
+        db.close()